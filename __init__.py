@@ -24,18 +24,71 @@ positional arguments:
   command
     backend       Backends handling.
       {install,set}           installs or sets backend
-      {pdf2djvu,djvudigital}  choosed backend
+      {pdf2djvu,djvudigital,djvulibre}  choosed backend
+      --mirror URL|FOLDER     with install, tries this mirror first (i.e. other machine's download
+                                cache), remembered, `none` turns it off
+      --cache FOLDER          with install, keeps downloaded archives and checksums in FOLDER
+      --sha256 HEX            with install, expected SHA-256 of downloaded archive
 
     convert       Convert file to djvu.
       -p PATH, --path PATH  convert file under PATH to djvu using default settings
       -i ID, --id ID        convert file with ID to djvu using default settings
       --all                 convert all pdf files in calibre's library, you have to turn on postimport
                                 conversion first, works for every backend
+      --batch SOURCE        convert documents of folder tree SOURCE, listed in file SOURCE (one path
+                                per line) or read from stdin (`-`) outside calibre's library,
+                                without questions, last line of output is JSON summary
+      --refresh             with -i or --all, re-encode only changed pages of replaced PDFs
+                                and splice them into existing DJVU
+      --pages RANGES        with -p or -i, convert only pages like 1-20 into a preview DJVU
+                                and project time and size of whole book from it
+      -o DIR, --output DIR  with --batch, write DJVUs into DIR keeping layout of SOURCE (by default
+                                next to source documents)
+      --jobs N              with --all or --batch, convert N books at once instead of adapting their number
+                                to throughput and free memory
+      --force               with -i, --all or --batch, convert also scans predicted to shrink less than
+                                `min_gain` (plugins/djvumaker.json, 0.1 by default)
+      --estimate            with --all, only print projected CPU time, wall time (at --jobs N) and
+                                DJVU size of candidate books from past conversions, costliest books
 
     postimport    Change postimport settings
       -y, --yes     sets plugin to convert PDF files after import (sometimes do not work for pdf2djvu)
       -n, --no      sets plugin to do not convert PDF files after import (default)
 
+    profile       Change device profile, backends render pages at DPI fitting them to device screen
+      [PROFILE]     sets profile by name, as WIDTHxHEIGHT or turns it off with `none`
+      -l, --list    lists known device profiles
+
+    worker        Run worker node converting books sent by other calibre installations in local network
+      --host HOST, --port PORT  address to listen on (default: 127.0.0.1, port 8765), other
+                    addresses require --token
+      --capacity N  number of books or page shards converted at once, by default from backend's
+                    declared threads and memory
+      --token TOKEN shared secret required from coordinators, sent unencrypted
+
+    nodes         Change worker nodes which convert books of this library, lists them without arguments
+      --add HOST:PORT[/CAPACITY], --remove HOST:PORT[/CAPACITY]
+      --loopback N  runs N local worker nodes, for testing without other machines
+      --loopback-capacity N, --shard-pages N, --retries N, --token TOKEN
+
+    index         Profile library books (pages, images, encodings, DPI, scan verdict) into sidecar index
+      --rebuild                profiles all books again
+      --show ID                prints recorded profile of book
+      --tag TAG                adds TAG to books indexed as scans
+      --background {on,off}    background indexing in GUI (off by default), --auto-tag TAG tags new scans
+                               ('' turns off)
+
+    trace         Record timing of conversion phases, also in fork_job workers, shows state without arguments
+      --on [--profile], --off  turns tracing on (with cProfile dumps of Python phases) or off
+      --export FILE            writes recorded spans as Chrome trace JSON
+      --clear                  removes recorded spans and profiles
+
+    metrics       Publish live metrics of conversions for Prometheus, shows state without arguments
+      --on, --off              turns metrics on or off
+      --port PORT              serves them on http://127.0.0.1:PORT/metrics during conversions (0: off)
+      --textfile FILE          writes them to FILE, i.e. in node_exporter's textfile collector folder
+      --show                   prints current metrics of all processes
+
     install_deps  (depreciated) alias for `calibre-debug -r djvumaker -- backend install djvudigital`
     convert_all   (depreciated) alias for `calibre-debug -r djvumaker -- convert --all`
     test          (only for debugging, first has to be turned on in utils.py:53) custom command
@@ -49,12 +102,58 @@ Features:
 =========
 * downloading and installation two backend:
   * djvudigital (for macOS - through brew)
-  * pdf2djvu (for Windows - through automated download from author's github)
+  * pdf2djvu (for Windows - through automated download from author's github, interrupted downloads
+      are resumed, archives verified by SHA-256 and cached, a mirror in local network is tried first)
 * discover method - you can just add your existing tool to you PATH env
 * easy-to-use right click menu item for conversion of single or many PDF documents
 * postimport file conversion (curently works only for djvudigital backend)
 * notification about current conversion progress for (curently works only for pdf2djvu backend)
 * CLI support for setting changes, installations of backends and manual conversion of files
+* every converted DJVU is validated before it's added to library: IFF85 structure, chunk sizes,
+    bundled directory and page count against the source document, read without loading image data
+* device profiles - rendering DPI fitted to e-reader screen
+* preview of a few pages (`convert --pages 1-20`, `Preview DJVU` in GUI) with projected time and
+    size of whole book, for trying backend flags quickly (pdf2djvu and djvulibre backends)
+* blank and duplicate pages are encoded once (pdf2djvu backend, needs bzz or djvm from DjVuLibre),
+    which saves encoding time, not output size: duplicates are copied into the DJVU,
+    turned off by `"skip_redundant_pages": false` in plugins/djvumaker.json
+* TIFF, CBZ and folders of page images are encoded directly by DjVuLibre (cjb2/c44), in parallel
+* pages are bundled by the plugin itself: DIRM directory is written and components are copied from
+    memory mapped files in one pass, only the directory goes through DjVuLibre's bzz (djvm -c
+    is used without it), indirect (multi-file) documents can be written too
+* djvulibre backend - streaming pipeline, ghostscript renders pages while DjVuLibre encodes
+    the previous ones, with only a few pages on disk at once
+* distributed conversion - books and their page shards are sent to worker nodes in local network
+* scans are told from authored PDFs by sampling up to 16 pages for image coverage and visible text
+* optional background indexer records page count, image encodings, DPI and scan verdict of library books,
+    conversions and `convert --all` look verdicts up instead of opening documents again
+* backends declare their capabilities (page ranges, progress, parallel runs, threads, memory),
+    concurrency of `convert --all`, worker node capacity and pipeline threads follow from them
+* `convert --all` and books converted from GUI adapt number of conversions at once to measured pages
+    per second and memory pressure (additive increase, multiplicative decrease), `--jobs N` fixes it
+* scanned PDFs predicted (from image encoding, bytes per page and past conversions) to shrink less
+    than `"min_gain"` in plugins/djvumaker.json (10 %) as DJVU are skipped once there are enough
+    recorded conversions, `convert --force` overrides
+* `convert --all --estimate` projects CPU time, wall time and DJVU size of the run from recorded
+    throughput and compression of past conversions, lists costliest books
+* `convert --batch SOURCE -o DIR` converts a folder tree or list of files outside calibre's library
+    in parallel: outputs are renamed into place when complete, up-to-date ones (newer than their
+    source) are skipped, a JSON summary ends the run
+* one book is converted once at a time: GUI, postimport and CLI requests for a document already
+    being converted (in any process) wait for it and attach to its result
+* every backend command runs in its own process group (session), abort and fork_job timeout
+    terminate the whole tree (SIGTERM, SIGKILL after 5 s), scratch folders and partial output are removed
+* djvudigital passes ghostscript rendering threads, band buffer and bitmap size (`--gsarg`)
+    computed from page size, DPI, cores and memory of the conversion, chosen values are logged
+* pdf2djvu renders with `--jobs` = cores / conversions running on the machine (counted over
+    calibre, fork_job workers and CLI) when it starts, so parallel conversions don't oversubscribe
+    cores; running conversions keep their threads, user's `-j`/`--jobs` is kept as is
+* bulk conversions (`convert --all`, many books selected in GUI) add DJVUs to library in batches
+* opt-in live metrics (`metrics --on`): queue depth, running backends, pages per second, bytes in and
+    out, failures by reason and conversion latency histograms of all processes in Prometheus text
+    format, written to a file and served on localhost
+* only the first and last 200 lines of backend output go to the job log, full output is kept in
+    rotating log files in plugins/djvumaker/logs
 
 
 Technical details:
@@ -135,6 +234,24 @@ References:
 --- Modules ---
 gui.py      -- handles GUI connection
 utils.py    -- utility methods, CLI generation, pdf2djvu installtion scripts
+pdfscan.py  -- lightweight reading of PDF page tree and content streams, redundant pages detection
+djvu.py     -- reading and assembling DjVu documents from single pages
+images.py   -- direct conversion of TIFF, CBZ and folders of page images
+pipeline.py -- streaming conversion engine: page sources, parallel encoders and bundler
+distributed.py -- conversion on worker nodes in local network, coordinator and worker server
+tracing.py  -- opt-in timing of conversion phases, Chrome trace export
+metrics.py  -- live counters, gauges and histograms of conversions, Prometheus text file and HTTP
+logcapture.py -- memory-bounded capture of backend output, rotating log files
+results.py  -- batched library writes of converted documents
+index.py    -- sidecar index of document profiles of library books, background indexer
+backends.py -- Backend abstract base classes declaring capabilities and cost hints of backends
+inflight.py -- lock files of conversions in flight, concurrent requests attach to their result
+processes.py -- process groups of backend commands, termination of whole trees, scratch folders,
+    registry of running conversions
+download.py -- resumable, checksum-verified downloads of backend archives, cache and mirror
+bulk.py     -- throughput-adaptive number of books converted at once in bulk runs
+estimate.py -- per backend history of conversion throughput, cost estimate of bulk runs
+batch.py    -- conversion of folder trees and file lists outside calibre library, atomic outputs
 
 --- Globals ---
 PLUGINNAME      -- name of the plugin, i.e.: 'djvumaker'
@@ -142,9 +259,11 @@ PLUGINVER       -- plugin version in tuple  form, i.e.: (1,0,2)
 PLUGINVER_DOT   -- plugin version in string form, i.e.: '1.0.2'
 prints          -- prints function from Calibre, prepanded with string: 'djvumaker: '
 printsd         -- prints function from Calibre, prepanded with string: 'DEBUG: djvumaker: '
+PREVIEW_PAGES   -- pages converted by GUI preview
 
 --- Meaningful imports ---
 from calibre import force_unicode,  -- output from other tools should be one time(!) piped through
+                    as_unicode,     -- text of exceptions, also with non-ASCII paths
                     prints          -- #NODOC
 from calibre.customize import FileTypePlugin, InterfaceActionBase -- plugin classes for inheritance
 from calibre.customize.ui import run_plugins_on_postimport -- Calibre runs every filetypeplugin with
@@ -166,7 +285,17 @@ DJVUmaker(FileTypePlugin, InterfaceActionBase)  -- basic plugin class
   .cli_install_backend(self, args)    -- #NODOC
   .cli_set_backend(self, args)        -- #NODOC
   .cli_set_postimport(self, args)     -- #NODOC
+  .cli_set_profile(self, args)        -- #NODOC
+  .cli_trace(self, args)              -- #NODOC
+  .trace_dir(self)                    -- folder of recorded traces
+  .cli_metrics(self, args)            -- #NODOC
+  .metrics_dir(self)                  -- folder of metrics snapshots of all processes
+  .metrics_server(self, prints)       -- serve metrics on localhost if port is set
+  .cli_index(self, args)              -- #NODOC
+  .cli_worker(self, args)             -- #NODOC
+  .cli_nodes(self, args)              -- #NODOC
   .cli_convert(self, args)            -- #NODOC
+  .cli_preview(self, args)            -- `convert --pages`, preview DJVU and projection
   --- Methods required by Calibre ---
   .customization_help(self, gui=True) -- return message inside "Customize plugin" menu
   .run(self, path_to_ebook)   -- #NODOC
@@ -175,28 +304,91 @@ DJVUmaker(FileTypePlugin, InterfaceActionBase)  -- basic plugin class
   @classmethod
   .register_backend(cls, fun) -- adds backend to plugin
   ._postimport(self, book_id, book_format=None, db=None, log=None, fork_job=True, abort=None,
-      notifications=None)     -- starting jobs method
+      notifications=None, refresh=False, results=None, force=False) -- starting jobs method
+  .batched_results(self, db, prints) -- context of bulk conversion, library writes are batched
+  .add_result(self, db, book_id, djvu, prints, results=None, after=None, failed=None) -- add DJVU to
+      book
   .site_customization_parser(self, use_backend) -- parse user setting from "Customize plugin" menu
   .run_backend(self, *args, **kwargs) -- choose backend to run
+  .target_dpi(self, srcdoc)   -- rendering DPI from saved device profile
+  .save_page_record(self, db, book_id, path_to_ebook, prints, keys=None) -- page keys of converted PDF
+  .load_page_record(self, db, book_id)
+  .needs_refresh(self, db, book_id)   -- PDF changed since DJVU was converted
+  .distributed_enabled(self)          -- worker nodes are configured
+  .worker_convert(self, path, pages, dpi, abort) -- conversion of job received as worker node
+  .coordinator(self, prints)          -- coordinator of worker nodes, starts loopback nodes
+  .run_distributed(self, path_to_ebook, prints, abort=None) -- convert on worker nodes
+  .backend(self)                      -- Backend instance of used backend, see backends.py
+  .backend_supports_pages(self)       -- backend can convert only selected pages
+  .preview(self, path, pages=None, log=None, abort=None, notifications=None) -- convert a few pages
+  .book_path(self, db, book_id)       -- path of book's PDF, TIFF or CBZ
+  .check_output(self, djvu, pages, prints) -- validate DJVU structure and page count before adding it
+  .local_concurrency(self)            -- conversions run at once here, from backend's declarations
+  .conversion_limit(self, prints, fixed=None) -- ConcurrencyLimit of bulk conversions in this process
+  .conversion_slot(self, pages=None, abort=None) -- context of one conversion waiting for its slot
+  .predict_output(self, profile, path) -- Prediction of DJVU size of scan
+  .unprofitable(self, profile, path, prints) -- why converting scan doesn't pay off (gain below
+      `min_gain` predicted from conversion history)
+  .conversion_candidates(self, db, index) -- (book_id, path, pages, size) of books `convert --all` converts
+  .cli_estimate(self, args)           -- print projected cost of `convert --all`
+  .cli_batch(self, args)              -- convert files outside library, print JSON summary
+  .library_index(self, db)            -- LibraryIndex of document profiles of library books
+  .start_indexer(self, db, prints=None, tag_books=None) -- keep library index updated in background
+      thread if turned on
+  .tag_scanned(self, db, tag, book_ids=None) -- add tag to books indexed as scans
+  .in_flight(self, db, book_id, path_to_ebook) -- InFlight lock of conversion of book's document
+  ._convert_book(self, book_id, book_format, db, path_to_ebook, pages, images, prints, log, fork_job,
+                 abort, notifications, results, encoding=None, flight=None) -- conversion part of
+                 _postimport, run under in-flight lock
+  ._refresh(self, book_id, db, prints, log, abort, notifications, results=None)
+      -- splice changed pages into DJVU, under in-flight lock
+  ._refresh_pages(self, book_id, db, path_to_ebook, prints, log, abort, notifications)
+      -- refreshed DJVU and page keys, None if DJVU is up to date
 
 NotSupportedFiletype(Exception) -- #NODOC
+Preview(djvu, pages, seconds, size, page_count) -- preview conversion
+  .report()                   -- preview's time and size per page, projection for whole book
 
 --- Functions ---
 
 is_rasterbook(path, basic_return=True) -- #NODOC
+document_profile(path)          -- pages, images, encodings, DPI and raster verdict of document
+document_page_count(path)       -- number of pages, None if it cannot be read
+profile_resolution(profile)     -- screen resolution of named or WIDTHxHEIGHT device profile
+page_size(path, samples=5)      -- biggest page size in inches, read through podofo
+profile_dpi(path, resolution)   -- DPI fitting document pages to screen resolution
 raise_if_not_supported(srcdoc, supported_extensions) -- #NODOC
-job_handler(fun) -- #NODOC
-
-    --- Implemented backends ---
-@DJVUmaker.register_backend
-@job_handler
-@add_method_dec(pdf2djvu_custom_printing, 'printing')
-pdf2djvu(srcdoc, cmdflags, djvu, preferences)   -- #NODOC
-    .printing = pdf2djvu_custom_printing(readout, pages, images) -- custom printing and notifications
-
-@DJVUmaker.register_backend
-@job_handler
-djvudigital(srcdoc, cmdflags, djvu, preferences) -- #NODOC
+plan_redundant_pages(backend, srcdoc, cmdflags, preferences, prints) -- duplicate and blank pages to skip
+signal_gui_refresh(prints)       -- ask running calibre GUI to reload library
+capture_log(prints, name) -- LogCapture printing head and tail, full output in plugin's logs folder
+running_registry()      -- folder where running conversions of all processes register
+discard(path)           -- remove partial output of failed conversion
+conversion_history()    -- History of finished conversions, shared by all processes
+record_conversion(backend, srcdoc, djvu, pages, cpu, encoding, prints) -- add finished conversion to
+    history
+conversion_metrics(backend, srcdoc, djvu, pages, seconds, reason=None) -- count conversion in metrics
+job_handler(backend) -- #NODOC conversion function of Backend instance, registered by its name
+
+    --- Implemented backends --- (capabilities declared as in backends.Backend)
+Pdf2djvu(Backend)       -- page ranges, progress from output, threads share cores with running books
+  .command(srcdoc, cmdflags, djvu, preferences) -- #NODOC
+  .thread_flags(threads, cmdflags, preferences=None) -- --jobs, left out if set by user or pdf2djvu
+      was built without OpenMP
+  .has_jobs_option(pdf2djvu_path)
+  .page_flags(pages)    -- pdf2djvu cmd flags converting only chosen pages
+  .printing(readout, pages, images) -- custom printing and notifications
+Djvudigital(Backend)    -- ghostscript rendering tuned to page size, DPI, cores and memory
+  .command(srcdoc, cmdflags, djvu, preferences) -- #NODOC
+  .tuning_flags(srcdoc, cmdflags, threads, memory) -- --gsarg flags of rendering threads and buffers
+Djvulibre(InProcessBackend) -- page ranges, in-process pipeline using all cores, reports progress
+                           from its runner
+  .command(srcdoc, cmdflags, djvu, preferences) -- ghostscript command of first pipeline stage
+  .page_flags(pages)
+  .thread_flags(threads, cmdflags, preferences=None) -- number of encoders unless set by user
+  .runner(srcdoc, cmdflags, djvu, prints, notifications, abort) -- runs conversion instead of the command
+pdf2djvu = DJVUmaker.register_backend(job_handler(Pdf2djvu()))
+djvudigital = DJVUmaker.register_backend(job_handler(Djvudigital()))
+djvulibre = DJVUmaker.register_backend(job_handler(Djvulibre()))
 
     --- Non working backends ---
 c44	    (srcdoc, cmdflags=[], log=None)
@@ -232,7 +424,7 @@ Main TODOs:
 * (M-H) pdf2djvu sometimes doesn't work for postimport
 * (H) plugin settings QT widget
 * (H) make general overhaul of starting conversion logic
-* (H) add support for conversion from other formats
+* (H) add support for conversion from other formats (besides TIFF, CBZ and image folders)
 #NODOC - more todos
 """
 from __future__ import unicode_literals, division, absolute_import, print_function
@@ -250,10 +442,12 @@ if __name__ == '__main__':
     sys.stdout.write(PLUGINVER_DOT) #Makefile needs this to do releases
     sys.exit()
 
-import errno, os, sys, shutil, traceback, subprocess, collections
+import errno, os, sys, shutil, traceback, subprocess, collections, json, time, tempfile
 from functools import partial, wraps
+from contextlib import contextmanager
+from distutils.spawn import find_executable
 
-from calibre import force_unicode, prints
+from calibre import as_unicode, force_unicode, human_readable, prints
 from calibre.ebooks import ConversionError
 from calibre.ptempfile import PersistentTemporaryFile
 from calibre.customize import FileTypePlugin, InterfaceActionBase
@@ -263,7 +457,35 @@ from calibre.utils.podofo import get_podofo
 from calibre.utils.ipc.simple_worker import fork_job as worker_fork_job, WorkerError
 from calibre_plugins.djvumaker.utils import (create_backend_link, create_cli_parser, install_pdf2djvu,
                                              discover_backend, ask_yesno_input, empty_function,
-                                             EmptyClass, add_method_dec, plugin_dir)
+                                             EmptyClass, plugin_dir, page_ranges,
+                                             file_fingerprint, run_concurrently, cpu_count,
+                                             physical_memory, format_duration, temporary_path)
+from calibre_plugins.djvumaker.pdfscan import (DocumentProfile, PDFDocument, PDFScanError,
+                                               plan_distinct_pages, profile_document, scan_pages)
+from calibre_plugins.djvumaker.djvu import (DjVuError, can_bundle, expand_page_plan, assemble_pages,
+                                            validate_document)
+from calibre_plugins.djvumaker.images import INPUT_TYPES, images_to_djvu, is_image_input
+from calibre_plugins.djvumaker.images import page_count as image_page_count
+from calibre_plugins.djvumaker.distributed import (DistributedError, Coordinator, Node, WorkerServer,
+                                                   parse_node, start_loopback)
+from calibre_plugins.djvumaker.tracing import span, traced, trace_env
+from calibre_plugins.djvumaker.logcapture import LogCapture, log_file
+from calibre_plugins.djvumaker.results import ResultCollector
+from calibre_plugins.djvumaker.index import Indexer, LibraryIndex, library_formats
+from calibre_plugins.djvumaker.bulk import ConcurrencyLimit
+from calibre_plugins.djvumaker.estimate import History, default_rates, dominant_encoding, estimate
+from calibre_plugins.djvumaker.inflight import InFlight, inflight_key
+from calibre_plugins.djvumaker.batch import (FileResult, batch_sources, output_path, publish,
+                                             up_to_date)
+from calibre_plugins.djvumaker.batch import summary as batch_summary
+from calibre_plugins.djvumaker import tracing
+from calibre_plugins.djvumaker import metrics
+from calibre_plugins.djvumaker.backends import Backend, InProcessBackend, flag_given
+from calibre_plugins.djvumaker.processes import (popen_group, process_cpu_time, reap_orphans,
+                                                 register_group, register_path, running_job, running_jobs,
+                                                 scratch_env, terminate_group, wait_cpu, watch_abort)
+from calibre_plugins.djvumaker.pipeline import (DEFAULT_DPI, PipelineError, find_ghostscript, gs_command,
+                                                gs_tuning, parse_flags, rasterize_to_djvu)
 
 # if iswindows and hasattr(sys, 'frozen'):
 #     # CREATE_NO_WINDOW=0x08 so that no ugly console is popped up
@@ -284,6 +506,28 @@ if DEBUG:
 else:
     printsd = empty_function
 
+# Screen resolutions (width, height) in pixels of e-reader devices, backends render pages
+# at the DPI which fits a book's page size to the screen of the chosen profile
+DEVICE_PROFILES = collections.OrderedDict([
+    ('kindle-paperwhite', (758, 1024)),
+    ('kindle-voyage', (1072, 1448)),
+])
+PROFILE_DPI_RANGE = (72, 600) # rendering DPI computed from a profile is clamped to this range
+PREVIEW_PAGES = 20 # pages converted by GUI preview
+
+class Preview(collections.namedtuple('Preview', ['djvu', 'pages', 'seconds', 'size', 'page_count'])):
+    """Preview conversion of a few pages, whole book is projected from its per page figures."""
+
+    def report(self):
+        text = 'Preview of {} pages converted in {}, {} ({:.2f} s and {} per page).'.format(
+            self.pages, format_duration(self.seconds), human_readable(self.size),
+            self.seconds / self.pages, human_readable(self.size // self.pages))
+        if self.page_count:
+            text += ' Whole book of {} pages projected: {}, {}.'.format(
+                self.page_count, format_duration(self.seconds / self.pages * self.page_count),
+                human_readable(self.size * self.page_count // self.pages))
+        return text
+
 # -- Calibre Plugin class --
 class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for gui hooks!
     #NODOC
@@ -294,7 +538,7 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
     author              = 'Joey Korkames' # The author of this plugin
     version             = PLUGINVER   # The version number of this plugin
     # The file types that this plugin will be automatically applied to
-    file_types          = set(['pdf','ps', 'eps'])
+    file_types          = set(['pdf','ps', 'eps', 'tif', 'tiff', 'cbz'])
     on_postimport       = True # Run this plugin after books are addded to the database
     # needs the new db api w/id() bugfix, and podofo.image_count()
     minimum_calibre_version = (2, 22, 0)
@@ -315,6 +559,16 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
         DEFAULT_STORE_VALUES = {}
         DEFAULT_STORE_VALUES['plugin_version'] = PLUGINVER
         DEFAULT_STORE_VALUES['postimport'] = False
+        DEFAULT_STORE_VALUES['device_profile'] = None
+        DEFAULT_STORE_VALUES['skip_redundant_pages'] = True
+        DEFAULT_STORE_VALUES['min_gain'] = 0.1 # scans predicted to shrink less are not converted
+        DEFAULT_STORE_VALUES['distributed'] = {
+            'nodes' : [], 'loopback' : 0, 'loopback_capacity' : 1, 'shard_pages' : 50,
+            'retries' : 2, 'token' : None}
+        DEFAULT_STORE_VALUES['trace'] = {'enabled' : False, 'profile' : False}
+        DEFAULT_STORE_VALUES['metrics'] = {'enabled' : False, 'textfile' : None, 'port' : None}
+        DEFAULT_STORE_VALUES['index'] = {'background' : False, 'interval' : 600, 'tag' : None}
+        DEFAULT_STORE_VALUES['download'] = {'mirror' : None, 'cache' : None}
         for item in self.REGISTERED_BACKENDS:
             DEFAULT_STORE_VALUES[item] = {
                 'flags' : [], 'installed' : False, 'version' : None}
@@ -335,6 +589,16 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             for key, val in DEFAULT_STORE_VALUES.iteritems():
                 self.plugin_prefs[key] = val
 
+        if self.plugin_prefs['trace']['enabled']:
+            tracing.enable(self.trace_dir(), self.plugin_prefs['trace']['profile'])
+        if self.plugin_prefs['metrics']['enabled']:
+            metrics.enable(self.metrics_dir(), self.plugin_prefs['metrics']['textfile'])
+        self._results = None # ResultCollector of running bulk conversion
+        self._force = False # bulk conversion converts books which don't pay off too
+        self._indexes = {} # library_id -> LibraryIndex
+        self._indexer = None
+        self._metrics_server = None
+
     def site_customization_parser(self, use_backend):
         """Parse user input from "Customize plugin" menu. Return backend and cmd flags to use."""
         backend, cmdflags = use_backend, self.plugin_prefs[use_backend]['flags']
@@ -360,12 +624,16 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             pass
         return backend, cmdflags
 
+    @traced('run_backend')
     def run_backend(self, *args, **kwargs):
         """
         Choose proper backend. Check saved settings and overriden from "Customize plugin" menu.
 
         Possible kwargs:
             cmd_creation_only:bool -- if True, return only command creation function result
+            dpi:int                -- rendering DPI, by default computed from the device profile
+            page_selection:list    -- 0-based indexes of the only pages to convert
+            encoding:str           -- dominant image encoding of PDF, recorded in conversion history
         """
         use_backend = self.plugin_prefs['use_backend']
         kwargs['preferences'] = self.plugin_prefs
@@ -378,11 +646,31 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
 
         if 'cmd_creation_only' in kwargs and kwargs['cmd_creation_only']:
             kwargs.pop('cmd_creation_only')
+            kwargs.pop('dpi', None)
+            kwargs.pop('page_selection', None)
+            kwargs.pop('encoding', None)
             return self.REGISTERED_BACKENDS[use_backend].__wrapped__(*args, **kwargs)
                 #srcdoc, cmdflags, djvu, preferences
         kwargs.pop('cmd_creation_only', None)
+        if 'dpi' not in kwargs:
+            kwargs['dpi'] = self.target_dpi(args[0])
+        if is_image_input(args[0]):
+            # scanned page images are encoded directly with DjVuLibre, no backend is needed
+            return images_to_djvu(*args, **kwargs)
         return self.REGISTERED_BACKENDS[use_backend](*args, **kwargs)
 
+    def target_dpi(self, srcdoc):
+        """Rendering DPI for `srcdoc` from the saved device profile, None if no profile is set."""
+        profile = self.plugin_prefs['device_profile']
+        if profile is None:
+            return None
+        try:
+            resolution = profile_resolution(profile)
+        except ValueError as err:
+            prints('Error: {} Rendering at default DPI.'.format(err))
+            return None
+        return profile_dpi(srcdoc, resolution)
+
     def customization_help(self, gui=True):
         """Method required by calibre. Shows user info in "Customize plugin" menu."""
         # TODO: add info about current JSON settings
@@ -407,6 +695,8 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
         help_command = 'calibre-debug -r djvumaker -- --help'
         info = ('<p>You can enter overwritting command and flags to create djvu files.'
                 'eg: `pdf2djvu -v`. You have to restart calibre before changes can take effect.<br>'
+                'Without `--jobs N`, pdf2djvu gets cores divided by conversions running when it'
+                ' starts, a running conversion keeps its threads when others start or end.<br>'
                 'Currently set command is: <b>{}</b><br>'
                 '{}'
                 'You can read more about plugin customization running "{}" from command line.</p>').format(command, overriden_info, help_command)
@@ -462,6 +752,13 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
         #                             "Please visit http://github.com/Homebrew/homebrew")
 
         printsd('cli_install_backend enter: args.backend:', args.backend)
+        for key in ('mirror', 'cache'):
+            value = getattr(args, key, None)
+            if value is not None:
+                self.plugin_prefs['download'][key] = None if value.lower() == 'none' else value
+                self.plugin_prefs.commit() # always use commit if uses nested dict
+                prints('Download {} set to: {}'.format(key, self.plugin_prefs['download'][key]))
+
         if not args.backend: # Report currently installed backends if without args
             installed_backend = [k for k, v in {
                     item : self.plugin_prefs[item]['installed'] for item in self.REGISTERED_BACKENDS
@@ -501,7 +798,8 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             # TODO: neat "Not supported" messages for every backend from function
             err_info = 'Only Windows supported. Try manual installation and add pdf2djvu to PATH env'
             if iswindows:
-                success, version = install_pdf2djvu(PLUGINNAME, self.plugin_prefs, log=prints)
+                success, version = install_pdf2djvu(PLUGINNAME, self.plugin_prefs, log=prints,
+                                                    sha256=args.sha256)
             elif isosx: raise Exception(err_info + ' Check djvudigital backend for solution.')
             elif islinux: raise Exception(err_info + ' Can work: `sudo apt-get install pdf2djvu` or your distro equivalent.')
             elif isbsd: raise Exception(err_info)
@@ -521,13 +819,28 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
                 prints('Installation of pdf2djvu was succesfull or unrequired.')
             else:
                 prints('Installation of pdf2djvu was not succesfull.')
+        elif args.backend == 'djvulibre':
+            # only tools from distro packages are needed, the pipeline itself is part of plugin
+            missing = [tool for tool in ('cjb2', 'c44') if find_executable(tool) is None]
+            if not can_bundle():
+                missing.append('bzz')
+            if find_ghostscript() is None:
+                missing.insert(0, 'gs')
+            if missing:
+                raise Exception(('Missing {}. Install DjVuLibre and Ghostscript, i.e.: `sudo apt-get'
+                                 ' install djvulibre-bin ghostscript`, `brew install djvulibre'
+                                 ' ghostscript` or your system equivalent.').format(', '.join(missing)))
+            self.plugin_prefs['djvulibre']['installed'] = True
+            self.plugin_prefs.commit() # always use commit if uses nested dict
+            prints('DjVuLibre and Ghostscript found, djvulibre backend is ready.')
         else:
             raise Exception('Backend not recognized.')
 
     def cli_set_backend(self, args):
         #NODOC
         if not args.backend:
-            prints('Currently set backend: {}'.format(self.plugin_prefs['use_backend']))
+            prints('Currently set backend: {} ({})'.format(self.plugin_prefs['use_backend'],
+                                                           self.backend().capabilities()))
             return None
             # sys.exit()
 
@@ -552,10 +865,197 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             else:
                 prints("Currently {} doesn't do convertion of PDF's after import".format(PLUGINNAME))
 
+    def cli_set_profile(self, args):
+        #NODOC
+        if args.list:
+            for name, (width, height) in DEVICE_PROFILES.iteritems():
+                prints('{:<20} {}x{}'.format(name, width, height))
+            return None
+        if args.profile is None:
+            prints('Currently set device profile: {}'.format(self.plugin_prefs['device_profile']))
+            return None
+
+        if args.profile.lower() == 'none':
+            self.plugin_prefs['device_profile'] = None
+            prints('Device profile turned off, backends render at their default DPI.')
+            return None
+        width, height = profile_resolution(args.profile)
+        self.plugin_prefs['device_profile'] = args.profile
+        prints('{} ({}x{}) successfully set as device profile.'.format(args.profile, width, height))
+        return None
+
+    def cli_trace(self, args):
+        #NODOC
+        settings = self.plugin_prefs['trace']
+        if args.on or args.off:
+            settings['enabled'] = bool(args.on)
+            settings['profile'] = bool(args.on and args.profile)
+            self.plugin_prefs['trace'] = settings
+            self.plugin_prefs.commit() # always use commit if uses nested dict
+        if args.clear:
+            tracing.clear(self.trace_dir())
+            prints('Recorded traces removed.')
+        if args.export:
+            count = tracing.export(self.trace_dir(), args.export)
+            prints('{} spans exported to {}, open it in chrome://tracing or ui.perfetto.dev.'.format(
+                count, args.export))
+        prints('Tracing is {}{}, traces are recorded in {}'.format(
+            'on' if settings['enabled'] else 'off',
+            ' with cProfile dumps' if settings['profile'] else '', self.trace_dir()))
+        return None
+
+    def trace_dir(self):
+        return os.path.join(plugin_dir(PLUGINNAME), 'traces')
+
+    def cli_metrics(self, args):
+        #NODOC
+        settings = self.plugin_prefs['metrics']
+        if args.on or args.off:
+            settings['enabled'] = bool(args.on)
+        if args.port is not None:
+            settings['port'] = args.port or None
+        if args.textfile is not None:
+            settings['textfile'] = os.path.abspath(args.textfile) if args.textfile else None
+        if args.on or args.off or args.port is not None or args.textfile is not None:
+            self.plugin_prefs['metrics'] = settings
+            self.plugin_prefs.commit() # always use commit if uses nested dict
+        if args.show:
+            sys.stdout.write(metrics.render(metrics.collect(self.metrics_dir())))
+            return None
+        prints('Metrics are {}, written to {}{}'.format(
+            'on' if settings['enabled'] else 'off',
+            settings['textfile'] or os.path.join(self.metrics_dir(), 'djvumaker.prom'),
+            ' and served on http://127.0.0.1:{}/metrics during conversions'.format(settings['port'])
+            if settings['port'] else ''))
+        return None
+
+    def metrics_dir(self):
+        return os.path.join(plugin_dir(PLUGINNAME), 'metrics')
+
+    def metrics_server(self, prints):
+        """
+        Serve metrics of all processes on localhost while this process converts, if a port is
+        set. Only one process can listen on it, the rest leave it to the one which does.
+        """
+        port = self.plugin_prefs['metrics']['port']
+        if self._metrics_server is not None or not port or not metrics.enabled():
+            return
+        try:
+            self._metrics_server = metrics.MetricsServer(port, self.metrics_dir())
+        except EnvironmentError as err:
+            self._metrics_server = False
+            prints('metrics are not served on port {} by this process: {}'.format(port, err))
+            return
+        self._metrics_server.start()
+        prints('metrics served on http://127.0.0.1:{}/metrics'.format(port))
+
+    def cli_index(self, args):
+        #NODOC
+        from calibre.library import db
+        db = db() # initialize calibre library database
+        settings = self.plugin_prefs['index']
+        if args.background is not None or args.auto_tag is not None:
+            if args.background is not None:
+                settings['background'] = args.background == 'on'
+            if args.auto_tag is not None:
+                settings['tag'] = args.auto_tag or None
+            self.plugin_prefs['index'] = settings
+            self.plugin_prefs.commit() # always use commit if uses nested dict
+        index = self.library_index(db)
+        if args.show is not None:
+            for book_id, book_format, path in library_formats(db, ('pdf',) + INPUT_TYPES):
+                if book_id == args.show:
+                    profile = index.profile(path, book_id, book_format)
+                    prints('book ID #{} {}: {}'.format(book_id, book_format.upper(), path))
+                    for field, value in profile._asdict().items():
+                        prints('  {:<13}{}'.format(field, value))
+                    return None
+            raise Exception('Book with id #{} has not a PDF, TIFF or CBZ format.'.format(args.show))
+        if args.rebuild:
+            index.clear()
+        start = time.time()
+        updated = index.refresh(library_formats(db, ('pdf',) + INPUT_TYPES), log=prints)
+        profiles = [profile for _, _, profile in index.entries().values()]
+        scans = [profile for profile in profiles if profile is not None and profile.raster]
+        prints(('{} documents profiled in {:.1f} s. Index holds {} books: {} scans ({} pages),'
+                ' {} markup-based, {} unreadable.').format(
+                    len(updated), time.time() - start, len(profiles), len(scans),
+                    sum(profile.page_count for profile in scans),
+                    sum(1 for profile in profiles if profile is not None and not profile.raster),
+                    sum(1 for profile in profiles if profile is None)))
+        if args.tag:
+            prints("'{}' tag added to {} books.".format(args.tag, self.tag_scanned(db, args.tag)))
+        prints('Background indexing in GUI is {}{}.'.format(
+            'on' if settings['background'] else 'off',
+            ", scans are tagged '{}'".format(settings['tag']) if settings['tag'] else ''))
+        return None
+
+    def cli_worker(self, args):
+        #NODOC
+        settings = self.plugin_prefs['distributed']
+        capacity = args.capacity or self.local_concurrency()
+        try:
+            server = WorkerServer((args.host, args.port), self.worker_convert, capacity,
+                                  self.backend_supports_pages(), args.token or settings['token'],
+                                  log=prints)
+        except DistributedError as err:
+            prints(err)
+            return None
+        prints('Worker node listening on {}:{} with capacity {}, stop it with Ctrl+C'.format(
+            args.host or '*', server.server_address[1], capacity))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def cli_nodes(self, args):
+        #NODOC
+        settings = self.plugin_prefs['distributed']
+        if args.add:
+            parse_node(args.add) # check format before saving
+            settings['nodes'] = [node for node in settings['nodes'] if node != args.add] + [args.add]
+        if args.remove:
+            if args.remove not in settings['nodes']:
+                raise Exception('Node {} is not configured.'.format(args.remove))
+            settings['nodes'].remove(args.remove)
+        for option in ('loopback', 'loopback_capacity', 'shard_pages', 'retries', 'token'):
+            if getattr(args, option) is not None:
+                settings[option] = getattr(args, option)
+        self.plugin_prefs['distributed'] = settings
+        self.plugin_prefs.commit() # always use commit if uses nested dict
+
+        if not self.distributed_enabled():
+            prints('No worker nodes, books are converted locally.')
+            return None
+        for node in self.coordinator(prints).nodes:
+            try:
+                reply = node.hello()
+                prints('{:<24} capacity {}, page shards: {}'.format(
+                    node, node.capacity, 'yes' if reply.get('pages') else 'no'))
+            except DistributedError as err:
+                prints('{:<24} {}'.format(node, err))
+        prints('Books with at least {} pages are split into shards, lost jobs are retried {}'
+               ' times.'.format(2 * settings['shard_pages'], settings['retries']))
+        return None
+
     def cli_convert(self, args):
         #NODOC
         printsd(args)
-        if args.all:
+        if args.estimate and not args.all:
+            raise Exception('--estimate works only with --all.')
+        if args.output is not None and args.batch is None:
+            raise Exception('--output works only with --batch.')
+        if args.pages is not None:
+            if args.all or args.batch is not None:
+                raise Exception('--pages works only with -p or -i.')
+            self.cli_preview(args)
+        elif args.batch is not None:
+            self.cli_batch(args)
+        elif args.estimate:
+            self.cli_estimate(args)
+        elif args.all:
             # `calibre-debug -r djvumaker -- convert --all`
             printsd('in cli convert_all')
             # TODO: make work `djvumaker -- convert --all`
@@ -568,41 +1068,252 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             from calibre.library import db
             from calibre.customize.ui import run_plugins_on_postimport
             db = db() # initialize calibre library database
+            index = self.library_index(db)
+            jobs = []
+            markup = 0
             for book_id in list(db.all_ids()):
                 if db.has_format(book_id, 'DJVU', index_is_id=True):
+                    if args.refresh and self.needs_refresh(db, book_id):
+                        jobs.append((partial(self._postimport, book_id, 'pdf', db, fork_job=False,
+                                             refresh=True), None))
                     continue
                 # TODO: shouldn't work with this code, db has not atributte run_plugins_on_postimport
                 #       https://github.com/kovidgoyal/calibre/blob/master/src/calibre/customize/ui.py
-                if db.has_format(book_id, 'PDF', index_is_id=True):
-                    run_plugins_on_postimport(db, book_id, 'pdf')
-                    continue
+                for book_format in ('pdf',) + INPUT_TYPES:
+                    if db.has_format(book_id, book_format.upper(), index_is_id=True):
+                        profile = index.lookup(db.format_abspath(book_id, book_format,
+                                                                 index_is_id=True))
+                        if profile is not None and not profile.raster:
+                            markup += 1 # known from index, no need to open it again
+                        else:
+                            jobs.append((partial(run_plugins_on_postimport, db, book_id,
+                                                 book_format), profile and profile.page_count))
+                        break
+            if markup:
+                prints('{} books indexed as markup-based are skipped'.format(markup))
+            self._force = args.force # postimport plugins are run by calibre, without arguments
+            try:
+                with self.batched_results(db, prints):
+                    if self.distributed_enabled():
+                        # keep every worker node busy, each book can still be split between nodes
+                        run_concurrently([job for job, _ in jobs],
+                                         self.coordinator(prints).capacity())
+                    else:
+                        # number of books at once follows throughput and free memory
+                        limit = self.conversion_limit(prints, args.jobs)
+                        run_concurrently([partial(limit.run, job, pages) for job, pages in jobs],
+                                         limit.maximum, prints)
+            finally:
+                self._force = False
         elif args.path is not None:
             # `calibre-debug -r djvumaker -- convert -p test.pdf` -> tempfile(test.djvu)
             printsd('in path')
-            if is_rasterbook(args.path):
+            if is_image_input(args.path) or is_rasterbook(args.path):
                 djvu = self.run_backend(args.path, log=self.prints.func)
                 if djvu:
-                    input_filename, _ = os.path.splitext(args.path)
+                    self.check_output(djvu, document_page_count(args.path), prints)
+                    input_filename, _ = os.path.splitext(os.path.normpath(args.path))
                     shutil.copy2(djvu, input_filename + '.djvu')
                     prints("Finished DJVU outputed to: {}.".format(input_filename + '.djvu'))
 
-                    user_input = ask_yesno_input('Do you want to open djvused in subshell?'
-                                                 ' (may not work on not macOS)')
-                    if not user_input:
-                        return None
-                    # de-munge the tty
-                    sys.stdin = sys.__stdin__
-                    sys.stdout = sys.__stdout__
-                    sys.stderr = sys.__stderr__
-                    os.system("stat '%s'" % djvu)
-                    # TODO: doesn't work on Windows, why is it here?
-                    os.system("djvused -e dump '%s'" % djvu)
-                    os.system("djvused -v '%s'" % djvu)
-
         elif args.id is not None:
             # `calibre-debug -r djvumaker -- convert -i 123 #id(123).pdf` -> tempfile(id(123).djvu)
             printsd('in convert by id')
-            self._postimport(args.id, fork_job=False)
+            self._postimport(args.id, fork_job=False, refresh=args.refresh, force=args.force)
+
+    def cli_batch(self, args):
+        """
+        `convert --batch SOURCE [-o OUTPUT]`: convert documents of directory tree, listed in file
+        or read from stdin without questions and without calibre library, see batch module.
+        JSON summary is the last line of output, exit status is 1 if any document failed.
+        """
+        extensions = tuple(self.backend().input_types) + INPUT_TYPES
+        sources = batch_sources(args.batch, extensions)
+        prints('{} documents to convert from {}'.format(len(sources), args.batch))
+        self.metrics_server(prints)
+        results = []
+        def convert(path, relative):
+            output = output_path(path, relative, args.output)
+            start = time.time()
+            def finish(status, error=None):
+                results.append(FileResult(path, output, status, round(time.time() - start, 2),
+                                          error))
+            if up_to_date(path, output):
+                return finish('up-to-date')
+            djvu = None
+            try:
+                pages = images = encoding = None
+                if path.lower().endswith('.pdf'):
+                    profile = document_profile(path)
+                    pages, images = profile.page_count, profile.images
+                    encoding = dominant_encoding(profile.encodings)
+                    if not profile.raster:
+                        return finish('skipped', 'markup-based document')
+                    reason = None if args.force else self.unprofitable(profile, path, prints)
+                    if reason is not None:
+                        return finish('skipped', reason)
+                with metrics.tracked('djvumaker_conversions_in_progress'):
+                    djvu = self.run_backend(path, self.prints.func, None, None, pages, images,
+                                            encoding=encoding)
+                if not djvu:
+                    return finish('failed', 'backend produced no DJVU')
+                self.check_output(djvu, pages or document_page_count(path), prints)
+                publish(djvu, output)
+            except Exception as err:
+                error = as_unicode(err) # str() fails on non-ASCII paths
+                prints('{} failed: {}'.format(path, error))
+                return finish('failed', error)
+            finally:
+                if djvu:
+                    discard(djvu)
+            prints('Finished DJVU outputed to: {}.'.format(output))
+            finish('converted')
+
+        # number of documents at once follows throughput and free memory, as with --all
+        limit = self.conversion_limit(prints, args.jobs)
+        run_concurrently([partial(limit.run, partial(convert, path, relative))
+                          for path, relative in sources], limit.maximum, prints)
+        results.sort(key=lambda result: result.source)
+        summary = batch_summary(results)
+        sys.stdout.write(json.dumps(summary, sort_keys=True) + '\n')
+        sys.stdout.flush()
+        if summary['failed']:
+            sys.exit(1)
+
+    def predict_output(self, profile, path):
+        """Prediction of DJVU size of scanned PDF from its DocumentProfile and past conversions."""
+        return conversion_history().predict(self.backend().name, profile.page_count,
+                                            os.path.getsize(path),
+                                            dominant_encoding(profile.encodings))
+
+    def unprofitable(self, profile, path, prints):
+        """
+        Reason why converting scanned PDF doesn't pay off, None if it's predicted to. Only
+        prediction from recorded conversions skips it, guess without history is just logged.
+        """
+        prediction = self.predict_output(profile, path)
+        if prediction.gain >= self.plugin_prefs['min_gain']:
+            return None
+        reason = ('({} per page, {} images) predicted to shrink by {:.0%} as DJVU ({}, based on'
+                  ' {}), less than {:.0%}').format(
+                      human_readable(prediction.size // max(1, profile.page_count)),
+                      dominant_encoding(profile.encodings) or 'no', prediction.gain,
+                      human_readable(prediction.output), prediction.basis,
+                      self.plugin_prefs['min_gain'])
+        if not prediction.samples:
+            prints('{} {}, converting it: too few conversions recorded to skip it'.format(
+                path, reason))
+            return None
+        return reason
+
+    def conversion_candidates(self, db, index):
+        """
+        Yield (book_id, path, pages, size) of books without DJVU which `convert --all` converts,
+        books indexed as markup-based are left out. Pages are None if they cannot be read.
+        """
+        for book_id in list(db.all_ids()):
+            if db.has_format(book_id, 'DJVU', index_is_id=True):
+                continue
+            for book_format in ('pdf',) + INPUT_TYPES:
+                if db.has_format(book_id, book_format.upper(), index_is_id=True):
+                    path = db.format_abspath(book_id, book_format, index_is_id=True)
+                    profile = index.lookup(path)
+                    if profile is None:
+                        yield book_id, path, document_page_count(path), os.path.getsize(path)
+                    elif profile.raster:
+                        yield book_id, path, profile.page_count, os.path.getsize(path)
+                    break
+
+    def cli_estimate(self, args):
+        #NODOC
+        from calibre.library import db
+        db = db() # initialize calibre library database
+        backend = self.backend()
+        rates = conversion_history().rates(backend.name)
+        if rates is None:
+            prints('No {} conversions recorded yet, projecting from declared CPU cost {}.'.format(
+                backend.name, backend.cpu_cost))
+            rates = default_rates(backend.cpu_cost)
+        else:
+            prints('{}: {:.2f} s CPU time per page, DJVU {:.0%} of source size (last {}'
+                   ' conversions).'.format(backend.name, rates.cpu_per_page, rates.size_ratio,
+                                           rates.samples))
+        jobs = args.jobs or self.local_concurrency()
+        cost = estimate(self.conversion_candidates(db, self.library_index(db)), rates, cpu_count(),
+                        jobs, backend.threads)
+        prints('{} books, {:.0f} pages, {} of source documents.'.format(
+            cost.books, cost.pages, human_readable(cost.size)))
+        prints('CPU time: {}, wall time with {} books at once on {} cores: {}.'.format(
+            format_duration(cost.cpu), jobs, cpu_count(), format_duration(cost.wall)))
+        prints('DJVU output: about {}.'.format(human_readable(cost.output)))
+        if cost.costliest:
+            prints('Costliest books:')
+        for book in cost.costliest:
+            prints('  #{}: {:.0f} pages, {} CPU time, {} -> {}, {}'.format(
+                book.book_id, book.pages, format_duration(book.cpu), human_readable(book.size),
+                human_readable(book.output), os.path.basename(book.path)))
+
+    def cli_preview(self, args):
+        #NODOC
+        if args.path is not None:
+            path = args.path
+            output = os.path.splitext(os.path.normpath(path))[0] + '.preview.djvu'
+        else:
+            from calibre.library import db
+            db = db() # initialize calibre library database
+            path = self.book_path(db, args.id)
+            output = os.path.abspath('book-{}.preview.djvu'.format(args.id))
+        preview = self.preview(path, args.pages)
+        shutil.copy2(preview.djvu, output)
+        prints('Preview DJVU outputed to: {}'.format(output))
+        prints(preview.report())
+
+    def preview(self, path, pages=None, log=None, abort=None, notifications=None):
+        """
+        Convert only 0-based `pages` (first PREVIEW_PAGES by default) of document with current
+        backend and flags. Return Preview with projected time and size of whole book.
+        """
+        if pages is None:
+            pages = range(PREVIEW_PAGES)
+        page_count = document_page_count(path)
+        if page_count:
+            pages = [page for page in pages if page < page_count]
+        if not pages:
+            raise Exception('Document {} has only {} pages.'.format(path, page_count))
+        if not is_image_input(path) and not self.backend_supports_pages():
+            raise Exception('{} backend cannot convert selected pages, preview needs pdf2djvu or'
+                            ' djvulibre backend.'.format(self.plugin_prefs['use_backend']))
+        start = time.time()
+        djvu = self.run_backend(path, log or self.prints.func, abort, notifications, len(pages),
+                                None, page_selection=pages)
+        if not djvu:
+            raise Exception('Preview conversion of {} failed.'.format(path))
+        self.check_output(djvu, len(pages), partial(log, '{}:'.format(PLUGINNAME)) if log else prints)
+        return Preview(djvu, len(pages), time.time() - start, os.path.getsize(djvu), page_count)
+
+    def check_output(self, djvu, pages, prints):
+        """
+        Check structure of converted DJVU and its page count (if known) before it's added to
+        library, truncated or malformed output of killed or failed backend is removed and
+        raises Exception.
+        """
+        with span('validate', profile=True):
+            try:
+                summary = validate_document(djvu, pages)
+            except (DjVuError, EnvironmentError) as err:
+                metrics.inc('djvumaker_failures_total', backend=self.plugin_prefs['use_backend'],
+                            reason='invalid_output')
+                discard(djvu) # truncated output of killed job isn't left in temporary folder
+                raise Exception('ConversionError, rejected DJVU {}: {}'.format(djvu, err))
+        prints('validated DJVU: {} pages, {}'.format(summary.pages, human_readable(summary.size)))
+        return summary
+
+    def book_path(self, db, book_id):
+        """Path of book's PDF, or of its TIFF or CBZ if it has no PDF."""
+        for book_format in ('pdf',) + INPUT_TYPES:
+            if db.has_format(book_id, book_format.upper(), index_is_id=True):
+                return db.format_abspath(book_id, book_format, index_is_id=True)
+        raise Exception('Book with id #{} has not a PDF, TIFF or CBZ format.'.format(book_id))
 
     # -- calibre filetype plugin mandatory methods --
     def run(self, path_to_ebook):
@@ -616,8 +1327,9 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
         else:
             return None
 
+    @traced('postimport')
     def _postimport(self, book_id, book_format=None, db=None, log=None, fork_job=True, abort=None,
-                   notifications=None):
+                   notifications=None, refresh=False, results=None, force=False):
         #NODOC IMPORTANT
         # TODO: make general overhaul of starting conversion logic
         if log: # divert our printing to the caller's logger
@@ -636,40 +1348,94 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             #    calibredebug -r djvumaker -- convert -i #id
             # runs also for GUI if run trough `calibredebug -g`
             fork_job = False # DEBUG UNCOMMENT
-            rpc_refresh = True # use the calibre RPC to signal a GUI refresh
 
+        lookup = span('db lookup', book_id=book_id)
         if db is None:
             from calibre.library import db # TODO: probably legacy db import, change for new_api
             db = db() # initialize calibre library database
 
         if book_format == None:
-            if not db.has_format(book_id, 'PDF', index_is_id=True):
-                raise Exception('Book with id #{} has not a PDF format.'.format(book_id))
+            for book_format in ('pdf',) + INPUT_TYPES:
+                if db.has_format(book_id, book_format.upper(), index_is_id=True):
+                    break
             else:
-                book_format='pdf'
+                raise Exception('Book with id #{} has not a PDF, TIFF or CBZ format.'.format(book_id))
 
         if db.has_format(book_id, 'DJVU', index_is_id=True):
+            lookup.end()
+            if refresh and book_format == 'pdf':
+                with self.conversion_slot(None, abort):
+                    return self._refresh(book_id, db, prints, log, abort, notifications, results)
             prints("already have 'DJVU' format document for book ID #{}".format(book_id))
             return None # don't auto convert, we already have a DJVU for this document
 
         path_to_ebook = db.format_abspath(book_id, book_format, index_is_id=True)
+        lookup.end()
+        pages = images = encoding = None
         if book_format == 'pdf':
-            is_rasterbook_val, pages, images = is_rasterbook(path_to_ebook, basic_return=False)
-            if is_rasterbook_val:
-                pass # TODO: should add a 'scanned' or 'djvumaker' tag
+            with span('document profile', profile=True):
+                profile = self.library_index(db).profile(path_to_ebook, book_id, book_format)
+            pages, images = profile.page_count, profile.images
+            encoding = dominant_encoding(profile.encodings) # for conversion history
+            if profile.raster:
+                if self.plugin_prefs['index']['tag']:
+                    self.tag_scanned(db, self.plugin_prefs['index']['tag'], [book_id])
             else:
             # this is a marked-up/vector-based pdf,
             # no advantages to having another copy in DJVU format
                 prints(("{} document from book ID #{} determined to be a markup-based ebook,"
                         " not converting to DJVU").format(book_format, book_id))
                 return None #no-error in job panel
+            if not (force or self._force):
+                reason = self.unprofitable(profile, path_to_ebook, prints)
+                if reason is not None:
+                    prints('{} document from book ID #{} {}, not converting (--force converts'
+                           ' it)'.format(book_format, book_id, reason))
+                    return None
             # TODO: test the DPI to determine if a document is from a broad-sheeted book.
             #       if so, queue up k2pdfopt to try and chunk the content appropriately to letter size
 
             prints(("scheduling new {} document from book ID #{} for post-import DJVU"
                     " conversion: {}").format(book_format, book_id, path_to_ebook))
 
-        if fork_job:
+        # the same document converted by other job (GUI, postimport, CLI) is not converted again
+        flight = self.in_flight(db, book_id, path_to_ebook)
+        attached = flight.acquire(abort, prints)
+        if attached is not None:
+            if attached.djvu:
+                prints('book ID #{} was converted by concurrent job of process {}: {}'.format(
+                    book_id, attached.pid, attached.djvu))
+            return None
+        self.metrics_server(prints)
+        try:
+            # postimport of added books, GUI, CLI and refresh share the limit of conversions at once
+            with self.conversion_slot(pages, abort), \
+                    metrics.tracked('djvumaker_conversions_in_progress'):
+                self._convert_book(book_id, book_format, db, path_to_ebook, pages, images, prints,
+                                   log, fork_job, abort, notifications, results, encoding, flight)
+        except:
+            flight.release() # a waiting job converts the book itself
+            raise
+
+    def in_flight(self, db, book_id, path_to_ebook):
+        """InFlight lock of conversion of book's current document, shared by all processes."""
+        return InFlight(os.path.join(plugin_dir(PLUGINNAME), 'inflight'),
+                        inflight_key(db.new_api.library_id, book_id,
+                                     file_fingerprint(path_to_ebook)))
+
+    def _convert_book(self, book_id, book_format, db, path_to_ebook, pages, images, prints, log,
+                      fork_job, abort, notifications, results, encoding=None, flight=None):
+        """
+        Convert book's document on worker nodes, in fork_job or here, queue resulting DJVU.
+        `flight` is finished once the DJVU is in library, released if it cannot be added.
+        """
+        djvu = None
+        if self.distributed_enabled() and not os.path.isdir(path_to_ebook):
+            with span('distributed'):
+                djvu = self.run_distributed(path_to_ebook, prints, abort)
+        if djvu:
+            prints('converted on worker nodes')
+        elif fork_job:
             #useful for not blocking calibre GUI when large PDFs
             # are dropped into the automatic-import-folder
             try:
@@ -681,30 +1447,43 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
             # note that Calibre bungs the python loader to check the plugin directory when
             # modules with calibre_plugin. prefixed are passed
             # https://github.com/kovidgoyal/calibre/blob/master/src/calibre/customize/zipplugin.py#L192
-                func_name = self.plugin_prefs['use_backend']
+                if is_image_input(path_to_ebook):
+                    func_name = 'images_to_djvu'
+                else:
+                    func_name = self.plugin_prefs['use_backend']
                 args = [path_to_ebook, log, abort, notifications, pages, images]
-                jobret = worker_fork_job('calibre_plugins.{}'.format(PLUGINNAME), func_name,
-                            args= args,
-                            kwargs={'preferences' : self.plugin_prefs},
-                            env={'PATH': os.environ['PATH'] + ':/usr/local/bin'},
-                            # djvu and poppler-utils on osx
-                            timeout=600)
+                kwargs = {'preferences' : self.plugin_prefs, 'dpi' : self.target_dpi(path_to_ebook),
+                          'encoding' : encoding}
+                env = {'PATH': os.environ['PATH'] + ':/usr/local/bin'}
+                # djvu and poppler-utils on osx
+                env.update(trace_env()) # worker records its spans too
+                env.update(metrics.metrics_env()) # and counts its conversion
+                with span('fork_job', backend=func_name):
+                    jobret = worker_fork_job('calibre_plugins.{}'.format(PLUGINNAME), func_name,
+                                args= args,
+                                kwargs=kwargs,
+                                env=env,
+                                timeout=600)
                             # TODO: determine a resonable timeout= based on filesize or
                             # make a heartbeat= check
                             # TODO: doesn't work for pdf2djvu, why?
 
             except WorkerError as e:
                 prints('djvudigital background conversion failed: \n{}'.format(force_unicode(e.orig_tb)))
+                metrics.inc('djvumaker_failures_total', backend=func_name, reason='worker_error')
+                # worker killed on timeout leaves its backend's process tree and partial output
+                orphans = reap_orphans(running_registry())
+                if orphans:
+                    prints('terminated {} orphaned backend process groups'.format(orphans))
                 raise # ConversionError
             except:
                 prints(traceback.format_exc())
                 raise
 
         # dump djvudigital output logged in file by the Worker to
-        # calibre proc's (gui or console) log/stdout
-            with open(jobret['stdout_stderr'], 'rb') as f:
-                raw = f.read().strip()
-                prints(raw)
+        # calibre proc's (gui or console) log/stdout, line by line, only head and tail of it
+            with capture_log(prints, 'book-{}-worker'.format(book_id)) as capture:
+                capture.feed_file(jobret['stdout_stderr'])
 
             if jobret['result']:
                 djvu = jobret['result']
@@ -715,33 +1494,319 @@ class DJVUmaker(FileTypePlugin, InterfaceActionBase): # multiple inheritance for
         else: #!fork_job & !gui
             prints("Starts backend")
             djvu = self.run_backend(path_to_ebook, log, abort, notifications, pages,
-                                    images)
+                                    images, encoding=encoding)
 
         if djvu:
-            db.new_api.add_format(book_id, 'DJVU', djvu, run_hooks=True)
-            prints("added new 'DJVU' document to book ID #{}".format(book_id))
-            if sys.__stdin__.isatty():
-            # update calibre gui Out-Of-Band. Like if we were run as a command-line scripted import
-            # this resets current gui views/selections, no cleaner way to do it :-(
-                from calibre.utils.ipc import RC
-                t = RC(print_error=False)
-                t.start()
-                t.join(3)
-                if t.done: # GUI is running
-                    t.conn.send('refreshdb:')
-                    t.conn.close()
-                    prints("signalled Calibre GUI refresh")
+            self.check_output(djvu, pages if book_format == 'pdf' else
+                              document_page_count(path_to_ebook), prints)
+            def after():
+                try:
+                    if book_format == 'pdf':
+                        with span('save_page_record', profile=True):
+                            self.save_page_record(db, book_id, path_to_ebook, prints)
+                finally:
+                    if flight is not None: # waiting requests attach once the DJVU is in library
+                        flight.finish(djvu)
+            self.add_result(db, book_id, djvu, prints, results, after,
+                            flight.release if flight is not None else None)
+            return djvu
         else:
             # TODO: normal Exception propagation instead of passing errors as return values
             raise Exception(('ConversionError, djvu: {}. Did you install any backend according to the'
                              ' documentation?').format(djvu))
 
+    @contextmanager
+    def batched_results(self, db, prints):
+        """
+        Conversions finished inside this context are added to library in batches by
+        ResultCollector, GUI is refreshed once per batch.
+        """
+        on_batch = (lambda book_ids: signal_gui_refresh(prints)) if sys.__stdin__.isatty() else None
+        self._results = ResultCollector(db, prints, on_batch=on_batch)
+        try:
+            with self._results:
+                yield self._results
+        finally:
+            self._results = None
+
+    def add_result(self, db, book_id, djvu, prints, results=None, after=None, failed=None):
+        """
+        Add converted DJVU to book, through `results` or running bulk conversion's ResultCollector
+        if there is one. `after` is called once the document is in library, `failed` if batched
+        write couldn't add it (direct write raises).
+        """
+        results = results or self._results
+        if results is not None:
+            results.add(book_id, djvu, after=after, failed=failed)
+            prints("'DJVU' document of book ID #{} queued for batched library write".format(book_id))
+            return None
+        with span('add_format', profile=True):
+            db.new_api.add_format(book_id, 'DJVU', djvu, run_hooks=True)
+        prints("added new 'DJVU' document to book ID #{}".format(book_id))
+        if after is not None:
+            after()
+        if sys.__stdin__.isatty():
+            signal_gui_refresh(prints)
+        return None
+
+    def _page_record_path(self, db, book_id):
+        return os.path.join(plugin_dir(PLUGINNAME), 'pagemaps', db.new_api.library_id,
+                            '{}.json'.format(book_id))
+
+    def save_page_record(self, db, book_id, path_to_ebook, prints, keys=None):
+        """Store content keys of pages of converted PDF, refresh compares them with new PDF."""
+        try:
+            if keys is None:
+                keys = [page.key for page in scan_pages(path_to_ebook, stable=True)]
+        except PDFScanError as err:
+            prints("Cannot record pages of book ID #{}, its DJVU won't be refreshable: {}".format(
+                book_id, err))
+            return None
+        record_path = self._page_record_path(db, book_id)
+        if not os.path.isdir(os.path.dirname(record_path)):
+            os.makedirs(os.path.dirname(record_path))
+        with open(record_path, 'wb') as f:
+            json.dump({'source' : file_fingerprint(path_to_ebook), 'pages' : keys}, f)
+        return record_path
+
+    def load_page_record(self, db, book_id):
+        """Return page record saved by save_page_record or None."""
+        try:
+            with open(self._page_record_path(db, book_id), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def needs_refresh(self, db, book_id):
+        """Check whether PDF of book changed since its DJVU was converted by this plugin."""
+        record = self.load_page_record(db, book_id)
+        if record is None or not db.has_format(book_id, 'PDF', index_is_id=True):
+            return False
+        path_to_ebook = db.format_abspath(book_id, 'pdf', index_is_id=True)
+        return record['source'] != file_fingerprint(path_to_ebook)
+
+    def library_index(self, db):
+        """LibraryIndex of library `db`, shared by background indexer, conversions and CLI."""
+        library_id = db.new_api.library_id
+        if library_id not in self._indexes:
+            self._indexes[library_id] = LibraryIndex(
+                os.path.join(plugin_dir(PLUGINNAME), 'index', '{}.json'.format(library_id)),
+                document_profile)
+        return self._indexes[library_id]
+
+    def start_indexer(self, db, prints=None, tag_books=None):
+        """
+        Keep index of library `db` updated in background if turned on, stops indexer of other
+        library. New scans are tagged by `tag_books(tag, book_ids)`, GUI passes one running in
+        GUI thread, which refreshes the tagged books too.
+        """
+        if self._indexer is not None:
+            self._indexer.stop()
+            self._indexer = None
+        settings = self.plugin_prefs['index']
+        if not settings['background']:
+            return None
+        prints = prints or self.prints
+        tag_books = tag_books or partial(self.tag_scanned, db)
+        def on_update(updated):
+            book_ids = [book_id for book_id, profile in updated if profile.raster]
+            if settings['tag'] and book_ids:
+                tag_books(settings['tag'], book_ids)
+        self._indexer = Indexer(self.library_index(db),
+                                partial(library_formats, db, ('pdf',) + INPUT_TYPES),
+                                settings['interval'], on_update, log=prints)
+        self._indexer.start()
+        return self._indexer
+
+    def tag_scanned(self, db, tag, book_ids=None):
+        """Add `tag` to `book_ids` or to all books indexed as scans, return number of tagged books."""
+        api = db.new_api
+        if book_ids is None:
+            book_ids = [book_id for book_id, _, profile in self.library_index(db).entries().values()
+                        if profile is not None and profile.raster]
+        changes = {}
+        for book_id in set(book_ids):
+            tags = tuple(api.field_for('tags', book_id) or ())
+            if tag not in tags:
+                changes[book_id] = tags + (tag,)
+        if changes:
+            api.set_field('tags', changes)
+        return len(changes)
+
+    def distributed_enabled(self):
+        settings = self.plugin_prefs['distributed']
+        return bool(settings['nodes'] or settings['loopback'])
+
+    def worker_convert(self, path, pages, dpi, abort):
+        """Conversion of job received by worker node, see distributed.WorkerServer."""
+        return self.run_backend(path, self.prints.func, abort, dpi=dpi, page_selection=pages)
+
+    def coordinator(self, prints):
+        """Coordinator of configured worker nodes, loopback workers are started on first use."""
+        if getattr(self, '_coordinator', None) is not None:
+            self._coordinator.log = prints
+            return self._coordinator
+        settings = self.plugin_prefs['distributed']
+        nodes = [Node(*parse_node(text), token=settings['token']) for text in settings['nodes']]
+        if settings['loopback']:
+            # several workers on this host, for testing without other machines
+            servers = start_loopback(settings['loopback'], settings['loopback_capacity'],
+                                     self.worker_convert, self.backend_supports_pages(),
+                                     settings['token'], log=prints)
+            nodes += [Node(host, port, settings['loopback_capacity'], settings['token'])
+                      for host, port in (server.server_address for server in servers)]
+        self._coordinator = Coordinator(nodes, settings['retries'], settings['shard_pages'],
+                                        log=prints)
+        return self._coordinator
+
+    def run_distributed(self, path_to_ebook, prints, abort=None):
+        """Convert on worker nodes, return path to DJVU or None if it has to be converted here."""
+        page_count = None # unknown for PostScript, the book is sent whole
+        try:
+            if is_image_input(path_to_ebook):
+                page_count = image_page_count(path_to_ebook)
+            elif path_to_ebook.lower().endswith('.pdf'):
+                with PDFDocument(path_to_ebook) as doc:
+                    page_count = doc.page_count()
+        except (PDFScanError, EnvironmentError, ValueError) as err:
+            prints('Cannot read page count ({}), book is not split'.format(err))
+        try:
+            return self.coordinator(prints).convert(path_to_ebook, page_count,
+                                                    self.target_dpi(path_to_ebook), abort)
+        except DistributedError as err:
+            prints('Conversion on worker nodes failed ({}), converting locally'.format(err))
+            return None
+
+    def backend(self):
+        """Backend instance of currently used backend, declares its capabilities."""
+        backend, _ = self.site_customization_parser(self.plugin_prefs['use_backend'])
+        return self.REGISTERED_BACKENDS[backend].backend
+
+    def backend_supports_pages(self):
+        """Check whether currently used backend can convert only selected pages."""
+        return self.backend().page_ranges
+
+    def local_concurrency(self):
+        """Conversions to run at once on this machine, from backend's declared threads and memory."""
+        memory = physical_memory()
+        return self.backend().concurrency(cpu_count(), memory // 2 if memory else None)
+
+    def conversion_limit(self, prints, fixed=None):
+        """
+        ConcurrencyLimit of bulk conversions in this process, starting at local_concurrency and
+        adapted up to twice the cores (small books wait on disk), or `fixed` conversions at once.
+        """
+        limit = getattr(self, '_conversion_limit', None)
+        if limit is None or limit.fixed != fixed:
+            limit = ConcurrencyLimit(self.local_concurrency(), 2 * cpu_count(), fixed=fixed,
+                                     log=prints)
+            self._conversion_limit = limit
+            metrics.track('djvumaker_queue_depth', lambda: limit.waiting)
+        limit.log = prints
+        return limit
+
+    @contextmanager
+    def conversion_slot(self, pages=None, abort=None):
+        """
+        One conversion, waits while the adapted number of conversions run. Bulk conversion's
+        limit is used if there is one, its jobs already hold their slots. Worker nodes limit
+        conversions by their own capacity.
+        """
+        if self.distributed_enabled():
+            yield
+        else:
+            limit = getattr(self, '_conversion_limit', None) or self.conversion_limit(self.prints)
+            with limit.slot(pages, abort):
+                yield
+
+    def _refresh(self, book_id, db, prints, log, abort, notifications, results=None):
+        """
+        Update DJVU of book after its PDF was replaced. Only pages which content is not found
+        in the PDF converted before are encoded, the rest is copied from existing DJVU.
+        """
+        path_to_ebook = db.format_abspath(book_id, 'pdf', index_is_id=True)
+        # GUI refresh and `convert -i --refresh` of the same book don't both encode it
+        flight = self.in_flight(db, book_id, path_to_ebook)
+        attached = flight.acquire(abort, prints)
+        if attached is not None:
+            if attached.djvu:
+                prints('book ID #{} was refreshed by concurrent job of process {}: {}'.format(
+                    book_id, attached.pid, attached.djvu))
+            return None
+        try:
+            refreshed = self._refresh_pages(book_id, db, path_to_ebook, prints, log, abort,
+                                            notifications)
+            if refreshed is None:
+                flight.release()
+                return None
+            djvu, keys = refreshed
+            def after():
+                try:
+                    self.save_page_record(db, book_id, path_to_ebook, prints, keys)
+                finally:
+                    flight.finish(djvu)
+            self.add_result(db, book_id, djvu, prints, results, after, flight.release)
+        except:
+            flight.release() # a waiting job refreshes the book itself
+            raise
+        return None
+
+    def _refresh_pages(self, book_id, db, path_to_ebook, prints, log, abort, notifications):
+        """
+        Refreshed DJVU of book and content keys of its pages, None if its DJVU is up to date.
+        """
+        record = self.load_page_record(db, book_id)
+        if record is None:
+            prints(("no page record for book ID #{}, remove its 'DJVU' format to convert it"
+                    " again").format(book_id))
+            return None
+        if record['source'] == file_fingerprint(path_to_ebook):
+            prints("'DJVU' document of book ID #{} is up to date".format(book_id))
+            return None
+
+        keys = [page.key for page in scan_pages(path_to_ebook, stable=True)]
+        old_pages = {}
+        for index, key in enumerate(record['pages']):
+            old_pages.setdefault(key, index)
+        changed = [index for index, key in enumerate(keys) if key not in old_pages]
+        prints('{} of {} pages of book ID #{} changed since last conversion'.format(
+            len(changed), len(keys), book_id))
+
+        djvu = None
+        if self.backend_supports_pages():
+            new_djvu = None
+            try:
+                if changed:
+                    new_djvu = self.run_backend(path_to_ebook, log, abort, notifications,
+                                                len(keys), None, page_selection=changed)
+                if new_djvu or not changed:
+                    old_djvu = db.format_abspath(book_id, 'djvu', index_is_id=True)
+                    position = {page : index for index, page in enumerate(changed)}
+                    pages = [(new_djvu, position[index]) if index in position
+                             else (old_djvu, old_pages[key]) for index, key in enumerate(keys)]
+                    reserved = temporary_path('.djvu')
+                    try:
+                        djvu = assemble_pages(reserved, pages)
+                    except DjVuError as err:
+                        discard(reserved)
+                        prints('Cannot splice changed pages ({}), converting all pages...'.format(
+                            err))
+            finally:
+                if new_djvu:
+                    discard(new_djvu) # its pages are copied to the spliced DJVU
+        else:
+            prints('backend cannot convert selected pages, converting all pages...')
+        if not djvu:
+            djvu = self.run_backend(path_to_ebook, log, abort, notifications, len(keys), None)
+        if not djvu:
+            raise Exception('ConversionError, refresh of book ID #{} failed'.format(book_id))
+        self.check_output(djvu, len(keys), prints)
+        return djvu, keys
+
 def is_rasterbook(path, basic_return=True):
     """
     Identify whether this is a raster doc (ie. a scan) or a digitally authored text+graphic doc.
-    Skip conversion if source doc is not mostly raster-image based.
-    Ascertain this by checking whether there are as many image objects in the PDF
-    as there are pages +/- 5 (google books and other scanners add pure-text preambles to their pdfs)
+    Skip conversion if source doc is not mostly raster-image based, see document_profile.
 
     If basic_return is True:
         return:
@@ -750,13 +1815,36 @@ def is_rasterbook(path, basic_return=True):
         return:
             aforementioned bool value, number of pages, number of images
     """
-    def fun_basic_return(result, pages, images):
-        if basic_return:
-            return result
-        else:
-            return result, pages, images
+    profile = document_profile(path)
+    if basic_return:
+        return profile.raster
+    return profile.raster, profile.page_count, profile.images
+
+def document_profile(path):
+    """
+    Return pdfscan.DocumentProfile of PDF document or scanned images input.
+    Ascertain whether PDF is a scan by sampling a bounded number of pages spread over
+    the document and measuring how much of each page is covered by images and how much visible
+    text it draws, see pdfscan.profile_document. Verdict and its confidence are logged.
+    When pdfscan cannot read the document, fall back to checking whether there are as many image
+    objects in the PDF as there are pages +/- 5 (google books and other scanners add pure-text
+    preambles to their pdfs), confidence is None then.
+    """
+    printsd('enter document_profile: {}'.format(path))
+    if is_image_input(path):
+        pages = image_page_count(path)
+        encoding = os.path.splitext(path)[1].lstrip('.').lower() or 'images'
+        return DocumentProfile(True, 1.0, pages, pages, pages, pages, {encoding : pages}, None)
+    try:
+        profile = profile_document(path)
+    except (PDFScanError, EnvironmentError) as err:
+        prints('page sampling failed ({}), counting images with podofo'.format(err))
+    else:
+        prints('{}: {} of {} sampled pages (of {}) are scans, confidence {:.2f} > {}'.format(
+            'raster' if profile.raster else 'markup-based', profile.raster_pages, profile.sampled,
+            profile.page_count, profile.confidence, path))
+        return profile
 
-    printsd('enter is_rasterbook: {}'.format(path))
     podofo = get_podofo()
     pdf = podofo.PDFDoc()
     printsd('opens file')
@@ -770,8 +1858,6 @@ def is_rasterbook(path, basic_return=True):
         # It's probably a bug in calibre podofo image_count method:
         # https://github.com/kovidgoyal/calibre/blob/master/src/calibre/utils/podofo/doc.cpp#L146
         # or PDF file created with errors.
-        #
-        # This is not a big concern because raises mostly for heavy image PDFs
         images = pdf.image_count()
     except:
         import inspect
@@ -785,31 +1871,203 @@ def is_rasterbook(path, basic_return=True):
         if object.__str__(error_info[0]) != "<class 'podofo.Error'>":
             raise
         else:
-            # TODO: WARN or ASK user what to do, image count is unknown
-            return fun_basic_return(True, pages, None)
+            # neither pdfscan nor podofo can read the document, converting it would most
+            # probably fail as well, so don't guess
+            prints("cannot tell whether {} is a scan, not converting it".format(path))
+            return DocumentProfile(False, None, pages, 0, 0, None, {}, None)
     else:
         prints("pages(%s) : images(%s) > %s" % (pages, images, path))
-        if pages > 0:
-            return fun_basic_return(abs(pages - images) <= 5, pages, images)
-        return fun_basic_return(False, pages, images)
+        raster = pages > 0 and abs(pages - images) <= 5
+        return DocumentProfile(raster, None, pages, 0, 0, images, {}, None)
+
+def profile_resolution(profile):
+    """
+    Return device screen resolution (width, height) for profile name from DEVICE_PROFILES
+    or for custom profile in 'WIDTHxHEIGHT' form, i.e.: '600x800'.
+    """
+    if profile in DEVICE_PROFILES:
+        return DEVICE_PROFILES[profile]
+    try:
+        width, height = [int(x) for x in profile.lower().split('x')]
+    except ValueError:
+        raise ValueError('Device profile {} is not recognized, use one of: {} or WIDTHxHEIGHT.'.format(
+            profile, ', '.join(DEVICE_PROFILES)))
+    if width <= 0 or height <= 0:
+        raise ValueError('Device profile {} has not positive resolution.'.format(profile))
+    return width, height
+
+def document_page_count(path):
+    """Number of pages of document or image input, None if it cannot be read."""
+    if is_image_input(path):
+        return image_page_count(path)
+    try:
+        with PDFDocument(path) as doc:
+            return doc.page_count()
+    except (PDFScanError, EnvironmentError):
+        pass
+    try:
+        pdf = get_podofo().PDFDoc()
+        pdf.open(path)
+        return pdf.page_count()
+    except Exception:
+        return None # PostScript
+
+def page_size(path, samples=5):
+    """
+    Return size (width, height) in inches of the biggest of first `samples` pages of PDF document.
+    Return None if podofo doesn't expose page boxes or document has no pages.
+    """
+    podofo = get_podofo()
+    pdf = podofo.PDFDoc()
+    pdf.open(path)
+    sizes = []
+    try:
+        for pagenum in range(min(samples, pdf.page_count())):
+            # (left, bottom, width, height) in PostScript points
+            _, _, width, height = pdf.get_page_box('MediaBox', pagenum)
+            sizes.append((width / 72, height / 72))
+    except Exception as err:
+        # get_page_box is missing in older calibre versions and fails for broken page trees
+        printsd('page_size failed: {}'.format(err))
+    if not sizes:
+        return None
+    return max(sizes, key=lambda size: size[0] * size[1])
+
+def profile_dpi(path, resolution):
+    """
+    Compute rendering DPI at which pages of document under `path` fit to device screen
+    `resolution` (width, height). Return None if the page size cannot be read.
+    """
+    size = None
+    if os.path.splitext(path)[1].lower() == '.pdf':
+        size = page_size(path)
+    if size is None or size[0] <= 0 or size[1] <= 0:
+        prints('page size of {} is unknown, rendering at default DPI'.format(path))
+        return None
+    width, height = resolution
+    dpi = int(min(width / size[0], height / size[1]))
+    dpi = max(PROFILE_DPI_RANGE[0], min(PROFILE_DPI_RANGE[1], dpi))
+    prints('page size {:.2f}x{:.2f}in fitted to {}x{}px screen at {} DPI'.format(
+        size[0], size[1], width, height, dpi))
+    return dpi
+
+def plan_redundant_pages(backend, srcdoc, cmdflags, preferences, prints):
+    """
+    Find duplicate and blank pages of document before backend runs.
+    Return PagePlan if `backend` can encode only selected pages and there is something to skip,
+    otherwise None.
+    """
+    if not backend.page_ranges or preferences is None \
+            or not preferences['skip_redundant_pages']:
+        return None
+    if any(flag.split('=')[0] in ('-p', '--pages') for flag in cmdflags):
+        return None # user chose pages on his own
+    if os.path.splitext(srcdoc)[1].lower() != '.pdf':
+        return None
+    if not can_bundle():
+        printsd('neither bzz nor djvm found, redundant pages will be encoded')
+        return None
+    try:
+        plan = plan_distinct_pages(srcdoc, log=prints)
+    except PDFScanError as err:
+        prints('Cannot look for redundant pages: {}'.format(err))
+        return None
+    if not plan.redundant:
+        return None
+    return plan
+
+def signal_gui_refresh(prints):
+    """
+    Update calibre gui Out-Of-Band. Like if we were run as a command-line scripted import
+    this resets current gui views/selections, no cleaner way to do it :-(
+    """
+    from calibre.utils.ipc import RC
+    refresh_span = span('gui refresh')
+    t = RC(print_error=False)
+    t.start()
+    t.join(3)
+    if t.done: # GUI is running
+        t.conn.send('refreshdb:')
+        t.conn.close()
+        prints("signalled Calibre GUI refresh")
+    refresh_span.end(gui_running=t.done)
+
+def capture_log(prints, name):
+    """LogCapture forwarding head and tail of output to prints, full output in logs folder."""
+    return LogCapture(prints, log_file(os.path.join(plugin_dir(PLUGINNAME), 'logs'), name))
+
+_history = None
+
+def conversion_history():
+    """History of finished conversions in plugin's folder, shared by all processes."""
+    global _history
+    if _history is None:
+        _history = History(os.path.join(plugin_dir(PLUGINNAME), 'history.json'))
+    return _history
+
+def record_conversion(backend, srcdoc, djvu, pages, cpu, encoding, prints):
+    """Record finished conversion with dominant image `encoding` of source PDF in history."""
+    try:
+        conversion_history().record(backend.name, pages, cpu, os.path.getsize(srcdoc),
+                                    os.path.getsize(djvu), encoding)
+    except EnvironmentError as err:
+        prints('cannot record conversion history: {}'.format(err))
+
+def conversion_metrics(backend, srcdoc, djvu, pages, seconds, reason=None):
+    """Count finished conversion of `srcdoc` in metrics, failed one (no `djvu`) by `reason`."""
+    if not djvu:
+        metrics.inc('djvumaker_failures_total', backend=backend.name, reason=reason)
+        return
+    metrics.inc('djvumaker_conversions_total', backend=backend.name)
+    metrics.observe('djvumaker_conversion_seconds', seconds, backend=backend.name)
+    if pages:
+        metrics.inc('djvumaker_pages_converted_total', pages, backend=backend.name)
+    try:
+        metrics.inc('djvumaker_input_bytes_total', os.path.getsize(srcdoc), backend=backend.name)
+        metrics.inc('djvumaker_output_bytes_total', os.path.getsize(djvu), backend=backend.name)
+    except EnvironmentError:
+        pass
 
-def job_handler(fun):
-    """Decorator for backend functions."""
+def running_registry():
+    """Folder where conversions of all processes (calibre, fork_job workers, CLI) register."""
+    return os.path.join(plugin_dir(PLUGINNAME), 'running')
+
+def discard(path):
+    """Remove partial output of failed or aborted conversion."""
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+
+def job_handler(backend):
+    """Wrap Backend instance into conversion function handling its jobs."""
     #NODOC
-    @wraps(fun)
-    def wrapper(srcdoc, log=None, abort=None, notifications=None, pages=None,
-                images=None, cmdflags=None, *args, **kwargs):
-        """Wrap around every backend."""
+    registry = running_registry()
+
+    def handle(srcdoc, log=None, abort=None, notifications=None, pages=None,
+               images=None, cmdflags=None, dpi=None, page_selection=None, encoding=None, *args,
+               **kwargs):
+        """
+        Wrap around every backend. `encoding` is dominant image encoding of `srcdoc` from its
+        profile, recorded in conversion history.
+        """
         # TODO: better notifications
         if notifications is None:
             notifications = EmptyClass()
             notifications.put = lambda x : None
+        known_pages = pages
         pages = 1 if pages is None else pages
+        started = time.time()
         images = 1 if images is None else images # sometimes it can be None passed as arg, not default
         notifications.put((1/(pages+3),'Launching backend...'))
+        cpu_time = [0] # of the last run, measured or wall time times cores given to the backend
 
         if cmdflags is None:
             cmdflags = []
+        if dpi is not None:
+            # flags saved by user take precedence over device profile
+            if not flag_given(cmdflags, '-d', '--dpi'):
+                cmdflags = cmdflags + backend.dpi_flags(dpi)
 
         if 'CALIBRE_WORKER' in os.environ:
             # running as a fork_job, all process output piped to logfile, so don't buffer
@@ -843,38 +2101,90 @@ def job_handler(fun):
             # `pip sarge` makes streaming subprocesses easier than sbp.Popen
 
         bookname = os.path.splitext(os.path.basename(srcdoc))[0]
-        with PersistentTemporaryFile(bookname + '.djvu') as djvu: # note, PTF() is from calibre
+
+        def done(result, returncode=0):
+            """Count conversion in metrics, failed one by reason from backend's `returncode`."""
+            reason = None
+            if not result:
+                reason = ('backend_missing' if returncode is None else
+                          'aborted' if abort is not None and abort.is_set() else 'backend_error')
+            conversion_metrics(backend, srcdoc, result, known_pages, time.time() - started, reason)
+            return result
+
+        def run(cmdflags, djvu):
+            """Run backend command, return its return code or None if backend is not installed."""
+            scratch = None
             try:
                 env = os.environ
-                cmd = fun(srcdoc, cmdflags, djvu, *args, **kwargs)
+                # cores are shared by conversions running in this process,
+                # flags saved by user come last and take precedence
+                jobs = running_jobs(registry)
+                threads = backend.threads_per_job(cpu_count(), jobs)
+                memory = physical_memory()
+                # half of memory is shared by running conversions like in local_concurrency
+                tuning, tuned = backend.tuning_flags(srcdoc, cmdflags, threads,
+                                                     memory // 2 // max(1, jobs) if memory else None)
+                if tuned:
+                    prints('tuned {}'.format(tuned))
+                cmdflags = (backend.thread_flags(threads, cmdflags, kwargs.get('preferences'))
+                            + tuning + cmdflags)
+                with span('backend discovery', profile=True):
+                    cmd = backend.command(srcdoc, cmdflags, djvu, *args, **kwargs)
                 if isosx:
                     env['PATH'] = "/usr/local/bin:" + env['PATH'] # Homebrew
+                if backend.in_process:
+                    # backend converts in plugin's process instead of one command
+                    prints('pipeline: {}'.format(cmd))
+                    start, cpu_start = time.time(), process_cpu_time()
+                    with span('pipeline', threads=threads), \
+                            metrics.tracked('djvumaker_backend_processes', backend=backend.name):
+                        returncode = backend.runner(srcdoc, cmdflags, djvu, prints, notifications,
+                                                    abort)
+                    if cpu_start is None:
+                        cpu_time[0] = (time.time() - start) * threads
+                    else:
+                        # process' CPU time is shared by conversions running in it
+                        cpu_time[0] = ((process_cpu_time() - cpu_start)
+                                       / max(1, jobs, running_jobs()))
+                    return returncode
                 prints('subprocess: {}'.format(cmd))
-
-                proc = subprocess.Popen(cmd, env=env, bufsize=cmdbuf, stdout=subprocess.PIPE,
-                                        stderr=subprocess.STDOUT)
+                subprocess_span = span('subprocess', cmd=' '.join(cmd))
+                start = time.time()
+
+                # temporary files of the whole process tree go to a folder removed after the run
+                scratch = tempfile.mkdtemp(prefix='djvumaker-')
+                register_path(scratch)
+                # own process group, so abort terminates scripts together with their children
+                proc = popen_group(cmd, env=scratch_env(env, scratch), bufsize=cmdbuf,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                register_group(proc.pid)
+                metrics.add('djvumaker_backend_processes', 1, backend=backend.name)
+                if abort is not None: # aborts if msg from GUI is send, even if backend is silent
+                    watch_abort(proc, abort, lambda: prints(
+                        'aborted, terminating {} process tree'.format(backend.name)))
                 # stderr: csepdjvu, stdout: ghostscript & djvudigital
-                if cmdbuf > 0: #stream the output
-                    while proc.poll() is None:
-                        # TODO: piping print through backend util method, to add custom output handling
-                        #       + notifications about job progress
-                        readout = proc.stdout.readline()
-                        if force_unicode(readout).strip() != '':
-                            # TODO: better custom pringing
-                            if hasattr(fun, 'printing'):
-                                readout, progress, msg = fun.printing(readout, pages, images)
-                                if progress is not None:
-                                    notifications.put((progress, msg))
-                                prints(readout, force_unicode=False)
-                            else:
-                                prints(readout)
-                        if abort is not None and abort.is_set():
-                            proc.kill() # aborts if msg from GUI is send
-
-                    for line in proc.stdout.read().split('\n'):
-                        prints(line)
-                else:
-                    proc.communicate()
+                # output is streamed line by line, only its head and tail are printed
+                try:
+                    with capture_log(prints, '{}-{}'.format(backend.name, bookname)) as capture:
+                        for readout in iter(proc.stdout.readline, b''):
+                            # TODO: piping print through backend util method, to add custom output
+                            #       handling + notifications about job progress
+                            if force_unicode(readout).strip() != '':
+                                # TODO: better custom pringing
+                                if backend.progress:
+                                    readout, progress, msg = backend.printing(readout, pages,
+                                                                              images)
+                                    if progress is not None:
+                                        notifications.put((progress, msg))
+                                capture.line(readout)
+                        cpu = wait_cpu(proc)
+                finally:
+                    if proc.poll() is None: # output reading failed, don't leave the tree behind
+                        terminate_group(proc.pid, proc)
+                    metrics.add('djvumaker_backend_processes', -1, backend=backend.name)
+                subprocess_span.end(returncode=proc.returncode)
+                # wall time times threads where CPU time of the tree isn't known (Windows)
+                cpu_time[0] = (time.time() - start) * threads if cpu is None else cpu
                 # TODO: better notifications
                 notifications.put(((pages+2)/(pages+3), 'Cleaning...'))
                 prints('subprocess returned {}'.format(proc.returncode))
@@ -883,12 +2193,68 @@ def job_handler(fun):
                     prints(
                         ('$PATH[{}]\n/{} script not available to perform conversion:'
                          '{} must be installed').format(os.environ['PATH'], cmd[0],
-                                                        fun.__name__))
-                return False
-            if proc.returncode != 0:
-                return False # 10 djvudigital shell/usage error
-            return djvu.name
-    wrapper.__wrapped__ = fun # backporting python3 feature
+                                                        backend.name))
+                return None
+            finally:
+                if scratch is not None:
+                    shutil.rmtree(scratch, ignore_errors=True)
+            return proc.returncode
+
+        if page_selection is not None:
+            # caller wants only these pages, i.e. refresh of changed pages
+            if not backend.page_ranges:
+                prints('{} backend cannot convert selected pages'.format(backend.name))
+                return done(False)
+            cmdflags = cmdflags + backend.page_flags(page_selection)
+            plan = None
+        else:
+            with span('plan_redundant_pages', profile=True):
+                plan = plan_redundant_pages(backend, srcdoc, cmdflags, kwargs.get('preferences'),
+                                            prints)
+        with PersistentTemporaryFile(bookname + '.djvu') as djvu: # note, PTF() is from calibre
+            register_path(djvu.name) # removed if this process is killed before it returns
+            if plan is not None:
+                if plan.encode_pages:
+                    returncode = run(cmdflags + backend.page_flags(plan.encode_pages), djvu)
+                else:
+                    prints('all pages are blank, backend is not needed')
+                    returncode = 0
+                if returncode == 0:
+                    try:
+                        with span('expand_page_plan', profile=True):
+                            expand_page_plan(djvu.name, plan, prints)
+                        if known_pages:
+                            # CPU time of distinct pages, they stand for the whole book
+                            record_conversion(backend, srcdoc, djvu.name, known_pages,
+                                              cpu_time[0], encoding, prints)
+                        return done(djvu.name)
+                    except DjVuError as err:
+                        # the backend's output holds only distinct pages, nothing to fall back on
+                        prints('Cannot reuse encoded pages ({}), converting all pages...'.format(err))
+                else:
+                    # failed or aborted backend would fail on all pages as well
+                    discard(djvu.name)
+                    return done(False, returncode)
+            returncode = run(cmdflags, djvu)
+            if returncode != 0:
+                discard(djvu.name) # partial output of failed or aborted backend
+                return done(False, returncode) # 10 djvudigital shell/usage error
+            if known_pages and page_selection is None:
+                record_conversion(backend, srcdoc, djvu.name, known_pages, cpu_time[0], encoding,
+                                  prints)
+            return done(djvu.name)
+
+    @traced('backend ' + backend.name)
+    def wrapper(*args, **kwargs):
+        try:
+            with running_job(registry):
+                return handle(*args, **kwargs)
+        finally:
+            metrics.flush() # fork_job worker exits right after its conversion
+    wrapper.__name__ = str(backend.name)
+    wrapper.__doc__ = backend.__doc__
+    wrapper.__wrapped__ = backend.command # backporting python3 feature
+    wrapper.backend = backend
     return wrapper
 
 # -- DJVU conversion utilities wrapper functions -- see
@@ -906,46 +2272,168 @@ def raise_if_not_supported(srcdoc, supported_extensions):
             ', '.join(['.' + item for item in supported_extensions]), '.'+file_ext))
 
 
-# TODO: class implementation of backend
-def pdf2djvu_custom_printing(readout, pages, images):
-    """Get output from backend, clean it, and return with progress info."""
-    readout = force_unicode(readout)
-    readout = 'pdf2djvu: ' + readout.strip()
-    splitted = readout.split('#')
-    if len(splitted) == 3:
-        page = int(splitted[2])
-        # TODO: better notifications
-        return readout, (page+1)/(pages+3), 'Converting....'
-    return readout, None, None
-
-@DJVUmaker.register_backend
-@job_handler
-@add_method_dec(pdf2djvu_custom_printing, 'printing') # TODO: class implementation of backend
-def pdf2djvu(srcdoc, cmdflags, djvu, preferences):
+class Pdf2djvu(Backend):
     """pdf2djvu backend shell command generation"""
-    raise_if_not_supported(srcdoc, ['pdf'])
-    pdf2djvu_path, _, _, _ = discover_backend('pdf2djvu', preferences, plugin_dir(PLUGINNAME))
-    if pdf2djvu_path is None:
-        raise OSError('pdf2djvu not found')
-    if djvu is None:
-        djvu = EmptyClass()
-        djvu.name, _ = os.path.splitext(srcdoc)
-        djvu.name += '.djvu'
-    # DEBUG COMMENT:
-    # return [pdf2djvu_path, '-v', '-o', djvu.name, srcdoc] # verbose
-    return [pdf2djvu_path] + cmdflags + ['-o', djvu.name, srcdoc]
-
-@DJVUmaker.register_backend
-@job_handler
-def djvudigital(srcdoc, cmdflags, djvu, preferences):
+    name = 'pdf2djvu'
+    page_ranges = True
+    progress = True
+    threads = 0
+    shares_cores = True
+    memory = 300
+    _jobs_option = {} # pdf2djvu path -> whether it was built with OpenMP
+
+    def thread_flags(self, threads, cmdflags, preferences=None):
+        """--jobs unless set by user or pdf2djvu was built without OpenMP."""
+        if flag_given(cmdflags, '-j', '--jobs'):
+            return []
+        pdf2djvu_path, _, _, _ = discover_backend('pdf2djvu', preferences, plugin_dir(PLUGINNAME))
+        if pdf2djvu_path is None or not self.has_jobs_option(pdf2djvu_path):
+            return []
+        return ['--jobs={}'.format(threads)]
+
+    def has_jobs_option(self, pdf2djvu_path):
+        """pdf2djvu built without OpenMP has no -j/--jobs option."""
+        if pdf2djvu_path not in self._jobs_option:
+            try:
+                output = subprocess.check_output([pdf2djvu_path, '--help'], stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as err:
+                output = err.output
+            except OSError:
+                output = b''
+            self._jobs_option[pdf2djvu_path] = b'--jobs' in output
+        return self._jobs_option[pdf2djvu_path]
+
+    def command(self, srcdoc, cmdflags, djvu, preferences):
+        raise_if_not_supported(srcdoc, self.input_types)
+        pdf2djvu_path, _, _, _ = discover_backend('pdf2djvu', preferences, plugin_dir(PLUGINNAME))
+        if pdf2djvu_path is None:
+            raise OSError('pdf2djvu not found')
+        if djvu is None:
+            djvu = EmptyClass()
+            djvu.name, _ = os.path.splitext(srcdoc)
+            djvu.name += '.djvu'
+        # DEBUG COMMENT:
+        # return [pdf2djvu_path, '-v', '-o', djvu.name, srcdoc] # verbose
+        return [pdf2djvu_path] + cmdflags + ['-o', djvu.name, srcdoc]
+
+    def page_flags(self, pages):
+        """Return pdf2djvu cmd flags converting only 0-based `pages`, in document order."""
+        return ['--pages={}'.format(page_ranges(pages))]
+
+    def printing(self, readout, pages, images):
+        """Get output from backend, clean it, and return with progress info."""
+        readout = force_unicode(readout)
+        readout = 'pdf2djvu: ' + readout.strip()
+        splitted = readout.split('#')
+        if len(splitted) == 3:
+            page = int(splitted[2])
+            # TODO: better notifications
+            return readout, (page+1)/(pages+3), 'Converting....'
+        return readout, None, None
+
+class Djvudigital(Backend):
     """djvudigital backend shell command generation"""
-    raise_if_not_supported(srcdoc, ['pdf', 'ps'])
+    name = 'djvudigital'
+    input_types = ('pdf', 'ps')
+    threads = 0
+    shares_cores = True
+    memory = 400
+    cpu_cost = 1.5
+    default_dpi = 300
+
+    def tuning_flags(self, srcdoc, cmdflags, threads, memory):
+        """
+        Ghostscript rendering threads, band buffer and bitmap size from size of the biggest page,
+        DPI, `threads` and `memory`, passed through `--gsarg`. Parameters set in `cmdflags` are kept.
+        """
+        dpi = self.default_dpi
+        for flag in cmdflags:
+            if flag.startswith('--dpi='):
+                dpi = int(flag.split('=', 1)[1])
+        size = None
+        if srcdoc.lower().endswith('.pdf'):
+            try:
+                size = page_size(srcdoc)
+            except Exception as err:
+                printsd('page size of {} is unknown: {}'.format(srcdoc, err))
+        tuning = gs_tuning(size, dpi, threads, memory)
+        user_flags = ' '.join(cmdflags)
+        flags = ['--gsarg={}'.format(define) for define in tuning.defines()
+                 if define.split('=')[0] + '=' not in user_flags]
+        return flags, 'ghostscript at {} DPI: {}'.format(dpi, tuning)
+
+    def command(self, srcdoc, cmdflags, djvu, preferences):
+        raise_if_not_supported(srcdoc, self.input_types)
 
-    # DEBUG UNCOMMENT
-    return ['djvudigital'] + cmdflags + [srcdoc, djvu.name] # command passed to subprocess
+        # DEBUG UNCOMMENT
+        return ['djvudigital'] + cmdflags + [srcdoc, djvu.name] # command passed to subprocess
 
-    #DEBUG COMMENT
-    # return ['XCOPY', r"C:\tools\bin\test.djvu", str(djvu.name)+'*', r'/Y'] # command passed to subprocess
+        #DEBUG COMMENT
+        # return ['XCOPY', r"C:\tools\bin\test.djvu", str(djvu.name)+'*', r'/Y'] # command passed to subprocess
+
+class Djvulibre(InProcessBackend):
+    """
+    djvulibre backend, ghostscript rasterizers streaming pages to DjVuLibre encoders (pipeline.py).
+    """
+    name = 'djvulibre'
+    input_types = ('pdf', 'ps', 'eps')
+    page_ranges = True
+    threads = 0
+    memory = 512
+    cpu_cost = 1.2
+
+    def command(self, srcdoc, cmdflags, djvu, preferences):
+        """Returns command of the first stage, flags are checked here so wrong ones fail early."""
+        raise_if_not_supported(srcdoc, self.input_types)
+        options = parse_flags(cmdflags)
+        return gs_command(srcdoc, options.dpi or DEFAULT_DPI, gs=find_ghostscript() or 'gs')
+
+    def page_flags(self, pages):
+        """Return djvulibre backend flags converting only 0-based `pages`."""
+        return ['--pages={}'.format(page_ranges(pages))]
+
+    def thread_flags(self, threads, cmdflags, preferences=None):
+        if flag_given(cmdflags, '--encoders'):
+            return []
+        return ['--encoders={}'.format(threads)]
+
+    def runner(self, srcdoc, cmdflags, djvu, prints, notifications, abort):
+        """Run djvulibre backend pipeline, return 0 on success like backend's shell command."""
+        missing = [tool for tool in ('cjb2', 'c44') if find_executable(tool) is None]
+        if not can_bundle():
+            missing.append('bzz')
+        if find_ghostscript() is None:
+            missing.insert(0, 'gs')
+        if missing:
+            prints('{} not available to perform conversion: DjVuLibre and Ghostscript must be'
+                   ' installed'.format(', '.join(missing)))
+            return None
+        page_count = None # PostScript is rendered by one ghostscript process to its end
+        if srcdoc.lower().endswith('.pdf'):
+            try:
+                with PDFDocument(srcdoc) as doc:
+                    page_count = doc.page_count()
+            except (PDFScanError, EnvironmentError) as err:
+                prints('Cannot read page count ({}), rendering with one process'.format(err))
+
+        def progress(encoded):
+            # TODO: better notifications
+            notifications.put(((encoded + 1) / ((page_count or encoded) + 3), 'Converting....'))
+        try:
+            count = rasterize_to_djvu(srcdoc, djvu.name, cmdflags, page_count, abort, progress)
+        except PipelineError as err:
+            for line in '{}'.format(err).splitlines():
+                prints('Error: {}'.format(line))
+            return 1
+        if count is None:
+            prints('conversion aborted')
+            return 1
+        prints('pipeline encoded {} pages'.format(count))
+        return 0
+
+pdf2djvu = DJVUmaker.register_backend(job_handler(Pdf2djvu()))
+djvudigital = DJVUmaker.register_backend(job_handler(Djvudigital()))
+djvulibre = DJVUmaker.register_backend(job_handler(Djvulibre()))
 
 def c44(srcdoc, cmdflags=[], log=None):
     # part of djvulibre, converts jpegs to djvu
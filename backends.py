@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+backends module for Calibre plugin djvumaker - declarative description of conversion backends
+
+Backend subclasses declare what the plugin's scheduling needs to know about a conversion tool:
+whether it converts page ranges (refresh, redundant pages, page shards on worker nodes), reports
+per page progress, may run in parallel, how many cores one conversion keeps busy and how much
+memory and CPU time it needs. Concurrency limits and thread allocation are computed from these
+declarations instead of backend names. Backends themselves are defined in __init__.py.
+Subclasses must implement command(), in-process backends derive from InProcessBackend and
+implement runner() too.
+
+References:
+(#NODOC)
+Backend                   -- abstract base class, subclasses set capability attributes and implement
+                             command()
+  .name                   -- backend name used in settings, CLI and fork_job
+  .input_types            -- supported file extensions
+  .page_ranges            -- page_flags() converts only selected pages
+  .progress               -- printing() reports progress parsed from command output
+  .parallel               -- several conversions may run at once on one machine
+  .threads                -- cores one conversion keeps busy, 0 means it uses all of them
+  .shares_cores           -- with threads 0, conversions run at once as if single-threaded and
+                             split the cores between them instead of running one by one
+  .memory                 -- MB one conversion needs
+  .cpu_cost               -- CPU time per page relative to pdf2djvu at 300 DPI
+  .in_process             -- converts in plugin's process instead of running command()
+  .command(srcdoc, cmdflags, djvu, preferences) -- shell command of conversion
+  .dpi_flags(dpi)         -- flags setting rendering resolution
+  .page_flags(pages)      -- flags converting only 0-based pages
+  .printing(readout, pages, images) -- cleaned output line, progress and message
+  .thread_flags(threads, cmdflags, preferences=None) -- flags limiting threads of one conversion,
+                             [] if not supported or set by user in `cmdflags`
+  .tuning_flags(srcdoc, cmdflags, threads, memory) -- flags tuned for document and resources,
+                             with description of chosen values
+  .concurrency(cpus, memory=None) -- conversions to run at once
+  .threads_per_job(cpus, jobs)    -- threads given to each of `jobs` concurrent conversions
+  .capabilities()         -- short description of declared capabilities
+flag_given(cmdflags, *options) -- whether one of `options` is set in `cmdflags`
+InProcessBackend(Backend) -- abstract base class of backends converting in plugin's process
+  .runner(srcdoc, cmdflags, djvu, prints, notifications, abort) -- convert, reporting progress to
+                             `notifications` itself, return 0 on success like a command
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import abc
+
+def flag_given(cmdflags, *options):
+    """Whether `cmdflags` set one of `options`, i.e. '-j', '--jobs', alone or with its value."""
+    for flag in cmdflags:
+        for option in options:
+            if flag == option or flag.startswith(option + '='):
+                return True
+            if not option.startswith('--') and flag.startswith(option): # -j4
+                return True
+    return False
+
+class Backend(object):
+    """Conversion backend, see module docstring for declared capabilities."""
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    input_types = ('pdf',)
+    page_ranges = False
+    progress = False
+    parallel = True
+    threads = 1
+    shares_cores = False
+    memory = 256
+    cpu_cost = 1.0
+    in_process = False
+
+    @abc.abstractmethod
+    def command(self, srcdoc, cmdflags, djvu, preferences):
+        """Shell command converting `srcdoc` with `cmdflags` to file `djvu`."""
+
+    def dpi_flags(self, dpi):
+        return ['--dpi={}'.format(dpi)]
+
+    def page_flags(self, pages):
+        """Flags converting only 0-based `pages`, backends declaring page_ranges override it."""
+        raise ValueError('{} backend cannot convert selected pages'.format(self.name))
+
+    def printing(self, readout, pages, images):
+        return readout, None, None
+
+    def thread_flags(self, threads, cmdflags, preferences=None):
+        """
+        Flags running one conversion on `threads` cores, none if the user set threads in
+        `cmdflags`. They are computed once when the conversion starts.
+        """
+        return []
+
+    def tuning_flags(self, srcdoc, cmdflags, threads, memory):
+        """
+        Flags tuned for `srcdoc` converted on `threads` cores with `memory` MB (None if unknown),
+        and their description for job log. Flags given in `cmdflags` must not be overridden.
+        """
+        return [], None
+
+    def concurrency(self, cpus, memory=None):
+        """Number of conversions to run at once on `cpus` cores with `memory` MB free."""
+        if not self.parallel:
+            return 1
+        if self.threads:
+            jobs = cpus // self.threads
+        else:
+            jobs = cpus if self.shares_cores else 1
+        if memory is not None:
+            jobs = min(jobs, memory // self.memory)
+        return max(1, jobs)
+
+    def threads_per_job(self, cpus, jobs):
+        """Threads for each of `jobs` conversions running at once on `cpus` cores."""
+        if self.threads:
+            return self.threads
+        return max(1, cpus // max(1, jobs))
+
+    def capabilities(self):
+        features = [name for name, declared in (('page ranges', self.page_ranges),
+                                                ('progress', self.progress),
+                                                ('parallel', self.parallel),
+                                                ('in-process', self.in_process)) if declared]
+        return '{}; threads per job: {}, memory: {} MB, CPU cost: {}'.format(
+            ', '.join(features) or 'no optional features', self.threads or 'all cores',
+            self.memory, self.cpu_cost)
+
+class InProcessBackend(Backend):
+    """
+    Backend converting in plugin's process, command() only checks flags and describes the
+    conversion for job log. Threads are passed to runner() by thread_flags().
+    """
+    in_process = True
+
+    @abc.abstractmethod
+    def runner(self, srcdoc, cmdflags, djvu, prints, notifications, abort):
+        """
+        Convert `srcdoc` to file `djvu`, put progress to `notifications`, stop once `abort` is
+        set. Return 0 on success, other code on failure or None if tools are missing.
+        """
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+batch module for Calibre plugin djvumaker - bulk conversion of files outside calibre library
+
+`convert --batch SOURCE` converts every document of a directory tree, of a file listing paths
+(one per line) or of paths read from stdin (`-`), without questions. Outputs keep the layout of
+sources relative to the tree (or to the common folder of listed paths) in the output folder, or
+are written next to their sources. Every output is copied next to its destination and renamed
+into place, so there is never a half-written DJVU. Outputs newer than their sources are skipped.
+The run ends with a JSON summary of all files.
+
+References:
+(#NODOC)
+STATUSES                  -- status of every file in the summary
+FileResult(source, output, status, seconds, error) -- outcome of one file
+batch_sources(source, extensions, stdin=None) -- (path, relative path) of documents to convert
+output_path(source, relative, output=None) -- path of DJVU of `source`
+up_to_date(source, output) -- whether existing output is newer than source
+publish(djvu, output)     -- atomically put converted DJVU to `output`
+summary(results)          -- dict with counts of statuses and results of all files
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import os
+import shutil
+import sys
+import threading
+
+STATUSES = ('converted', 'up-to-date', 'skipped', 'failed')
+
+FileResult = collections.namedtuple('FileResult', ['source', 'output', 'status', 'seconds',
+                                                   'error'])
+
+def _decode(path):
+    if isinstance(path, bytes):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+def _listed(stream):
+    for line in stream:
+        path = _decode(line).strip()
+        if path and not path.startswith('#'):
+            yield os.path.abspath(path)
+
+def batch_sources(source, extensions, stdin=None):
+    """
+    Return list of (path, relative path) of documents with `extensions` in directory tree
+    `source`, listed in file `source` or in `stdin` if `source` is '-'. Listed paths are relative
+    to their common folder.
+    """
+    extensions = tuple('.' + ext.lower() for ext in extensions)
+    if source != '-' and os.path.isdir(source):
+        source = os.path.abspath(source)
+        found = []
+        for folder, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    path = os.path.join(folder, name)
+                    found.append((path, os.path.relpath(path, source)))
+        return found
+    if source == '-':
+        paths = list(_listed(stdin or sys.stdin))
+    else:
+        with open(source, 'rb') as f:
+            paths = list(_listed(f))
+    if not paths:
+        return []
+    base = os.path.dirname(os.path.commonprefix(paths)) if len(paths) > 1 \
+        else os.path.dirname(paths[0])
+    return [(path, os.path.relpath(path, base)) for path in paths]
+
+def output_path(source, relative, output=None):
+    name = os.path.splitext(relative if output else source)[0] + '.djvu'
+    return os.path.join(output, name) if output else name
+
+def up_to_date(source, output):
+    try:
+        return os.path.getmtime(output) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+def publish(djvu, output):
+    """Copy converted `djvu` next to `output` and rename it into place."""
+    folder = os.path.dirname(output)
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder): # made by other conversion meanwhile
+                raise
+    # threads of one run may publish the same output (i.e. a.pdf and a.ps), mkstemp would make
+    # the DJVU readable only by its owner
+    temp = '{}.{}-{}.part'.format(output, os.getpid(), threading.current_thread().ident)
+    try:
+        shutil.copyfile(djvu, temp)
+        if os.name == 'nt' and os.path.exists(output):
+            os.remove(output) # rename doesn't replace files on Windows
+        os.rename(temp, output)
+    except EnvironmentError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+def summary(results):
+    counts = collections.Counter(result.status for result in results)
+    data = dict((status, counts.get(status, 0)) for status in STATUSES)
+    data['files'] = [result._asdict() for result in results]
+    return data
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bulk module for Calibre plugin djvumaker - throughput-adaptive concurrency of bulk conversions
+
+No fixed number of books converted at once suits a whole library: small books are I/O-bound
+and want many conversions at once, big ones are memory-bound and want few. ConcurrencyLimit
+hands out slots to conversions and adapts their number additive-increase/multiplicative-decrease
+style: every epoch (once `limit` conversions finished) it compares aggregate pages per second
+with the previous epoch, adds one slot while throughput holds and conversions are waiting, and
+halves the slots when throughput falls or memory runs out (low available memory or swapping,
+read from /proc on Linux). Running conversions are never stopped, new ones wait for a slot.
+
+References:
+(#NODOC)
+LOW_MEMORY                -- fraction of physical memory which must stay available
+SWAP_PAGES                -- pages swapped in or out between two checks which mean swapping
+CHECK_INTERVAL            -- seconds between memory checks
+MIN_EPOCH                 -- shortest epoch in seconds, throughput of shorter ones is noise
+TOLERANCE                 -- relative drop of throughput not taken as congestion
+DECREASE                  -- factor of multiplicative decrease
+MemoryMonitor()           -- memory pressure on Linux
+  .pressure()             -- reason of memory pressure, None if there is none or it's unknown
+ConcurrencyLimit(start, maximum, minimum=1, fixed=None, log=None, monitor=None)
+  .slot(pages=None, abort=None) -- context of one conversion of `pages`, waits for free slot,
+                             nested slot of the same thread doesn't wait
+  .run(job, pages=None)   -- call `job` in a slot
+  .limit                  -- number of conversions allowed to run at once
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import threading
+import time
+from contextlib import contextmanager
+
+LOW_MEMORY = 0.1
+SWAP_PAGES = 256
+CHECK_INTERVAL = 5
+MIN_EPOCH = 10
+TOLERANCE = 0.1
+DECREASE = 0.5
+
+def _read_fields(path):
+    fields = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            parts = line.replace(b':', b' ').split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].decode('ascii')] = int(parts[1])
+    return fields
+
+class MemoryMonitor(object):
+    """Memory pressure from /proc/meminfo and /proc/vmstat, never reported on other systems."""
+
+    def __init__(self):
+        self.swapped = None
+
+    def pressure(self):
+        try:
+            meminfo = _read_fields('/proc/meminfo')
+            vmstat = _read_fields('/proc/vmstat')
+        except EnvironmentError:
+            return None
+        swapped = vmstat.get('pswpin', 0) + vmstat.get('pswpout', 0)
+        previous, self.swapped = self.swapped, swapped
+        if previous is not None and swapped - previous >= SWAP_PAGES:
+            return 'swapping ({} pages)'.format(swapped - previous)
+        total, available = meminfo.get('MemTotal'), meminfo.get('MemAvailable')
+        if total and available is not None and available < total * LOW_MEMORY:
+            return 'only {} MB of memory available'.format(available // 1024)
+        return None
+
+class ConcurrencyLimit(object):
+    """
+    Slots of conversions running at once, starting with `start` and adapted between `minimum`
+    and `maximum`, or `fixed` number of them. `log` gets changes of the limit. Thread-safe.
+    """
+
+    def __init__(self, start, maximum, minimum=1, fixed=None, log=None, monitor=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, fixed or maximum)
+        self.fixed = fixed
+        self.limit = fixed or max(self.minimum, min(self.maximum, start))
+        self.log = log
+        self.monitor = monitor or MemoryMonitor()
+        self.cond = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.held = threading.local() # depth of slots held by thread
+        self.known_pages = [0, 0] # pages and books with known page count, for unknown ones
+        self.last_rate = None
+        self.last_check = time.time()
+        self._new_epoch()
+
+    def _new_epoch(self, rate=None):
+        self.epoch_start = time.time()
+        self.epoch_pages = 0.0
+        self.epoch_books = 0
+        self.epoch_waited = self.waiting > 0
+        if rate is not None:
+            self.last_rate = rate
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit and self.log is not None:
+            self.log('concurrency {} -> {}: {}'.format(self.limit, limit, reason))
+        self.limit = limit
+        self.cond.notify_all()
+
+    def _adjust(self):
+        """Check memory and close epoch if it's over, called with the lock held."""
+        if self.fixed:
+            return
+        now = time.time()
+        if now - self.last_check >= CHECK_INTERVAL:
+            self.last_check = now
+            reason = self.monitor.pressure()
+            if reason is not None:
+                if self.limit > self.minimum:
+                    self._set_limit(int(self.limit * DECREASE), reason)
+                self._new_epoch() # throughput of congested epoch doesn't count
+                self.last_rate = None
+                return
+        elapsed = now - self.epoch_start
+        if self.epoch_books < self.limit or elapsed < MIN_EPOCH:
+            return
+        rate = self.epoch_pages / elapsed
+        if self.last_rate is not None and rate < self.last_rate * (1 - TOLERANCE):
+            self._set_limit(int(self.limit * DECREASE),
+                            'throughput fell from {:.2f} to {:.2f} pages/s'.format(self.last_rate,
+                                                                                   rate))
+        elif self.epoch_waited and self.limit < self.maximum:
+            self._set_limit(self.limit + 1, 'throughput {:.2f} pages/s'.format(rate))
+        self._new_epoch(rate)
+
+    def _finished(self, pages):
+        if pages:
+            self.known_pages[0] += pages
+            self.known_pages[1] += 1
+        else: # counted as average book
+            pages = self.known_pages[0] / self.known_pages[1] if self.known_pages[1] else 1
+        self.epoch_pages += pages
+        self.epoch_books += 1
+
+    @contextmanager
+    def slot(self, pages=None, abort=None):
+        """
+        Run conversion of `pages` inside, waits while `limit` conversions run. Set `abort` ends
+        waiting, the conversion then finds out by itself. Slot taken by thread already holding
+        one (job of run() dispatching the conversion in a slot too) is the same slot.
+        """
+        if getattr(self.held, 'depth', 0):
+            self.held.depth += 1
+            try:
+                yield
+            finally:
+                self.held.depth -= 1
+            return
+        with self.cond:
+            self.waiting += 1
+            self.epoch_waited = True
+            while self.running >= self.limit and not (abort is not None and abort.is_set()):
+                self.cond.wait(1)
+                self._adjust()
+            self.waiting -= 1
+            self.running += 1
+        self.held.depth = 1
+        try:
+            yield
+        finally:
+            self.held.depth = 0
+            with self.cond:
+                self.running -= 1
+                self._finished(pages)
+                self._adjust()
+                self.cond.notify_all()
+
+    def run(self, job, pages=None):
+        with self.slot(pages):
+            return job()
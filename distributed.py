@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+distributed module for Calibre plugin djvumaker - conversion on worker nodes in local network
+
+Worker node is calibre with this plugin running `calibre-debug -r djvumaker -- worker`, it converts
+documents with its own backend settings. Coordinator sends whole books, or page shards of one book,
+to worker nodes, never more jobs to a node than its capacity, and assembles returned DJVU shards.
+Jobs of lost nodes are retried on the others, a lost node is asked for hello again (up to retries
+times per conversion) and takes jobs once it answers. Aborted conversion cancels jobs running on
+nodes, their backends are terminated.
+
+The transport is plain TCP, not encrypted: documents and the shared token travel in clear text,
+the token only keeps other machines from using a worker. Workers listen on 127.0.0.1 unless
+told otherwise, and refuse other addresses without a token (see check_bind).
+
+Protocol, one job per TCP connection; every message is JSON header prefixed by its length (4 bytes,
+big endian), some are followed by `size` bytes of raw data:
+    -> {'op': 'hello', 'token': ...}
+    <- {'ok': true, 'version': 1, 'capacity': 2, 'pages': true}
+    -> {'op': 'convert', 'token': ..., 'name': 'book.pdf', 'sha1': ..., 'size': N,
+        'pages': [0, 1, ...] or null, 'dpi': 300 or null}
+    <- {'send': true} -> N bytes of source  (or {'send': false} if worker has it cached)
+    <- {'status': 'working'}                 (every HEARTBEAT seconds, also while the job waits
+                                              for a free slot, lost node detection)
+    -> {'op': 'cancel'}                      (any time after the source, job is dropped; closed
+                                              connection cancels it too)
+    <- {'ok': true, 'size': M} + M bytes of DJVU  or  {'ok': false, 'error': '...'}
+
+References:
+(#NODOC)
+DistributedError(Exception), NodeLost(DistributedError)
+send_message(sock, header)       -- send length prefixed JSON header
+recv_message(sock)               -- receive length prefixed JSON header
+is_loopback(host)                -- whether `host` resolves to loopback addresses only
+check_bind(host, token)          -- refuse to listen on network without token
+WorkerServer(address, convert, capacity, supports_pages, token, log)
+  .serve_forever()
+start_loopback(count, capacity, convert, supports_pages, token, log) -- workers on 127.0.0.1
+parse_node(text)                 -- 'host:port[/capacity]' to (host, port, capacity)
+Node(host, port, capacity, token)
+  .hello(), .convert(srcdoc, digest, pages, dpi, dest, abort=None)
+Coordinator(nodes, retries, shard_pages, log)
+  .capacity()                    -- number of jobs which nodes run at once
+  .convert(srcdoc, page_count, dpi, abort) -- convert book on nodes, return path to DJVU
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import hashlib
+import hmac
+import json
+import os
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import SocketServer
+
+from calibre_plugins.djvumaker.djvu import DjVuError, assemble_pages
+from calibre_plugins.djvumaker.utils import page_ranges, temporary_path
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 8765
+HEARTBEAT = 10 # seconds between 'working' messages of worker
+SLOT_POLL = 0.5 # seconds between checks for free slot of waiting job and for cancel
+PROBE_DELAY = HEARTBEAT # seconds before lost node is asked for hello again
+CONNECT_TIMEOUT = 10
+COPY_BUFSIZE = 1 << 20
+MAX_HEADER = 1 << 20
+CACHED_SOURCES = 8 # per worker
+
+class DistributedError(Exception):
+    """Job cannot be converted on worker nodes."""
+    pass
+
+class NodeLost(DistributedError):
+    """Worker node didn't respond, its job can be retried on other node."""
+    pass
+
+# -- protocol --
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(min(COPY_BUFSIZE, size - len(data)))
+        if not chunk:
+            raise NodeLost('Connection closed')
+        data += chunk
+    return data
+
+def send_message(sock, header):
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack(b'>I', len(data)) + data)
+
+def recv_message(sock):
+    size = struct.unpack(b'>I', _recv_exact(sock, 4))[0]
+    if size > MAX_HEADER:
+        raise DistributedError('Message header too big')
+    try:
+        return json.loads(_recv_exact(sock, size).decode('utf-8'))
+    except ValueError:
+        raise DistributedError('Malformed message header')
+
+def _send_file(sock, path):
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(COPY_BUFSIZE)
+            if not buf:
+                return
+            sock.sendall(buf)
+
+def _recv_file(sock, size, dest):
+    """Receive `size` bytes to file `dest`, return their sha1 digest."""
+    digest = hashlib.sha1()
+    with open(dest, 'wb') as out:
+        while size > 0:
+            chunk = sock.recv(min(COPY_BUFSIZE, size))
+            if not chunk:
+                raise NodeLost('Connection closed')
+            digest.update(chunk)
+            out.write(chunk)
+            size -= len(chunk)
+    return digest.hexdigest()
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+# -- worker node --
+def is_loopback(host):
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.error:
+        return False
+    return bool(addresses) and all(address[4][0].startswith('127.') or address[4][0] == '::1'
+                                   for address in addresses)
+
+def check_bind(host, token):
+    """Raise DistributedError if worker would accept jobs from network without token."""
+    if not token and not is_loopback(host):
+        raise DistributedError(('Worker on {} would accept jobs from anyone in the network, set'
+                                ' --token (sent unencrypted) or listen on 127.0.0.1').format(
+                                    host or 'all interfaces'))
+
+class WorkerHandler(SocketServer.BaseRequestHandler):
+    """Handles one connection, i.e. one job of coordinator."""
+
+    def handle(self):
+        server = self.server
+        try:
+            header = recv_message(self.request)
+            if server.token and not hmac.compare_digest(
+                    (header.get('token') or '').encode('utf-8'), server.token.encode('utf-8')):
+                send_message(self.request, {'ok' : False, 'error' : 'Wrong token'})
+            elif header.get('op') == 'hello':
+                send_message(self.request, {'ok' : True, 'version' : PROTOCOL_VERSION,
+                                            'capacity' : server.capacity,
+                                            'pages' : server.supports_pages})
+            elif header.get('op') == 'convert':
+                self.convert(header)
+            else:
+                send_message(self.request, {'ok' : False, 'error' : 'Unknown operation'})
+        except (socket.error, DistributedError) as err:
+            server.log('job from {} lost: {}'.format(self.client_address[0], err))
+
+    def convert(self, header):
+        server = self.server
+        source = server.cached_source(header['sha1'])
+        if source is None:
+            send_message(self.request, {'send' : True})
+            source = server.receive_source(self.request, header)
+        else:
+            send_message(self.request, {'send' : False})
+
+        pages = header.get('pages')
+        server.log('converting {} (pages: {}) for {}'.format(
+            header.get('name'), page_ranges(pages) if pages else 'all', self.client_address[0]))
+        result = {}
+        cancel = threading.Event() # aborts backend of the job
+        def run():
+            try:
+                result['djvu'] = server.convert(source, pages, header.get('dpi'), cancel)
+            except Exception as err:
+                result['error'] = '{}'.format(err)
+        def beat():
+            """Tell coordinator the job is alive, unless it cancelled it or went away."""
+            if cancel.is_set():
+                return
+            if select.select([self.request], [], [], 0)[0]:
+                try:
+                    message = recv_message(self.request)
+                except (socket.error, DistributedError):
+                    message = None # connection closed
+                if message is None or message.get('op') == 'cancel':
+                    cancel.set()
+                    return
+            try:
+                send_message(self.request, {'status' : 'working'})
+            except socket.error:
+                cancel.set()
+        # never more conversions than capacity, coordinator hears from a waiting job too
+        beaten = time.time()
+        while not server.slots.acquire(False):
+            time.sleep(SLOT_POLL)
+            if time.time() - beaten >= HEARTBEAT:
+                beat()
+                beaten = time.time()
+            if cancel.is_set():
+                server.log('job from {} cancelled'.format(self.client_address[0]))
+                return
+        try:
+            job = threading.Thread(target=run, name='djvumaker-worker-job')
+            job.daemon = True
+            job.start()
+            # slot is held until cancelled backend is gone
+            while job.is_alive():
+                job.join(SLOT_POLL)
+                if job.is_alive() and time.time() - beaten >= HEARTBEAT:
+                    beat()
+                    beaten = time.time()
+        finally:
+            server.slots.release()
+
+        djvu = result.get('djvu')
+        if cancel.is_set():
+            server.log('job from {} cancelled'.format(self.client_address[0]))
+            if djvu:
+                os.remove(djvu)
+            return
+        if not djvu:
+            send_message(self.request, {'ok' : False,
+                                        'error' : result.get('error', 'Conversion failed')})
+            return
+        try:
+            send_message(self.request, {'ok' : True, 'size' : os.path.getsize(djvu)})
+            _send_file(self.request, djvu)
+        finally:
+            os.remove(djvu)
+
+class WorkerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Worker node server. `convert(path, pages, dpi, abort)` converts document (only 0-based `pages`
+    if not None, stopped once `abort` Event is set), returns path to DJVU, which is removed after
+    sending, or False. Received sources are kept in temporary folder, so shards of one book are
+    uploaded only once.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, convert, capacity=1, supports_pages=False, token=None, log=None):
+        check_bind(address[0], token)
+        SocketServer.TCPServer.__init__(self, address, WorkerHandler)
+        self.convert = convert
+        self.capacity = capacity
+        self.supports_pages = supports_pages
+        self.token = token
+        self.log = log or (lambda msg: None)
+        self.slots = threading.BoundedSemaphore(capacity)
+        self.cachedir = tempfile.mkdtemp(prefix='djvumaker_worker_')
+        self.cache = collections.OrderedDict() # sha1 -> path, in least recently used order
+        self.cache_lock = threading.Lock()
+
+    def cached_source(self, digest):
+        with self.cache_lock:
+            path = self.cache.pop(digest, None)
+            if path is not None:
+                self.cache[digest] = path
+            return path
+
+    def receive_source(self, sock, header):
+        """Receive source of job, check it and add it to cache."""
+        # backends choose conversion by file extension
+        ext = os.path.splitext(header.get('name') or '')[1].lower()
+        fd, tmp = tempfile.mkstemp(suffix=ext, dir=self.cachedir)
+        os.close(fd)
+        try:
+            digest = _recv_file(sock, header['size'], tmp)
+        except:
+            os.remove(tmp)
+            raise
+        if digest != header['sha1']:
+            os.remove(tmp)
+            raise DistributedError('Source damaged during transfer')
+        path = os.path.join(self.cachedir, digest + ext)
+        os.rename(tmp, path) # same content if other connection received it meanwhile
+        with self.cache_lock:
+            self.cache[digest] = path
+            while len(self.cache) > CACHED_SOURCES:
+                _, old = self.cache.popitem(last=False)
+                if os.path.exists(old):
+                    os.remove(old)
+        return path
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+def start_loopback(count, capacity, convert, supports_pages=False, token=None, log=None):
+    """Start `count` worker servers on random ports of 127.0.0.1, serving in daemon threads."""
+    servers = []
+    for number in range(count):
+        server = WorkerServer(('127.0.0.1', 0), convert, capacity, supports_pages, token, log)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='djvumaker-loopback-{}'.format(number))
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    return servers
+
+
+# -- coordinator --
+def parse_node(text):
+    """Parse node address 'host:port[/capacity]', capacity None means asking the node."""
+    address, _, capacity = text.partition('/')
+    host, separator, port = address.rpartition(':')
+    if not separator:
+        host, port = address, DEFAULT_PORT
+    try:
+        return host, int(port), int(capacity) if capacity else None
+    except ValueError:
+        raise DistributedError('Wrong node address {}, use HOST:PORT/CAPACITY'.format(text))
+
+class Node(object):
+    """Worker node as seen by coordinator."""
+
+    def __init__(self, host, port=DEFAULT_PORT, capacity=None, token=None):
+        self.host, self.port = host, port
+        self.capacity = capacity
+        self.token = token
+        self.pages = False
+        self.alive = True
+
+    def __str__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        except socket.error as err:
+            raise NodeLost('Node {} unreachable: {}'.format(self, err))
+        sock.settimeout(3 * HEARTBEAT)
+        return sock
+
+    def hello(self):
+        """Ask node for its capacity and features, raises NodeLost if it doesn't respond."""
+        sock = self._connect()
+        try:
+            send_message(sock, {'op' : 'hello', 'token' : self.token})
+            reply = recv_message(sock)
+        except (socket.error, NodeLost) as err:
+            raise NodeLost('Node {} lost: {}'.format(self, err))
+        finally:
+            sock.close()
+        if not reply.get('ok'):
+            raise DistributedError('Node {} refused: {}'.format(self, reply.get('error')))
+        self.capacity = self.capacity or reply['capacity']
+        self.pages = reply.get('pages', False)
+        return reply
+
+    def _reply(self, sock, abort):
+        """Next message of node, job is cancelled and DistributedError raised once `abort` is set."""
+        deadline = time.time() + sock.gettimeout()
+        while abort is not None:
+            if abort.is_set():
+                try:
+                    send_message(sock, {'op' : 'cancel'})
+                except socket.error:
+                    pass # closed connection cancels the job too
+                raise DistributedError('Job on node {} cancelled'.format(self))
+            if select.select([sock], [], [], SLOT_POLL)[0]:
+                break
+            if time.time() > deadline:
+                raise NodeLost('timed out')
+        return recv_message(sock)
+
+    def convert(self, srcdoc, digest, pages, dpi, dest, abort=None):
+        """
+        Convert `srcdoc` on node to `dest`, raises NodeLost if connection failed. Set `abort`
+        cancels the job on node.
+        """
+        sock = self._connect()
+        try:
+            send_message(sock, {'op' : 'convert', 'token' : self.token,
+                                'name' : os.path.basename(srcdoc), 'sha1' : digest,
+                                'size' : os.path.getsize(srcdoc), 'pages' : pages, 'dpi' : dpi})
+            if recv_message(sock).get('send'):
+                _send_file(sock, srcdoc)
+            reply = self._reply(sock, abort)
+            while reply.get('status') == 'working':
+                reply = self._reply(sock, abort)
+            if not reply.get('ok'):
+                raise DistributedError('Node {} failed: {}'.format(self, reply.get('error')))
+            _recv_file(sock, reply['size'], dest)
+        except (socket.error, NodeLost) as err:
+            raise NodeLost('Node {} lost: {}'.format(self, err))
+        finally:
+            sock.close()
+        return dest
+
+class Coordinator(object):
+    """
+    Dispatches books and their page shards to worker nodes.
+
+    Arguments:
+        nodes       -- list of Node
+        retries     -- how many times job of lost node is tried on other nodes
+        shard_pages -- minimal number of pages of one shard, shorter books are not split
+        log         -- function printing messages
+    """
+
+    def __init__(self, nodes, retries=2, shard_pages=50, log=None):
+        self.nodes = nodes
+        self.retries = retries
+        self.shard_pages = shard_pages
+        self.log = log or (lambda msg: None)
+        self.lock = threading.Condition()
+        self.running = collections.Counter() # jobs of node, shared by concurrent conversions
+
+    def available_nodes(self):
+        nodes = []
+        for node in self.nodes:
+            try:
+                node.hello()
+                node.alive = True
+                nodes.append(node)
+            except DistributedError as err:
+                self.log('{}'.format(err))
+        return nodes
+
+    def capacity(self):
+        """Number of jobs which available nodes run at once, at least 1."""
+        return max(1, sum(node.capacity for node in self.available_nodes()))
+
+    def shards(self, nodes, page_count):
+        """Page shards of book, [None] for converting the whole book by one node."""
+        slots = sum(node.capacity for node in nodes if node.pages)
+        if not page_count or slots < 2 or page_count < 2 * self.shard_pages:
+            return [None]
+        size = max(self.shard_pages, -(-page_count // slots))
+        return [range(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+    def convert(self, srcdoc, page_count=None, dpi=None, abort=None):
+        """
+        Convert `srcdoc` on worker nodes, return path to DJVU.
+        Raises DistributedError if some shard couldn't be converted on any node.
+        """
+        nodes = self.available_nodes()
+        if not nodes:
+            raise DistributedError('No worker node available')
+        shards = self.shards(nodes, page_count)
+        if shards != [None]:
+            nodes = [node for node in nodes if node.pages]
+        self.log('converting {} in {} shard(s) on {} node(s)'.format(srcdoc, len(shards), len(nodes)))
+        digest = file_digest(srcdoc)
+        results = self._dispatch(nodes, srcdoc, digest, shards, dpi, abort)
+        if len(shards) == 1:
+            return results[0]
+        try:
+            djvu = temporary_path('.djvu') # removed by caller once added to library
+            assemble_pages(djvu, [(results[index], page)
+                                  for index, shard in enumerate(shards)
+                                  for page in range(len(shard))])
+            return djvu
+        except DjVuError as err:
+            raise DistributedError('Cannot assemble shards: {}'.format(err))
+        finally:
+            for path in results.values():
+                os.remove(path)
+
+    def _dispatch(self, nodes, srcdoc, digest, shards, dpi, abort):
+        """Run shards on nodes, at most node.capacity at once. Return {shard_index: djvu_path}."""
+        pending = collections.deque((index, shard, 0) for index, shard in enumerate(shards))
+        results, failures = {}, []
+        gone = set() # lost nodes which didn't answer hello
+
+        def finished():
+            return failures or len(results) == len(shards) or (abort is not None and abort.is_set())
+
+        probes = collections.Counter() # hellos of lost node in this conversion
+
+        def probe(node):
+            """Ask lost node for hello after PROBE_DELAY, False once it was asked retries times."""
+            if probes[node] >= self.retries:
+                return False
+            probes[node] += 1
+            deadline = time.time() + PROBE_DELAY
+            with self.lock:
+                while pending and not finished() and time.time() < deadline:
+                    self.lock.wait(1)
+                if not pending or finished():
+                    return False
+            try:
+                node.hello()
+            except DistributedError as err:
+                self.log('{}'.format(err))
+                return True
+            with self.lock:
+                node.alive = True
+                self.lock.notify_all()
+            self.log('Node {} is back'.format(node))
+            return True
+
+        def slot(node, number):
+            while True:
+                with self.lock:
+                    while not pending and not finished():
+                        self.lock.wait(1)
+                    if not pending or finished():
+                        return
+                    if not node.alive:
+                        if node in gone:
+                            return
+                        if number:
+                            self.lock.wait(1) # first thread of node asks it for hello
+                            continue
+                    elif self.running[node] >= node.capacity:
+                        self.lock.wait(1) # node is busy with other book
+                        continue
+                    else:
+                        self.running[node] += 1
+                        index, shard, attempt = pending.popleft()
+                if not node.alive:
+                    if not probe(node):
+                        with self.lock:
+                            gone.add(node)
+                            self.lock.notify_all()
+                        return
+                    continue
+                dest = temporary_path('.djvu') # removed after assembling shards
+                try:
+                    node.convert(srcdoc, digest, shard, dpi, dest, abort)
+                    with self.lock:
+                        results[index] = dest
+                except NodeLost as err:
+                    os.remove(dest)
+                    self.log('{}'.format(err))
+                    with self.lock:
+                        node.alive = False
+                        if attempt < self.retries:
+                            pending.append((index, shard, attempt + 1))
+                        else:
+                            failures.append('{}'.format(err))
+                except (DistributedError, EnvironmentError) as err:
+                    os.remove(dest)
+                    with self.lock:
+                        failures.append('{}'.format(err))
+                finally:
+                    with self.lock:
+                        self.running[node] -= 1
+                        self.lock.notify_all()
+
+        threads = [threading.Thread(target=slot, args=(node, number),
+                                    name='djvumaker-node-{}-{}'.format(node, number))
+                   for node in nodes for number in range(node.capacity)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(results) < len(shards):
+            for path in results.values():
+                os.remove(path)
+            if abort is not None and abort.is_set():
+                raise DistributedError('Conversion aborted')
+            raise DistributedError('; '.join(failures) or 'All worker nodes lost')
+        return results
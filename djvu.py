@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+djvu module for Calibre plugin djvumaker - reading and assembling DjVu (IFF85) documents
+
+DjVu files are IFF85 containers: 'AT&T' magic followed by FORM:DJVU (single page)
+or FORM:DJVM (bundled document) chunk. Bundled documents start with DIRM chunk, which holds
+uncompressed offsets of components (FORM:DJVU pages and FORM:DJVI shared files) followed by
+BZZ compressed component names. Only chunk headers and offsets are read here, pages are copied
+between files as opaque byte ranges. Documents are bundled here too: the plugin writes DIRM
+directory and copies components from memory mapped sources, only the directory (a few bytes per
+page) is compressed by DjVuLibre's `bzz`, so merging thousands of pages costs one pass over them.
+
+References:
+(#NODOC)
+DjVuError(Exception)
+iter_chunks(f, start, end)                 -- (chunk_id, data_offset, data_size) of IFF chunks
+Component(path, offset, size, kind, id)    -- FORM chunk of page or shared component in a file
+document_components(path, ids=True)        -- Components of document, without thumbnails
+page_components(path)                      -- (offset, size) of every page component
+validate_document(path, pages=None)        -- DjVuSummary(pages, components, size) of well-formed
+                                              document, DjVuError otherwise
+page_info(f, offset)                       -- (width, height, dpi) from page INFO chunk
+has_includes(f, offset, size)              -- whether page references shared components
+write_component(f, offset, size, dest)     -- write page component as standalone DjVu file
+write_blank_page(dest, width, height, dpi) -- write empty page without any image layer
+write_bundle(dest, components, indirect=False) -- write bundled or indirect document of Components
+bundle_pages(dest, page_files, indirect=False) -- merge DjVu files, with `djvm -c` if bzz is missing
+can_bundle()                               -- whether bundling tools are available
+BlankPage(width, height, dpi)
+assemble_pages(dest, pages)                -- bundle pages taken from other documents
+document_dpi(path)                         -- resolution of the first page
+expand_page_plan(path, plan, log)          -- rebuild full document from distinct pages encoding
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+
+MAGIC = b'AT&T'
+DEFAULT_DPI = 300 # pdf2djvu and djvudigital render at 300 DPI if not told otherwise
+COPY_BUFSIZE = 1 << 20
+DIRM_VERSION = 1
+# component types and flags of DIRM directory
+KIND_INCLUDE, KIND_PAGE, KIND_THUMBNAILS, KIND_SHARED_ANNO = 0, 1, 2, 3
+KIND_MASK, HAS_NAME, HAS_TITLE = 0x3f, 0x80, 0x40
+
+class DjVuError(Exception):
+    """DjVu document is malformed or cannot be assembled."""
+    pass
+
+def iter_chunks(f, start, end):
+    """Yield (chunk_id, data_offset, data_size) of IFF chunks between `start` and `end` offsets."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            raise DjVuError('Truncated chunk header at offset {}'.format(pos))
+        chunk_id, size = header[:4], struct.unpack(b'>I', header[4:])[0]
+        if pos + 8 + size > end:
+            raise DjVuError('Chunk {!r} at offset {} exceeds its container'.format(chunk_id, pos))
+        yield chunk_id, pos + 8, size
+        pos += 8 + size + (size & 1) # chunks are padded to even offsets
+
+def _read_form(f, offset):
+    """Return (form_type, size) of FORM chunk at offset."""
+    f.seek(offset)
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b'FORM':
+        raise DjVuError('No FORM chunk at offset {}'.format(offset))
+    return header[8:12], struct.unpack(b'>I', header[4:8])[0]
+
+Component = collections.namedtuple('Component', ['path', 'offset', 'size', 'kind', 'id'])
+
+def _read_dirm(f, path, end):
+    """Return (offsets, encoded directory) of DIRM chunk of bundled document."""
+    for chunk_id, offset, chunk_size in iter_chunks(f, 16, end):
+        if chunk_id == b'DIRM':
+            f.seek(offset)
+            flags, count = struct.unpack(b'>BH', f.read(3))
+            if not flags & 0x80:
+                raise DjVuError('{} is an indirect document'.format(path))
+            offsets = struct.unpack(b'>{}I'.format(count), f.read(4 * count))
+            return offsets, f.read(chunk_size - 3 - 4 * count)
+    raise DjVuError('Missing DIRM chunk in {}'.format(path))
+
+def _parse_directory(data, count):
+    """Return (flags, ids) of `count` components from decoded DIRM directory."""
+    if len(data) < 4 * count:
+        raise DjVuError('Truncated DIRM directory')
+    flags = bytearray(data[3 * count:4 * count])
+    strings = data[4 * count:].split(b'\0')
+    ids, pos = [], 0
+    for flag in flags:
+        if pos >= len(strings):
+            raise DjVuError('Truncated DIRM directory')
+        ids.append(strings[pos])
+        pos += 1 + bool(flag & HAS_NAME) + bool(flag & HAS_TITLE)
+    return [flag & KIND_MASK for flag in flags], ids
+
+def document_components(path, ids=True):
+    """
+    Return list of Components of DjVu file in document order, thumbnails are left out.
+    IDs of shared components (pages refer to them in INCL chunks) are read from BZZ compressed
+    directory with `ids`, pages have no ID.
+    """
+    with open(path, 'rb') as f:
+        if f.read(4) != MAGIC:
+            raise DjVuError('{} is not a DjVu file'.format(path))
+        file_size = os.fstat(f.fileno()).st_size
+        form_type, size = _read_form(f, 4)
+        if form_type == b'DJVU':
+            return [Component(path, 4, size + 8, KIND_PAGE, None)]
+        if form_type == b'DJVI':
+            # shared component of indirect document, pages refer to it by file name
+            name = os.path.basename(path)
+            return [Component(path, 4, size + 8, KIND_INCLUDE,
+                              name.encode('utf-8') if not isinstance(name, bytes) else name)]
+        if form_type != b'DJVM':
+            raise DjVuError('Unknown DjVu document type {!r}'.format(form_type))
+        offsets, directory = _read_dirm(f, path, min(file_size, 12 + size))
+        forms = [(offset,) + _read_form(f, offset) for offset in offsets]
+    kinds, names = None, [None] * len(forms)
+    if ids and any(form_type == b'DJVI' for _, form_type, _ in forms):
+        kinds, names = _parse_directory(_bzz(directory, decode=True), len(forms))
+    components = []
+    for index, (offset, form_type, size) in enumerate(forms):
+        if form_type == b'DJVU':
+            components.append(Component(path, offset, size + 8, KIND_PAGE, None))
+        elif form_type == b'DJVI':
+            kind = kinds[index] if kinds is not None else KIND_INCLUDE
+            components.append(Component(path, offset, size + 8, kind, names[index]))
+    return components
+
+def page_components(path):
+    """Return list of (offset, size) of page components (FORM:DJVU chunks) in document order."""
+    return [(component.offset, component.size) for component in document_components(path, False)
+            if component.kind == KIND_PAGE]
+
+DjVuSummary = collections.namedtuple('DjVuSummary', ['pages', 'components', 'size'])
+
+def _check_page(f, offset, size):
+    """Check that page component starts with INFO chunk and its chunks fit into it."""
+    chunks = iter_chunks(f, offset + 12, offset + size)
+    first = next(chunks, None)
+    if first is None or first[0] != b'INFO' or first[2] < 4:
+        raise DjVuError('Page at offset {} does not start with INFO chunk'.format(offset))
+    f.seek(first[1])
+    width, height = struct.unpack(b'>HH', f.read(4))
+    if not width or not height:
+        raise DjVuError('Page at offset {} has zero size'.format(offset))
+    for _ in chunks:
+        pass
+
+def _check_bundle(f, start, end):
+    """Check DIRM directory of bundled document against its components, return page count."""
+    offsets, forms = None, []
+    for chunk_id, offset, size in iter_chunks(f, start, end):
+        if offsets is None:
+            if chunk_id != b'DIRM':
+                raise DjVuError('Bundled document does not start with DIRM chunk')
+            if size < 3:
+                raise DjVuError('DIRM chunk is too short')
+            f.seek(offset)
+            flags, count = struct.unpack(b'>BH', f.read(3))
+            if not flags & 0x80:
+                raise DjVuError('Indirect document, its pages are in other files')
+            if size < 3 + 4 * count:
+                raise DjVuError('DIRM chunk is too short for {} components'.format(count))
+            offsets = list(struct.unpack(b'>{}I'.format(count), f.read(4 * count)))
+        elif chunk_id == b'FORM':
+            forms.append((offset - 8, size + 8))
+    if offsets is None:
+        raise DjVuError('Missing DIRM chunk')
+    if len(offsets) != len(forms):
+        raise DjVuError('Directory lists {} components, document has {}'.format(
+            len(offsets), len(forms)))
+    if offsets != [offset for offset, _ in forms]:
+        raise DjVuError('Directory offsets do not match components of document')
+    pages = 0
+    for offset, size in forms:
+        form_type, _ = _read_form(f, offset)
+        if form_type == b'DJVU':
+            _check_page(f, offset, size)
+            pages += 1
+        elif form_type in (b'DJVI', b'THUM'):
+            for _ in iter_chunks(f, offset + 12, offset + size):
+                pass
+        else:
+            raise DjVuError('Unknown component type {!r} at offset {}'.format(form_type, offset))
+    return pages, len(forms)
+
+def validate_document(path, pages=None):
+    """
+    Check structure of DjVu document without reading its image data: IFF85 header, size of
+    every chunk against its container and the file, directory of bundled document against its
+    components, INFO chunk of every page and the page count if `pages` is given.
+    Raise DjVuError on the first problem, return DjVuSummary.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if f.read(4) != MAGIC:
+            raise DjVuError('{} is not a DjVu file'.format(path))
+        form_type, size = _read_form(f, 4)
+        end = 12 + size
+        if end > file_size:
+            raise DjVuError('{} is truncated, it has {} of {} bytes'.format(path, file_size, end))
+        if file_size - end > 1: # one byte of padding is allowed
+            raise DjVuError('{} has {} bytes after end of document'.format(path, file_size - end))
+        if form_type == b'DJVU':
+            _check_page(f, 4, end - 4)
+            count, components = 1, 1
+        elif form_type == b'DJVM':
+            count, components = _check_bundle(f, 16, end)
+        else:
+            raise DjVuError('Unknown DjVu document type {!r}'.format(form_type))
+    if pages is not None and count != pages:
+        raise DjVuError('{} has {} pages, {} expected'.format(path, count, pages))
+    return DjVuSummary(count, components, file_size)
+
+def page_info(f, offset):
+    """Return (width, height, dpi) of page component at `offset`."""
+    _, size = _read_form(f, offset)
+    for chunk_id, data_offset, chunk_size in iter_chunks(f, offset + 12, offset + 8 + size):
+        if chunk_id == b'INFO':
+            f.seek(data_offset)
+            data = f.read(min(chunk_size, 10))
+            width, height = struct.unpack(b'>HH', data[:4])
+            dpi = struct.unpack(b'<H', data[6:8])[0] if len(data) >= 8 else DEFAULT_DPI
+            return width, height, dpi
+    raise DjVuError('Page at offset {} has no INFO chunk'.format(offset))
+
+def has_includes(f, offset, size):
+    """Check whether page component uses INCL chunks, i.e. shared shape dictionaries."""
+    return any(chunk_id == b'INCL' for chunk_id, _, _ in iter_chunks(f, offset + 12, offset + size))
+
+def _copy_range(src, dst, offset, length):
+    src.seek(offset)
+    while length > 0:
+        buf = src.read(min(COPY_BUFSIZE, length))
+        if not buf:
+            raise DjVuError('Unexpected end of file')
+        dst.write(buf)
+        length -= len(buf)
+
+def write_component(f, offset, size, dest):
+    """Write page component from opened DjVu file as standalone single page document."""
+    with open(dest, 'wb') as out:
+        out.write(MAGIC)
+        _copy_range(f, out, offset, size)
+    return dest
+
+def write_blank_page(dest, width, height, dpi=DEFAULT_DPI):
+    """Write page which has only INFO chunk, DjVu viewers display it as white page."""
+    info = struct.pack(b'>HHBB', width, height, 26, 0) + struct.pack(b'<HBB', dpi, 22, 1)
+    chunk = b'INFO' + struct.pack(b'>I', len(info)) + info
+    with open(dest, 'wb') as out:
+        out.write(MAGIC + b'FORM' + struct.pack(b'>I', 4 + len(chunk)) + b'DJVU' + chunk)
+    return dest
+
+def can_bundle():
+    return find_executable('bzz') is not None or find_executable('djvm') is not None
+
+def _replace(src, dst):
+    if os.path.exists(dst) and os.name == 'nt':
+        os.remove(dst) # os.rename doesn't overwrite on Windows
+    os.rename(src, dst)
+
+def _bzz(data, decode=False):
+    """Compress or decompress with DjVuLibre's bzz, only DIRM directories go through it."""
+    try:
+        proc = subprocess.Popen(['bzz', '-d' if decode else '-e', '-', '-'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = proc.communicate(data)
+    except OSError as err:
+        raise DjVuError('bzz failed: {}'.format(err))
+    if proc.returncode != 0:
+        raise DjVuError('bzz failed: {}'.format(error.strip() or proc.returncode))
+    return output
+
+class _Sources(object):
+    """Source files of components, memory mapped, only the most recently used ones stay open."""
+
+    def __init__(self, limit=16):
+        self.limit = limit
+        self.opened = collections.OrderedDict()
+
+    def copy(self, component, out):
+        """Write component to `out` from mapped source, without reading it into Python strings."""
+        source = self.opened.pop(component.path, None)
+        if source is None:
+            if len(self.opened) >= self.limit:
+                self._close(*self.opened.popitem(last=False)[1])
+            f = open(component.path, 'rb')
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                mapped = None # i.e. address space of 32-bit process, file is read in chunks
+            source = (f, mapped)
+        self.opened[component.path] = source
+        f, mapped = source
+        end = component.offset + component.size
+        if mapped is None:
+            _copy_range(f, out, component.offset, component.size)
+        elif end > len(mapped):
+            raise DjVuError('Unexpected end of file {}'.format(component.path))
+        else:
+            for start in range(component.offset, end, COPY_BUFSIZE):
+                out.write(buffer(mapped, start, min(COPY_BUFSIZE, end - start)))
+
+    @staticmethod
+    def _close(f, mapped):
+        if mapped is not None:
+            mapped.close()
+        f.close()
+
+    def close(self):
+        while self.opened:
+            self._close(*self.opened.popitem()[1])
+
+def _same_content(first, second):
+    if first.size != second.size:
+        return False
+    with open(first.path, 'rb') as a, open(second.path, 'rb') as b:
+        a.seek(first.offset)
+        b.seek(second.offset)
+        return a.read(first.size) == b.read(second.size) # shared components are small
+
+def write_bundle(dest, components, indirect=False):
+    """
+    Write DjVu document `dest` of Components. Bundled document gets DIRM directory followed
+    by components copied from their sources, indirect document is index file `dest` with
+    every component in its own file in the same folder. Pages are named p000001.djvu, ...,
+    shared components keep their IDs. `dest` can be one of source documents.
+    """
+    unique, ids, used, pages = [], [], {}, 0
+    for component in components:
+        if component.kind == KIND_PAGE:
+            pages += 1
+            name = 'p{:06d}.djvu'.format(pages).encode('ascii')
+        else:
+            name = component.id
+            if name in used:
+                # every merged document has its own copy of i.e. shared annotations
+                if not _same_content(used[name], component):
+                    raise DjVuError('Shared components {!r} of merged documents differ'.format(name))
+                continue
+        if name in used:
+            raise DjVuError('Component ID {!r} is not unique'.format(name))
+        used[name] = component
+        unique.append(component)
+        ids.append(name)
+    if not unique:
+        raise DjVuError('Document has no components')
+
+    directory = (b''.join(struct.pack(b'>I', component.size)[1:] for component in unique)
+                 + bytes(bytearray(component.kind for component in unique))
+                 + b''.join(name + b'\0' for name in ids))
+    encoded = _bzz(directory)
+    dirm_size = 3 + (0 if indirect else 4 * len(unique)) + len(encoded)
+    pos = 4 + 12 + 8 + dirm_size + (dirm_size & 1)
+    offsets = []
+    for component in unique:
+        offsets.append(pos)
+        pos += component.size + (component.size & 1) # components start at even offsets
+    end = 4 + 12 + 8 + dirm_size if indirect else offsets[-1] + unique[-1].size
+
+    dirm = struct.pack(b'>BH', DIRM_VERSION | (0 if indirect else 0x80), len(unique))
+    if not indirect:
+        dirm += struct.pack(b'>{}I'.format(len(offsets)), *offsets)
+    header = (MAGIC + b'FORM' + struct.pack(b'>I', end - 12) + b'DJVM'
+              + b'DIRM' + struct.pack(b'>I', dirm_size) + dirm + encoded + b'\0' * (dirm_size & 1))
+    tmp = dest + '.bundle'
+    sources = _Sources()
+    try:
+        if indirect:
+            folder = os.path.dirname(os.path.abspath(dest))
+            for component, name in zip(unique, ids):
+                with open(os.path.join(folder, name.decode('utf-8')), 'wb') as out:
+                    out.write(MAGIC)
+                    sources.copy(component, out)
+        with open(tmp, 'wb') as out:
+            out.write(header)
+            if not indirect:
+                for component, offset in zip(unique, offsets):
+                    if out.tell() != offset:
+                        out.write(b'\0')
+                    sources.copy(component, out)
+    except (EnvironmentError, DjVuError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        sources.close()
+    _replace(tmp, dest)
+    return dest
+
+def _bundle_with_djvm(dest, files):
+    tmp = dest + '.bundle'
+    try:
+        subprocess.check_output(['djvm', '-c', tmp] + list(files), stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as err:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise DjVuError('djvm failed: {}'.format(getattr(err, 'output', None) or err))
+    _replace(tmp, dest)
+    return dest
+
+def bundle_pages(dest, page_files, indirect=False):
+    """
+    Merge DjVu files (single pages or bundled documents) into document `dest`, with `djvm -c`
+    if DjVuLibre's bzz is not available.
+    """
+    if find_executable('bzz') is None:
+        if indirect:
+            raise DjVuError('bzz is needed to write indirect documents')
+        return _bundle_with_djvm(dest, page_files)
+    components = []
+    for path in page_files:
+        components.extend(document_components(path))
+    return write_bundle(dest, components, indirect)
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+
+BlankPage = collections.namedtuple('BlankPage', ['width', 'height', 'dpi'])
+
+def assemble_pages(dest, pages):
+    """
+    Write bundled document `dest` from `pages`, each page is either (djvu_path, page_index)
+    of a page in existing document or BlankPage. `dest` can be one of source documents.
+    Raises DjVuError if pages cannot be copied between documents.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='djvumaker_')
+    listed, blanks, checked = {}, {}, set()
+    try:
+        components = []
+        for page in pages:
+            if isinstance(page, BlankPage):
+                if page not in blanks:
+                    name = os.path.join(tmpdir, 'blank{}.djvu'.format(len(blanks)))
+                    write_blank_page(name, page.width, page.height, page.dpi)
+                    blanks[page] = document_components(name)[0]
+                components.append(blanks[page])
+                continue
+            path, index = page
+            if path not in listed:
+                listed[path] = [component for component in document_components(path, False)
+                                if component.kind == KIND_PAGE]
+            if index >= len(listed[path]):
+                raise DjVuError('{} has no page {}'.format(path, index + 1))
+            component = listed[path][index]
+            if page not in checked:
+                with open(path, 'rb') as f:
+                    if has_includes(f, component.offset, component.size):
+                        raise DjVuError('Pages with shared components cannot be reused')
+                checked.add(page)
+            components.append(component)
+
+        if find_executable('bzz') is not None:
+            write_bundle(dest, components)
+        else:
+            # djvm names components by file names, so every page needs its own file
+            files, extracted = [], {}
+            for number, component in enumerate(components):
+                name = os.path.join(tmpdir, 'p{:06d}.djvu'.format(number))
+                if component in extracted:
+                    _link_or_copy(extracted[component], name)
+                else:
+                    with open(component.path, 'rb') as f:
+                        extracted[component] = write_component(f, component.offset,
+                                                               component.size, name)
+                files.append(name)
+            _bundle_with_djvm(dest, files)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return dest
+
+def document_dpi(path):
+    """Resolution of the first page of document."""
+    with open(path, 'rb') as f:
+        return page_info(f, page_components(path)[0][0])[2]
+
+def expand_page_plan(path, plan, log=None):
+    """
+    Rebuild document `path`, which holds only encoded pages of PagePlan `plan` (in order),
+    into the full document: duplicate pages reuse encoding of their source page and blank pages
+    are written as empty pages of the same size. Every duplicate is a full copy of its source
+    page component, so skipping duplicates saves encoding time but not output size (DjVu pages
+    can share dictionaries through INCL, not whole page components).
+    Raises DjVuError if the document cannot be expanded, the caller then converts all pages.
+    """
+    encoded = {page : (path, index) for index, page in enumerate(plan.encode_pages)}
+    if encoded:
+        count = len(page_components(path))
+        if count != len(encoded):
+            raise DjVuError('Backend produced {} pages, {} expected'.format(count, len(encoded)))
+        dpi = document_dpi(path)
+    else:
+        dpi = DEFAULT_DPI
+
+    pages = []
+    for page, source in enumerate(plan.sources):
+        if page in plan.blanks:
+            width, height = plan.sizes[page]
+            pages.append(BlankPage(int(width * dpi / 72), int(height * dpi / 72), dpi))
+        else:
+            pages.append(encoded[source])
+    assemble_pages(path, pages)
+    if log is not None:
+        log('reused encoding for {} duplicate and {} blank pages'.format(
+            plan.duplicates, len(plan.blanks)))
+    return path
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+download module for Calibre plugin djvumaker - resumable, verified downloads of backend archives
+
+Archives are downloaded in chunks into a `.part` file next to their destination, an interrupted
+transfer is resumed with a HTTP range request instead of starting from zero. Finished downloads
+are verified by SHA-256 (given by caller, published as `<archive>.sha256` next to the archive or
+recorded by earlier download) and kept in a cache folder together with their checksum files.
+A mirror (URL or folder, i.e. a shared cache folder of another machine) is tried before the
+author's page, so many machines can install backends from one copy in local network.
+
+References:
+(#NODOC)
+CHUNK                     -- bytes read from connection at once
+RETRIES                   -- attempts of interrupted download, each resumes where previous stopped
+TIMEOUT                   -- seconds of silence of connection before attempt fails
+sha256sum(path)
+published_checksum(location) -- SHA-256 from `<location>.sha256` file or URL, None if missing
+fetch(url, dest, sha256=None, progress=None, log=print, retries=RETRIES)
+                          -- download `url` to `dest`, resume `dest.part`, verify checksum
+retrieve(url, cache, mirror=None, sha256=None, progress=None, log=print)
+                          -- path of archive in `cache`, copied from cache, mirror or `url`
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import hashlib
+import httplib
+import os
+import re
+import shutil
+import socket
+import time
+import urllib2
+import urlparse
+
+CHUNK = 64 * 1024
+RETRIES = 5
+TIMEOUT = 30
+USER_AGENT = 'calibre-djvumaker'
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_url(location):
+    return urlparse.urlsplit(location).scheme in ('http', 'https', 'ftp', 'file')
+
+def _parse_checksum(text):
+    match = re.match(r'\s*([0-9a-fA-F]{64})\b', text)
+    return match.group(1).lower() if match else None
+
+def published_checksum(location):
+    """SHA-256 from `sha256sum` formatted file `<location>.sha256`, None if there is none."""
+    try:
+        if _is_url(location):
+            response = urllib2.urlopen(location + '.sha256', timeout=TIMEOUT)
+            try:
+                text = response.read(1024)
+            finally:
+                response.close()
+        else:
+            with open(location + '.sha256', 'rb') as f:
+                text = f.read(1024)
+    except (EnvironmentError, urllib2.URLError, httplib.HTTPException, socket.error):
+        return None
+    return _parse_checksum(text.decode('ascii', 'replace'))
+
+def _record_checksum(path, sha256):
+    with open(path + '.sha256', 'wb') as f:
+        f.write('{}  {}\n'.format(sha256, os.path.basename(path)).encode('utf-8'))
+
+def _content_total(response, offset):
+    """Total size of resource from Content-Range or Content-Length, None if unknown."""
+    headers = response.info()
+    match = re.match(r'bytes (\d+)-\d+/(\d+)', headers.get('Content-Range') or '')
+    if match:
+        if int(match.group(1)) != offset:
+            raise IOError('server resumed at byte {} instead of {}'.format(match.group(1), offset))
+        return int(match.group(2))
+    length = headers.get('Content-Length')
+    return offset + int(length) if length is not None else None
+
+def _fetch_part(url, part, progress):
+    """Append rest of `url` to file `part`, start over if server ignores range requests."""
+    done = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib2.Request(url, headers={'User-Agent' : USER_AGENT})
+    if done:
+        request.add_header('Range', 'bytes={}-'.format(done))
+    response = urllib2.urlopen(request, timeout=TIMEOUT)
+    try:
+        if done and response.getcode() != 206:
+            done = 0
+        total = _content_total(response, done)
+        with open(part, 'ab' if done else 'wb') as f:
+            while True:
+                chunk = response.read(CHUNK)
+                if not chunk:
+                    break
+                f.write(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        response.close()
+    if total is not None and done != total:
+        raise IOError('connection closed after {} of {} bytes'.format(done, total))
+
+def fetch(url, dest, sha256=None, progress=None, log=print, retries=RETRIES):
+    """
+    Download `url` to `dest` through `dest.part`, which is resumed if left by earlier attempt.
+    `progress(done, total)` gets bytes downloaded and total size (None if unknown). File not
+    matching `sha256` is removed and Exception raised. Return `dest`.
+    """
+    part = dest + '.part'
+    for attempt in range(retries + 1):
+        try:
+            _fetch_part(url, part, progress)
+            break
+        except urllib2.HTTPError as err:
+            if err.code == 416: # range beyond size, remote file changed since part was written
+                os.remove(part)
+            elif err.code < 500:
+                raise Exception('Cannot download {}: {}'.format(url, err))
+            error = err
+        except (urllib2.URLError, httplib.HTTPException, socket.error, IOError) as err:
+            error = err
+        if attempt < retries:
+            log('Download of {} interrupted ({}), resuming in {}s...'.format(
+                url, error, 2 ** attempt))
+            time.sleep(2 ** attempt)
+    else:
+        raise Exception('Cannot download {} after {} attempts: {}'.format(url, retries + 1, error))
+
+    if sha256 is not None:
+        actual = sha256sum(part)
+        if actual != sha256.lower():
+            os.remove(part)
+            raise Exception('Downloaded {} has SHA-256 {}, expected {}.'.format(url, actual, sha256))
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest) # rename doesn't replace files on Windows
+    os.rename(part, dest)
+    return dest
+
+def _copy(source, dest, sha256):
+    part = dest + '.part'
+    shutil.copyfile(source, part)
+    if sha256 is not None and sha256sum(part) != sha256.lower():
+        os.remove(part)
+        raise Exception('{} does not match SHA-256 {}.'.format(source, sha256))
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(part, dest)
+    return dest
+
+def retrieve(url, cache, mirror=None, sha256=None, progress=None, log=print):
+    """
+    Return path of archive `url` in folder `cache`. A cached archive matching its checksum is
+    used as is, otherwise it is copied or downloaded from `mirror` (URL or folder with archives
+    of the same names) and then from `url`. Checksum of every archive is kept in `cache` as
+    `<archive>.sha256`, so `cache` can serve as mirror of other machines.
+    """
+    name = os.path.basename(urlparse.urlsplit(url).path)
+    dest = os.path.join(cache, name)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    if sha256 is None:
+        sha256 = published_checksum(dest)
+    if os.path.exists(dest):
+        if sha256 is not None and sha256sum(dest) == sha256.lower():
+            log('Using {} from download cache.'.format(dest))
+            return dest
+        os.remove(dest)
+
+    sources = [url]
+    if mirror:
+        sources.insert(0, mirror.rstrip('/') + '/' + name if _is_url(mirror)
+                          else os.path.join(mirror, name))
+    for source in sources:
+        expected = sha256 or published_checksum(source)
+        log('Downloading {}...'.format(source))
+        try:
+            if _is_url(source):
+                fetch(source, dest, expected, progress, log)
+            elif os.path.exists(source):
+                _copy(source, dest, expected)
+            else:
+                raise Exception('{} not found in mirror.'.format(name))
+        except Exception as err:
+            log('{}'.format(err))
+            continue
+        if expected is None:
+            expected = sha256sum(dest)
+            log('No checksum published for {}, recorded SHA-256 {}.'.format(name, expected))
+        _record_checksum(dest, expected)
+        return dest
+    raise Exception('Cannot download {}.'.format(name))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+estimate module for Calibre plugin djvumaker - conversion history and cost of planned bulk runs
+
+Every finished conversion records its page count, CPU time (measured user and system time of
+backend's process tree, or of plugin's process for in-process backends; wall time times cores
+given to it on Windows), source and DJVU size and dominant image encoding of source per backend in a JSON file next to
+plugin's settings, only the newest HISTORY_SIZE records of each backend are kept. Per page CPU
+time and compression ratio from the history (declared cost hints of backend when it's empty)
+project CPU time, wall time at given concurrency and output size of candidate books of
+`convert --all --estimate`. DJVU bytes per page of sources with the same encoding predict
+whether converting a book pays off at all: PDFs of JBIG2 or CCITT G4 images are often smaller
+than their DJVU.
+
+References:
+(#NODOC)
+HISTORY_SIZE              -- records kept per backend
+SECONDS_PER_PAGE          -- CPU seconds per page of backend with cpu_cost 1.0 without history
+SIZE_RATIO                -- DJVU size relative to source document without history
+TOP_BOOKS                 -- number of costliest books listed
+MIN_SAMPLES               -- records needed for prediction from history
+PAGE_BYTES, BILEVEL_PAGE_BYTES -- DJVU bytes per page without history, of bilevel encoded sources
+Rates(cpu_per_page, size_ratio, samples) -- per page CPU seconds, DJVU/source size, records used
+BookCost(book_id, path, pages, size, cpu, output) -- projected cost of one book
+Estimate(books, pages, size, cpu, wall, output, costliest) -- projected cost of all books
+Prediction(size, output, gain, basis, samples) -- predicted DJVU size of one book, relative size
+                             gain, recorded conversions it's based on (0 for typical page)
+History(path)
+  .record(backend, pages, cpu, size, output, encoding=None) -- add finished conversion of backend
+  .rates(backend)         -- Rates from recorded conversions, None if there are none
+  .predict(backend, pages, size, encoding=None) -- Prediction of DJVU size of source document
+dominant_encoding(encodings) -- image filter of most images in DocumentProfile encodings
+default_rates(cpu_cost)   -- Rates from backend's declared CPU cost
+estimate(candidates, rates, cpus, jobs, threads, top=TOP_BOOKS) -- Estimate of (book_id, path,
+                             pages, size) candidates converted `jobs` at once on `cpus` cores
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import heapq
+import json
+import os
+import threading
+
+from calibre_plugins.djvumaker.processes import lock_file
+
+HISTORY_SIZE = 200
+SECONDS_PER_PAGE = 1.0
+SIZE_RATIO = 0.5
+TOP_BOOKS = 10
+MIN_SAMPLES = 3
+PAGE_BYTES = 60 * 1024
+BILEVEL_PAGE_BYTES = 30 * 1024
+BILEVEL_ENCODINGS = ('JBIG2Decode', 'CCITTFaxDecode')
+
+Rates = collections.namedtuple('Rates', ['cpu_per_page', 'size_ratio', 'samples'])
+BookCost = collections.namedtuple('BookCost', ['book_id', 'path', 'pages', 'size', 'cpu', 'output'])
+Estimate = collections.namedtuple('Estimate', ['books', 'pages', 'size', 'cpu', 'wall', 'output',
+                                               'costliest'])
+Prediction = collections.namedtuple('Prediction', ['size', 'output', 'gain', 'basis', 'samples'])
+
+def dominant_encoding(encodings):
+    """Image filter (i.e. 'JBIG2Decode') of most images of sampled pages, None without images."""
+    return max(sorted(encodings), key=encodings.get) if encodings else None
+
+class History(object):
+    """
+    Conversion records per backend in JSON file `path`. Records of other processes (fork_job
+    workers, CLI) are merged on every write, writers take turns by `path`.lock file.
+    Thread-safe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def record(self, backend, pages, cpu, size, output, encoding=None):
+        if not pages or cpu <= 0 or not size:
+            return
+        folder = os.path.dirname(self.path)
+        with self.lock:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with lock_file(self.path + '.lock'):
+                self._record(backend, [pages, cpu, size, output, encoding])
+
+    def _record(self, backend, record):
+        records = self._load()
+        records.setdefault(backend, []).append(record)
+        records[backend] = records[backend][-HISTORY_SIZE:]
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(json.dumps(records).encode('utf-8'))
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path) # rename doesn't replace files on Windows
+        os.rename(temp, self.path)
+
+    def rates(self, backend):
+        with self.lock:
+            records = self._load().get(backend)
+        if not records:
+            return None
+        pages, cpu, size, output = [sum(record[column] for record in records)
+                                    for column in range(4)]
+        return Rates(cpu / pages, output / size, len(records))
+
+    def predict(self, backend, pages, size, encoding=None):
+        """
+        Predict DJVU size of source document of `pages` and `size` bytes from DJVU bytes per page
+        of recorded sources with the same dominant `encoding`, or of all recorded ones.
+        """
+        with self.lock:
+            records = self._load().get(backend) or []
+        same = [record for record in records if len(record) > 4 and record[4] == encoding]
+        for sample, basis in ((same, '{} conversions of {} sources'.format(len(same),
+                                                                         encoding or 'unknown')),
+                              (records, '{} conversions'.format(len(records)))):
+            if len(sample) >= MIN_SAMPLES:
+                page_bytes = sum(record[3] for record in sample) / sum(record[0] for record in sample)
+                samples = len(sample)
+                break
+        else:
+            samples = 0
+            bilevel = encoding in BILEVEL_ENCODINGS
+            page_bytes = BILEVEL_PAGE_BYTES if bilevel else PAGE_BYTES
+            basis = 'typical {}DJVU page'.format('bilevel ' if bilevel else '')
+        output = pages * page_bytes
+        return Prediction(size, output, 1 - output / size if size else 0, basis, samples)
+
+def default_rates(cpu_cost):
+    return Rates(SECONDS_PER_PAGE * cpu_cost, SIZE_RATIO, 0)
+
+def estimate(candidates, rates, cpus, jobs, threads, top=TOP_BOOKS):
+    """
+    Project cost of converting (book_id, path, pages, size) `candidates` with `rates`, `jobs`
+    books at once on `cpus` cores, every one using `threads` cores (0 means all). Books of
+    unknown page count are counted as average book.
+    """
+    candidates = list(candidates)
+    known = [pages for _, _, pages, _ in candidates if pages]
+    average = sum(known) / len(known) if known else 1
+    costs = []
+    for book_id, path, pages, size in candidates:
+        pages = pages or average
+        costs.append(BookCost(book_id, path, pages, size, pages * rates.cpu_per_page,
+                              size * rates.size_ratio))
+    cpu = sum(cost.cpu for cost in costs)
+    per_book = threads or max(1, cpus // jobs)
+    # run ends no sooner than the costliest book does on its own cores
+    wall = max([cpu / max(1, min(cpus, jobs * per_book))]
+               + [cost.cpu / per_book for cost in costs])
+    return Estimate(len(costs), sum(cost.pages for cost in costs),
+                    sum(cost.size for cost in costs), cpu, wall,
+                    sum(cost.output for cost in costs),
+                    heapq.nlargest(top, costs, key=lambda cost: cost.cpu))
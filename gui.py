@@ -9,11 +9,18 @@ References:
 ConvertToDJVUAction(InterfaceAction)
   .genesis(self)
   .initialization_complete(self)
+  .library_changed(self, db)
+  ._start_indexer(self, db)
+  ._tag_scans(self, db, tag, book_ids)
   .location_selected(self, loc)
   .convert_book(self, triggered)
+  .preview_book(self, triggered)
   ._convert_books(self, rows)
-  ._tjob_djvu_convert(self, db, book_id, fpath, ftype, abort, log, notifications)
+  ._tjob_djvu_convert(self, db, book_id, fpath, ftype, abort, log, notifications, refresh=False,
+      results=None)
   ._tjob_refresh_books(self, job)
+  ._tjob_djvu_preview(self, path_to_ebook, abort, log, notifications)
+  ._tjob_show_preview(self, job)
 """
 from __future__ import unicode_literals, division, absolute_import, print_function
 
@@ -23,11 +30,14 @@ from calibre import prints
 from cStringIO import StringIO
 from calibre.utils.logging import ERROR, WARN, DEBUG, INFO
 
+from calibre.gui2 import error_dialog, info_dialog, open_local_file, FunctionDispatcher
 from calibre.gui2.actions import InterfaceAction
 # http://manual.calibre-ebook.com/_modules/calibre/gui2/actions.html
 
 from calibre.customize.ui import run_plugins_on_postimport, find_plugin
 from calibre.gui2.threaded_jobs import ThreadedJob
+from calibre_plugins.djvumaker.images import INPUT_TYPES
+from calibre_plugins.djvumaker.results import ResultCollector
 
 # http://manual.calibre-ebook.com/creating_plugins.html#ui-py
 class ConvertToDJVUAction(InterfaceAction):
@@ -58,7 +68,27 @@ class ConvertToDJVUAction(InterfaceAction):
         cm = partial(cb.create_menu_action, cb.qaction.menu())
         cm('convert-djvu-cvtm', _('Convert to DJVU'), icon=self.qaction.icon(),
            triggered=self.convert_book)
+        cm('preview-djvu-cvtm', _('Preview DJVU'), icon=self.qaction.icon(),
+           triggered=self.preview_book)
         cb.qaction.setMenu(cb.qaction.menu())
+        # profile library books in background if turned on, conversions look them up in the index
+        self._start_indexer(self.gui.current_db)
+
+    def library_changed(self, db):
+        #NODOC
+        self._start_indexer(db)
+
+    def _start_indexer(self, db):
+        #NODOC
+        # indexer thread must not write to library behind GUI's back, tags are added in GUI thread
+        find_plugin('djvumaker').start_indexer(
+            db, tag_books=FunctionDispatcher(partial(self._tag_scans, db)))
+
+    def _tag_scans(self, db, tag, book_ids):
+        #NODOC
+        if find_plugin('djvumaker').tag_scanned(db, tag, book_ids):
+            self.gui.library_view.model().refresh_ids(book_ids)
+            self.gui.tags_view.recount()
 
     def location_selected(self, loc):
         #NODOC
@@ -80,21 +110,42 @@ class ConvertToDJVUAction(InterfaceAction):
 
         if self.gui.current_view() is self.gui.library_view:
             ids = list(map(self.gui.library_view.model().id, rows))
+            plugin = find_plugin('djvumaker')
+            conversions = []
             for book_id in ids:
+                refresh = False
                 if db.has_format(book_id, 'DJVU', index_is_id=True):
-                    continue
-                if db.has_format(book_id, 'PDF', index_is_id=True):
-                    path_to_ebook = db.format_abspath(book_id, 'pdf', index_is_id=True)
-                    job = ThreadedJob('ConvertToDJVU',
-                                      'Converting %s to DJVU' % path_to_ebook,
-                                      func=self._tjob_djvu_convert,
-                                      args=(db, book_id, None, 'pdf'), #by book_id!
-                                      kwargs={},
-                                      callback=self._tjob_refresh_books)
-                    # there is an assumed log=GUILog() ! src/calibre/utils/logging.py
-                    self.gui.job_manager.run_threaded_job(job)
-                    # too bad console utils and filetype plugins can't start a jobmanager..fork_job is
-                    #   a wretch
+                    # PDF replaced since conversion, only its changed pages are converted
+                    refresh = plugin.needs_refresh(db, book_id)
+                    if not refresh:
+                        continue
+                # scanned TIFF or CBZ is converted only if the book has no PDF
+                formats = ('pdf',) if refresh else ('pdf',) + INPUT_TYPES
+                ftype = next((ftype for ftype in formats
+                              if db.has_format(book_id, ftype.upper(), index_is_id=True)), None)
+                if ftype is not None:
+                    conversions.append((book_id, ftype, refresh))
+            # finished DJVUs of selected books are added to library in batches,
+            # the last job to end writes the rest
+            results = ResultCollector(db, plugin.prints, expected=len(conversions))
+            index = plugin.library_index(db)
+            for book_id, ftype, refresh in conversions:
+                path_to_ebook = db.format_abspath(book_id, ftype, index_is_id=True)
+                description = ('Refreshing DJVU of %s' if refresh else
+                               'Converting %s to DJVU') % path_to_ebook
+                profile = index.lookup(path_to_ebook)
+                if profile is not None:
+                    description += ' (%d pages)' % profile.page_count
+                job = ThreadedJob('ConvertToDJVU', description,
+                                  func=self._tjob_djvu_convert,
+                                  args=(db, book_id, None, ftype), #by book_id!
+                                  kwargs={'refresh' : refresh, 'results' : results,
+                                          'pages' : profile and profile.page_count},
+                                  callback=self._tjob_refresh_books)
+                # there is an assumed log=GUILog() ! src/calibre/utils/logging.py
+                self.gui.job_manager.run_threaded_job(job)
+                # too bad console utils and filetype plugins can't start a jobmanager..fork_job is
+                #   a wretch
         else: # !gui_library
         # looking at a device's flash contents or some other non-library store,
         # filepaths here are not to be tracked in the db
@@ -107,11 +158,54 @@ class ConvertToDJVUAction(InterfaceAction):
                                   kwargs={})
                 self.gui.job_manager.run_threaded_job(job)
 
-    def _tjob_djvu_convert(self, db, book_id, fpath, ftype, abort, log, notifications):
+    def preview_book(self, triggered):
+        """Convert first pages of the current book, show projected time and size of whole book."""
+        db = self.gui.current_db
+        if self.gui.current_view() is not self.gui.library_view:
+            return error_dialog(self.gui, _('Cannot preview'),
+                                _('Preview works only for books in library'), show=True)
+        index = self.gui.library_view.currentIndex()
+        if not index.isValid():
+            return error_dialog(self.gui, _('Cannot preview'),
+                                _('No book selected'), show=True)
+        book_id = self.gui.library_view.model().id(index)
+        path_to_ebook = find_plugin('djvumaker').book_path(db, book_id)
+        job = ThreadedJob('ConvertToDJVU', 'Previewing %s as DJVU' % path_to_ebook,
+                          func=self._tjob_djvu_preview,
+                          args=(path_to_ebook,),
+                          kwargs={},
+                          callback=self._tjob_show_preview)
+        self.gui.job_manager.run_threaded_job(job)
+
+    def _tjob_djvu_preview(self, path_to_ebook, abort, log, notifications):
+        #NODOC
+        preview = find_plugin('djvumaker').preview(path_to_ebook, log=log, abort=abort,
+                                                   notifications=notifications)
+        log(preview.report())
+        return preview
+
+    def _tjob_show_preview(self, job):
+        #NODOC
+        if job.failed:
+            return self.gui.job_exception(job, dialog_title=_('DJVU preview failed'))
+        info_dialog(self.gui, _('DJVU preview'), job.result.report(), show=True)
+        open_local_file(job.result.djvu)
+
+    def _tjob_djvu_convert(self, db, book_id, fpath, ftype, abort, log, notifications, refresh=False,
+                           results=None, pages=None):
         #NODOC
         if book_id:
-            find_plugin('djvumaker')._postimport(book_id, ftype, db, log, fork_job=False,
-                                                abort=abort, notifications=notifications)
+            plugin = find_plugin('djvumaker')
+            try:
+                # selected books wait for their turn, their number at once follows throughput
+                notifications.put((0, 'Waiting for other conversions...'))
+                with plugin.conversion_slot(pages, abort):
+                    plugin._postimport(book_id, ftype, db, log, fork_job=False, abort=abort,
+                                       notifications=notifications, refresh=refresh,
+                                       results=results)
+            finally:
+                if results is not None:
+                    results.job_done()
         elif fpath:
             # TODO: proper english
             raise NotImplementedError('Connot convert book outside of library.'
@@ -121,9 +215,12 @@ class ConvertToDJVUAction(InterfaceAction):
 
     def _tjob_refresh_books(self, job):
         #NODOC
-        book_id = job.args[1]
-        # self.gui.iactions['Edit Metadata'].refresh_gui([book_id], covers_changed=False)
-        self.gui.library_view.model().refresh_ids([book_id])
+        # books are refreshed once per written batch, by callback of the job which wrote it
+        book_ids = job.kwargs['results'].take_written()
+        if not book_ids:
+            return
+        # self.gui.iactions['Edit Metadata'].refresh_gui(book_ids, covers_changed=False)
+        self.gui.library_view.model().refresh_ids(book_ids)
         self.gui.library_view.model().current_changed(self.gui.library_view.currentIndex(),
                                                       self.gui.library_view.currentIndex())
         self.gui.tags_view.recount()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+images module for Calibre plugin djvumaker - direct conversion of scanned page images to DJVU
+
+Multi-page TIFF files, CBZ archives and folders of page images are converted page by page
+with DjVuLibre encoders (see pipeline.encode_page), without wrapping them into an intermediate
+PDF first. Pages are extracted lazily, encoded in parallel and bundled in page order into one DJVU.
+
+References:
+(#NODOC)
+INPUT_TYPES                  -- file extensions converted by this module, besides folders
+is_image_input(path)         -- whether path is converted by this module
+natural_key(name)            -- sort key, 'p2.jpg' before 'p10.jpg'
+tiff_pages(path)             -- IFD offsets and attributes of every page of TIFF file
+write_tiff_page(src, ifd, dest) -- write one page of TIFF file as single-page TIFF
+iter_page_sources(path, tmpdir) -- page images of document in page order
+page_count(path)             -- number of pages, TIFF files in folders and archives count as one
+images_to_djvu(srcdoc, ...)  -- convert image document to bundled DJVU, same signature as backends
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import re
+import shutil
+import struct
+import sys
+import zipfile
+
+from calibre import force_unicode
+from calibre_plugins.djvumaker.pipeline import encode_page, PageImage, Pipeline, PipelineError
+from calibre_plugins.djvumaker.utils import EmptyClass, cpu_count, temporary_path
+
+INPUT_TYPES = ('tif', 'tiff', 'cbz')
+IMAGE_EXTENSIONS = ('tif', 'tiff', 'jpg', 'jpeg', 'png', 'gif', 'bmp', 'pbm', 'pgm', 'ppm', 'pnm')
+
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+_TIFF_DROPPED_TAGS = (330, 34665, 34853) # SubIFDs, Exif and GPS IFDs point elsewhere in the file
+_TIFF_DATA_TAGS = ((273, 279), (324, 325)) # (StripOffsets, StripByteCounts), (TileOffsets, ...)
+
+def is_image_input(path):
+    """Check whether document under `path` is converted by images_to_djvu."""
+    return os.path.isdir(path) or os.path.splitext(path)[1].lower().lstrip('.') in INPUT_TYPES
+
+def natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def _is_image_name(name):
+    return os.path.splitext(name)[1].lower().lstrip('.') in IMAGE_EXTENSIONS
+
+
+# -- TIFF splitting --
+def _tiff_entries(f, order, ifd):
+    f.seek(ifd)
+    count = struct.unpack(order + b'H', f.read(2))[0]
+    entries = []
+    for _ in range(count):
+        tag, typ, num, raw = struct.unpack(order + b'HHI4s', f.read(12))
+        size = _TIFF_TYPE_SIZES.get(typ, 1) * num
+        entries.append((tag, typ, num, raw, size))
+    next_ifd = struct.unpack(order + b'I', f.read(4))[0]
+    return entries, next_ifd
+
+def _tiff_value(f, order, entry):
+    """Return raw bytes of entry value, read from file if they don't fit into the entry."""
+    tag, typ, num, raw, size = entry
+    if size <= 4:
+        return raw[:size]
+    f.seek(struct.unpack(order + b'I', raw)[0])
+    return f.read(size)
+
+def _tiff_ints(order, typ, data):
+    fmt = {1: b'B', 3: b'H', 4: b'I', 13: b'I'}.get(typ)
+    if fmt is None:
+        return []
+    return list(struct.unpack(order + fmt * (len(data) // struct.calcsize(fmt)), data))
+
+def _tiff_header(f):
+    header = f.read(8)
+    if header[:2] == b'II':
+        order = b'<'
+    elif header[:2] == b'MM':
+        order = b'>'
+    else:
+        raise ValueError('Not a TIFF file')
+    magic, ifd = struct.unpack(order + b'HI', header[2:])
+    if magic != 42:
+        raise ValueError('BigTIFF and other TIFF variants are not supported')
+    return order, ifd
+
+def tiff_pages(path):
+    """
+    Return list of (ifd_offset, bilevel, dpi) of every page of TIFF file, where bilevel tells
+    whether page is 1-bit image and dpi is its horizontal resolution or None.
+    """
+    pages = []
+    with open(path, 'rb') as f:
+        order, ifd = _tiff_header(f)
+        seen = set()
+        while ifd and ifd not in seen:
+            seen.add(ifd)
+            entries, next_ifd = _tiff_entries(f, order, ifd)
+            tags = {entry[0] : entry for entry in entries}
+            def ints(tag, default):
+                if tag not in tags:
+                    return default
+                return _tiff_ints(order, tags[tag][1], _tiff_value(f, order, tags[tag])) or default
+            bilevel = ints(258, [1])[0] == 1 and ints(277, [1])[0] == 1
+            dpi = None
+            if 282 in tags and tags[282][1] == 5:
+                num, den = struct.unpack(order + b'II', _tiff_value(f, order, tags[282]))
+                unit = ints(296, [2])[0]
+                if den and unit in (2, 3):
+                    dpi = int(round(num / den * (2.54 if unit == 3 else 1)))
+            pages.append((ifd, bilevel, dpi))
+            ifd = next_ifd
+    return pages
+
+def write_tiff_page(src, ifd, dest):
+    """Write page of TIFF file `src`, which IFD starts at offset `ifd`, as a single-page TIFF."""
+    with open(src, 'rb') as f:
+        order, _ = _tiff_header(f)
+        entries, _ = _tiff_entries(f, order, ifd)
+        entries = sorted(e for e in entries if e[0] not in _TIFF_DROPPED_TAGS)
+        values = {entry[0] : _tiff_value(f, order, entry) for entry in entries}
+        types = {entry[0] : entry[1] for entry in entries}
+        for offsets_tag, counts_tag in _TIFF_DATA_TAGS:
+            if offsets_tag in values and counts_tag in values:
+                offsets = _tiff_ints(order, types[offsets_tag], values[offsets_tag])
+                counts = _tiff_ints(order, types[counts_tag], values[counts_tag])
+                chunks = list(zip(offsets, counts))
+                data_tag = offsets_tag
+                break
+        else:
+            raise ValueError('TIFF page has no image data')
+
+        # layout: header, IFD, values which don't fit into entries, image data
+        ifd_size = 2 + 12 * len(entries) + 4
+        pos = 8 + ifd_size
+        value_offsets = {}
+        for tag, typ, num, raw, size in entries:
+            if tag == data_tag:
+                size = 4 * num # rewritten as LONGs
+            if size > 4:
+                value_offsets[tag] = pos
+                pos += size + (size & 1)
+        new_offsets = []
+        for offset, count in chunks:
+            new_offsets.append(pos)
+            pos += count
+
+        with open(dest, 'wb') as out:
+            out.write((b'II' if order == b'<' else b'MM') + struct.pack(order + b'HI', 42, 8))
+            out.write(struct.pack(order + b'H', len(entries)))
+            for tag, typ, num, raw, size in entries:
+                if tag == data_tag:
+                    typ, value = 4, struct.pack(order + b'I' * num, *new_offsets)
+                else:
+                    value = values[tag]
+                if len(value) > 4:
+                    raw = struct.pack(order + b'I', value_offsets[tag])
+                else:
+                    raw = value.ljust(4, b'\0')
+                out.write(struct.pack(order + b'HHI', tag, typ, num) + raw)
+            out.write(struct.pack(order + b'I', 0))
+            for tag, typ, num, raw, size in entries:
+                if tag in value_offsets:
+                    value = (struct.pack(order + b'I' * num, *new_offsets) if tag == data_tag
+                             else values[tag])
+                    out.write(value + (b'\0' if len(value) & 1 else b''))
+            for offset, count in chunks:
+                f.seek(offset)
+                out.write(f.read(count))
+    return dest
+
+
+# -- page sources --
+def iter_page_sources(path, tmpdir):
+    """
+    Yield (page_image_path, is_temporary, bilevel, dpi) of document pages in page order.
+    Pages of TIFF files and CBZ archives are extracted to `tmpdir` only when they are requested,
+    bilevel and dpi are None when they are not known before decoding the image.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path), key=natural_key):
+            page = os.path.join(path, name)
+            if os.path.isfile(page) and _is_image_name(name):
+                for source in _image_file_sources(page, False, tmpdir):
+                    yield source
+        return
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext == 'cbz':
+        with zipfile.ZipFile(path) as archive:
+            names = sorted((name for name in archive.namelist()
+                            if not name.endswith('/') and _is_image_name(name)), key=natural_key)
+            for number, name in enumerate(names):
+                page = os.path.join(tmpdir, 'cbz{:06d}{}'.format(
+                    number, os.path.splitext(name)[1].lower()))
+                with archive.open(name) as src, open(page, 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+                for source in _image_file_sources(page, True, tmpdir):
+                    yield source
+        return
+    for source in _image_file_sources(path, False, tmpdir):
+        yield source
+
+def page_count(path):
+    """Number of pages of image document, without extracting them."""
+    if os.path.isdir(path):
+        names = [name for name in os.listdir(path)
+                 if _is_image_name(name) and os.path.isfile(os.path.join(path, name))]
+    elif os.path.splitext(path)[1].lower() == '.cbz':
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist()
+                     if not name.endswith('/') and _is_image_name(name)]
+    else:
+        return len(tiff_pages(path))
+    # multi-page TIFF files inside are counted as one page
+    return len(names)
+
+def _image_file_sources(page, temporary, tmpdir):
+    ext = os.path.splitext(page)[1].lower().lstrip('.')
+    if ext not in ('tif', 'tiff'):
+        yield page, temporary, ext == 'pbm' or None, _jpeg_dpi(page) if ext in ('jpg', 'jpeg') else None
+        return
+    ifds = tiff_pages(page)
+    if len(ifds) == 1:
+        yield page, temporary, ifds[0][1], ifds[0][2]
+        return
+    base = os.path.join(tmpdir, os.path.splitext(os.path.basename(page))[0])
+    for number, (ifd, bilevel, dpi) in enumerate(ifds):
+        yield write_tiff_page(page, ifd, '{}_{:06d}.tif'.format(base, number)), True, bilevel, dpi
+    if temporary:
+        os.remove(page)
+
+def _jpeg_dpi(path):
+    """Resolution from JFIF header of JPEG file, None if it's missing."""
+    with open(path, 'rb') as f:
+        header = f.read(20)
+    if header[6:11] != b'JFIF\0':
+        return None
+    unit, xdensity = struct.unpack(b'>BH', header[13:16])
+    if unit == 1:
+        return xdensity
+    if unit == 2:
+        return int(round(xdensity * 2.54))
+    return None
+
+
+# -- conversion --
+def images_to_djvu(srcdoc, log=None, abort=None, notifications=None, pages=None, images=None,
+                   cmdflags=None, dpi=None, page_selection=None, preferences=None, workers=None,
+                   **kwargs):
+    """
+    Convert multi-page TIFF, CBZ archive or folder of page images to bundled DJVU.
+    Arguments are the same as of backends wrapped by job_handler, return path to DJVU or False.
+    Pages are extracted and encoded by pipeline.Pipeline with `workers` encoders.
+    """
+    if notifications is None:
+        notifications = EmptyClass()
+        notifications.put = lambda x : None
+    def prints(*args):
+        line = ' '.join(['djvumaker:'] + [force_unicode(arg) for arg in args])
+        return log(line) if log else sys.stdout.write(line + '\n')
+
+    try:
+        total = max(page_count(srcdoc), 1)
+    except (IOError, OSError, ValueError, struct.error, zipfile.BadZipfile):
+        total = 1 # unreadable document is reported by the pipeline
+    def progress(encoded):
+        notifications.put((encoded / (total + 1), 'Encoding page {} of {}...'.format(encoded, total)))
+
+    def source(tmpdir):
+        for number, (path, temporary, bilevel, page_dpi) in enumerate(
+                iter_page_sources(srcdoc, tmpdir)):
+            if page_selection is not None and number not in page_selection:
+                if temporary:
+                    os.remove(path)
+                continue
+            yield PageImage(number, path, bilevel, page_dpi, temporary)
+
+    workers = workers or cpu_count()
+    bookname = os.path.splitext(os.path.basename(os.path.normpath(srcdoc)))[0]
+    djvu = temporary_path(bookname + '.djvu') # removed by caller once added to library
+    prints('encoding pages of {} with {} workers'.format(srcdoc, workers))
+    notifications.put((0.01, 'Launching encoders...'))
+    try:
+        count = Pipeline(encode_page, workers, abort=abort, progress=progress).run([source],
+                                                                                   djvu)
+    except PipelineError as err:
+        for line in '{}'.format(err).splitlines():
+            prints('Error:', line)
+        os.remove(djvu)
+        return False
+    if count is None:
+        prints('conversion aborted')
+        os.remove(djvu)
+        return False
+    prints('bundled {} pages into {}'.format(count, djvu))
+    return djvu
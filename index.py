@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+index module for Calibre plugin djvumaker - sidecar index of document profiles of library books
+
+Telling scans from authored documents needs opening the document. LibraryIndex records
+DocumentProfile (page count, image count, image encodings, estimated DPI, raster verdict) of every
+convertible format of a library in a JSON file next to plugin's settings, keyed by format path
+and checked against file's mtime and size. Indexer thread keeps it updated in background, only new
+and changed documents are profiled, so conversions, bulk selection and tagging only look it up.
+
+References:
+(#NODOC)
+INDEX_VERSION             -- entries recorded by other version are profiled again
+INTERVAL                  -- seconds between passes of background indexer
+PAUSE                     -- seconds background indexer sleeps between profiled documents
+SAVE_EVERY                -- profiled documents between saves of index file
+library_formats(db, types) -- (book_id, fmt, path) of first format of every book found in `types`
+LibraryIndex(path, profiler)
+  .lookup(path)           -- recorded DocumentProfile if document didn't change, else None
+  .profile(path, book_id=None, fmt=None) -- recorded or freshly computed DocumentProfile
+  .refresh(formats, abort=None, log=None, pause=0) -- profile new and changed documents
+  .entries()              -- dict path -> (book_id, fmt, DocumentProfile or None if unreadable)
+  .save()
+  .clear()
+Indexer(index, formats, interval=INTERVAL, on_update=None, log=None) -- background thread
+  .stop()
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import json
+import os
+import threading
+import time
+import traceback
+
+from calibre_plugins.djvumaker.pdfscan import DocumentProfile
+
+INDEX_VERSION = 1
+INTERVAL = 600
+PAUSE = 0.05
+SAVE_EVERY = 50
+
+def library_formats(db, types):
+    """Yield (book_id, fmt, path) of the first format of every book of library found in `types`."""
+    api = getattr(db, 'new_api', db)
+    for book_id in api.all_book_ids():
+        formats = api.formats(book_id)
+        for fmt in types:
+            if fmt.upper() in formats:
+                path = api.format_abspath(book_id, fmt.upper())
+                if path:
+                    yield book_id, fmt, path
+                break
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+class LibraryIndex(object):
+    """
+    DocumentProfiles of library documents saved in JSON file `path`. `profiler(path)` returns
+    DocumentProfile of document, its exceptions mark document as unreadable until it changes.
+    Thread-safe.
+    """
+
+    def __init__(self, path, profiler):
+        self.path = path
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self._entries = {}
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self._entries = data['entries']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def _record(self, path, stat, book_id, fmt, profile):
+        entry = {'stat' : stat, 'book_id' : book_id, 'format' : fmt,
+                 'profile' : None if profile is None else profile._asdict()}
+        with self.lock:
+            self._entries[path] = entry
+
+    def _fresh(self, path, stat):
+        with self.lock:
+            entry = self._entries.get(path)
+        if entry is None or stat is None or entry['stat'] != stat:
+            return None
+        return entry
+
+    def lookup(self, path):
+        entry = self._fresh(path, _stat(path))
+        if entry is None or entry['profile'] is None:
+            return None
+        return DocumentProfile(**entry['profile'])
+
+    def profile(self, path, book_id=None, fmt=None):
+        """Return recorded DocumentProfile of document or profile it, profiler errors propagate."""
+        profile = self.lookup(path)
+        if profile is None:
+            stat = _stat(path)
+            profile = self.profiler(path)
+            self._record(path, stat, book_id, fmt, profile)
+            self.save()
+        return profile
+
+    def refresh(self, formats, abort=None, log=None, pause=0):
+        """
+        Profile documents from iterable of (book_id, fmt, path) which are new or changed since
+        recorded, forget documents not in `formats`. Return list of (book_id, DocumentProfile)
+        of profiled documents.
+        """
+        seen, updated, profiled = set(), [], 0
+        for book_id, fmt, path in formats:
+            if abort is not None and abort.is_set():
+                return updated # documents not seen yet must not be forgotten
+            seen.add(path)
+            stat = _stat(path)
+            if stat is None or self._fresh(path, stat) is not None:
+                continue
+            try:
+                profile = self.profiler(path)
+            except Exception as err:
+                if log is not None:
+                    log('cannot index book ID #{} ({}): {}'.format(book_id, path, err))
+                profile = None
+            self._record(path, stat, book_id, fmt, profile)
+            if profile is not None:
+                updated.append((book_id, profile))
+            profiled += 1
+            if profiled % SAVE_EVERY == 0:
+                self.save()
+            if pause:
+                time.sleep(pause)
+        with self.lock:
+            for path in set(self._entries) - seen:
+                del self._entries[path]
+        self.save()
+        return updated
+
+    def entries(self):
+        with self.lock:
+            entries = dict(self._entries)
+        return {path : (entry['book_id'], entry['format'],
+                        None if entry['profile'] is None else DocumentProfile(**entry['profile']))
+                for path, entry in entries.items()}
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self.lock:
+            data = json.dumps({'version' : INDEX_VERSION, 'entries' : self._entries})
+            temp = self.path + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data.encode('utf-8'))
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path) # rename doesn't replace files on Windows
+            os.rename(temp, self.path)
+
+    def clear(self):
+        with self.lock:
+            self._entries = {}
+        self.save()
+
+class Indexer(threading.Thread):
+    """
+    Background thread refreshing LibraryIndex every `interval` seconds, `formats()` returns
+    current (book_id, fmt, path) of library. `on_update(updated)` gets refresh result.
+    """
+
+    def __init__(self, index, formats, interval=INTERVAL, on_update=None, log=None):
+        super(Indexer, self).__init__(name='djvumaker indexer')
+        self.daemon = True
+        self.index = index
+        self.formats = formats
+        self.interval = interval
+        self.on_update = on_update
+        self.log = log
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                updated = self.index.refresh(self.formats(), abort=self.stopped, log=self.log,
+                                             pause=PAUSE)
+                if updated and self.on_update is not None:
+                    self.on_update(updated)
+            except Exception:
+                if self.log is not None:
+                    self.log(traceback.format_exc())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+inflight module for Calibre plugin djvumaker - cross-process registry of conversions in flight
+
+A GUI click, calibre's postimport hook and `convert -i` may start converting the same book at
+once, all of them check for existing DJVU long before one of them adds it. Every conversion
+takes a lock file in a folder shared by all processes, keyed by library, book and fingerprint
+of its source document. Later requests for the same document wait for the lock instead of
+starting another backend and attach to the result: once its DJVU is in the library (batched
+writes may add it later), the owner records it in a `.done` file and releases the lock. When
+the owner fails or its process dies, one of the waiting requests converts the book itself: lock
+of dead process is broken by one waiter at a time, so two waiters never both take it over.
+
+References:
+(#NODOC)
+POLL                      -- seconds between checks of lock held by other job
+DONE_TTL                  -- seconds after which results of finished conversions are forgotten
+inflight_key(library_id, book_id, fingerprint) -- file name safe key of conversion
+InFlight(folder, key)
+  .acquire(abort=None, log=None) -- None if this job converts, else Attached result of other job
+                             (without DJVU if `abort` stopped waiting)
+  .finish(djvu)           -- record result for waiting jobs and release lock
+  .release()              -- release lock without result (conversion failed)
+Attached(djvu, pid)       -- DJVU produced by conversion of process `pid`
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import errno
+import glob
+import json
+import os
+import re
+import time
+
+from calibre_plugins.djvumaker.processes import break_stale_lock, process_alive
+
+POLL = 1
+DONE_TTL = 3600
+
+Attached = collections.namedtuple('Attached', ['djvu', 'pid'])
+
+def inflight_key(library_id, book_id, fingerprint):
+    key = '{}-{}-{}'.format(library_id, book_id, '-'.join('{:.0f}'.format(part)
+                                                           for part in fingerprint))
+    return re.sub(r'[^\w.-]+', '_', key)
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+
+class InFlight(object):
+    """Lock of conversion `key` in `folder`, see module docstring."""
+
+    def __init__(self, folder, key):
+        self.folder = folder
+        self.lock = os.path.join(folder, key + '.lock')
+        self.done = os.path.join(folder, key + '.done')
+        self.owned = False
+
+    def _create(self):
+        try:
+            fd = os.open(self.lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps({'pid' : os.getpid(), 'started' : time.time()}).encode('utf-8'))
+        return True
+
+    def _cleanup(self):
+        now = time.time()
+        for path in glob.glob(os.path.join(self.folder, '*.done')):
+            try:
+                if now - os.path.getmtime(path) > DONE_TTL:
+                    os.remove(path)
+            except EnvironmentError:
+                pass
+
+    def acquire(self, abort=None, log=None):
+        """
+        Take the lock and return None, or wait while other job holds it and return its Attached
+        result. Lock of dead process or of job which failed is taken over. Set `abort` stops
+        waiting, Attached without DJVU is returned then.
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        self._cleanup()
+        waited = None
+        while not self._create():
+            owner = _read(self.lock)
+            if (owner is not None and not process_alive(owner['pid'])
+                    and break_stale_lock(self.lock)):
+                continue # owner was killed, its conversion is lost
+            if waited is None:
+                waited = owner['pid'] if owner is not None else None
+                if log is not None:
+                    log('conversion of the same document is in flight in process {}, waiting for'
+                        ' its result'.format(waited or 'another'))
+            if abort is not None and abort.is_set():
+                return Attached(None, waited)
+            time.sleep(POLL)
+            if not os.path.exists(self.lock):
+                result = _read(self.done)
+                if result is not None:
+                    return Attached(result['djvu'], result['pid'])
+        self.owned = True
+        _remove(self.done) # result of earlier conversion is for its own waiters only
+        return None
+
+    def finish(self, djvu):
+        if not self.owned:
+            return
+        temp = '{}.{}.tmp'.format(self.done, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(json.dumps({'djvu' : djvu, 'pid' : os.getpid()}).encode('utf-8'))
+        if os.name == 'nt' and os.path.exists(self.done):
+            os.remove(self.done) # rename doesn't replace files on Windows
+        os.rename(temp, self.done)
+        self.release()
+
+    def release(self):
+        if self.owned:
+            _remove(self.lock)
+            self.owned = False
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+logcapture module for Calibre plugin djvumaker - memory-bounded capture of backend output
+
+Verbose backends (ghostscript over thousands of pages) print more than calibre's job log
+should hold. LogCapture forwards the first lines of output as they come, keeps only the last
+lines in memory and writes everything to a rotating log file on disk, which path is printed
+in place of omitted lines.
+
+References:
+(#NODOC)
+HEAD_LINES, TAIL_LINES    -- lines forwarded from the beginning and from the end of output
+MAX_LINE                  -- longer lines are cut when forwarded (not in log file)
+MAX_LOG_BYTES, BACKUPS    -- size of log file before rotation, number of rotated files kept
+LOGS_KEPT                 -- number of newest log files kept in logs folder
+log_file(folder, name)    -- path of new log file in folder, prunes old log files
+LogCapture(forward, path=None, head=HEAD_LINES, tail=TAIL_LINES)
+  .line(text)             -- capture one line of output
+  .feed(stream)           -- capture stream line by line
+  .feed_file(path)        -- capture file line by line
+  .close()                -- forward retained tail and close log file
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import glob
+import os
+import re
+import time
+
+HEAD_LINES = 200
+TAIL_LINES = 200
+MAX_LINE = 4096
+MAX_LOG_BYTES = 8 * 1024 * 1024
+BACKUPS = 2
+LOGS_KEPT = 30
+
+def log_file(folder, name):
+    """Return path of new log file `name` in `folder`, remove all but LOGS_KEPT newest ones."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    logs = sorted(glob.glob(os.path.join(folder, '*.log')), key=os.path.getmtime)
+    for path in logs[:max(0, len(logs) - LOGS_KEPT + 1)]:
+        for rotated in [path] + glob.glob(path + '.*'):
+            try:
+                os.remove(rotated)
+            except EnvironmentError:
+                pass
+    name = re.sub(r'[^\w.-]+', '_', name)
+    return os.path.join(folder, '{}-{}.log'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+
+class LogCapture(object):
+    """
+    Forward lines of output to `forward` (i.e. prints), the first `head` lines immediately,
+    the last `tail` lines on close. All lines are written to log file `path` if given.
+    Use as context manager.
+    """
+
+    def __init__(self, forward, path=None, head=HEAD_LINES, tail=TAIL_LINES):
+        self.forward = forward
+        self.path = path
+        self.head = head
+        self.tail = collections.deque(maxlen=tail)
+        self.lines = 0
+        self.log = None
+        if path is not None:
+            try:
+                self.log = open(path, 'ab')
+            except EnvironmentError as err:
+                forward('cannot write log file {}: {}'.format(path, err))
+                self.path = None
+
+    def line(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        text = text.rstrip(b'\r\n')
+        if self.log is not None:
+            self._write(text)
+        self.lines += 1
+        if len(text) > MAX_LINE:
+            text = text[:MAX_LINE] + b' [...]'
+        if self.lines <= self.head:
+            self.forward(text)
+        else:
+            self.tail.append(text)
+
+    def _write(self, text):
+        try:
+            if self.log.tell() > MAX_LOG_BYTES:
+                self._rotate()
+            self.log.write(text + b'\n')
+        except EnvironmentError:
+            self.log = None # keep forwarding output without log file
+
+    def _rotate(self):
+        self.log.close()
+        for index in range(BACKUPS, 0, -1):
+            source = self.path if index == 1 else '{}.{}'.format(self.path, index - 1)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}'.format(self.path, index))
+        self.log = open(self.path, 'ab')
+
+    def feed(self, stream):
+        for text in iter(stream.readline, b''):
+            self.line(text)
+
+    def feed_file(self, path):
+        with open(path, 'rb') as f:
+            self.feed(f)
+
+    def close(self):
+        omitted = self.lines - self.head - len(self.tail)
+        if omitted > 0:
+            self.forward('[{} lines omitted{}]'.format(
+                omitted, ', full log: {}'.format(self.path) if self.path else ''))
+        while self.tail:
+            self.forward(self.tail.popleft())
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+metrics module for Calibre plugin djvumaker - live metrics of running conversions for Prometheus
+
+Metrics are on when DJVUMAKER_METRICS environment variable holds a folder, fork_job workers
+inherit it like tracing. Every process keeps its counters, gauges and histograms in memory and
+writes their snapshot to its own file in that folder at most every WRITE_INTERVAL seconds (and
+when it exits). Snapshots of all processes are merged: counters and histograms of every process
+count, gauges only of running ones, totals of exited processes are folded into `retired.json`.
+The merge is written in Prometheus text format to `djvumaker.prom` in the folder (or to the file
+in DJVUMAKER_METRICS_TEXTFILE, i.e. in node_exporter's textfile collector folder), and served by
+optional MetricsServer on localhost. Pages per second are pages of all processes converted in the
+last RATE_WINDOW seconds, so an alert can fire on a stalled run while books are queued.
+
+References:
+(#NODOC)
+METRICS_ENV, TEXTFILE_ENV -- environment variables turning metrics on, path of text file
+WRITE_INTERVAL            -- seconds between snapshots of one process
+RATE_WINDOW               -- seconds of throughput averaged in pages per second
+LATENCY_BUCKETS           -- upper bounds in seconds of conversion latency histogram
+DEFINITIONS               -- name -> (type, help) of every exposed metric
+enabled()                 -- whether metrics are on in this process
+enable(folder, textfile=None) -- turn metrics on for this process and its children
+disable()
+metrics_env()             -- environment variables for fork_job workers
+inc(name, value=1, **labels) -- increase counter
+add(name, delta, **labels) -- change gauge
+observe(name, value, **labels) -- add observation to histogram
+track(name, function)     -- gauge read from `function()` on every snapshot
+tracked(name, **labels)   -- context of gauge increased inside it
+flush()                   -- write snapshot of this process and merged text file now
+collect(folder)           -- merged snapshots of all processes
+render(merged)            -- Prometheus text format of merged snapshots
+MetricsServer(port, folder, host='127.0.0.1') -- HTTP server of /metrics
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import atexit
+import BaseHTTPServer
+import collections
+import errno
+import glob
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from calibre_plugins.djvumaker.processes import break_stale_lock, process_alive
+
+METRICS_ENV = 'DJVUMAKER_METRICS'
+TEXTFILE_ENV = 'DJVUMAKER_METRICS_TEXTFILE'
+WRITE_INTERVAL = 5
+RATE_WINDOW = 60
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+DEFINITIONS = collections.OrderedDict((name, (kind, text)) for name, kind, text in [
+    ('djvumaker_queue_depth', 'gauge', 'Books waiting for a conversion slot.'),
+    ('djvumaker_conversions_in_progress', 'gauge', 'Books dispatched and not finished yet.'),
+    ('djvumaker_backend_processes', 'gauge', 'Backend commands and pipelines running.'),
+    ('djvumaker_pages_per_second', 'gauge',
+     'Pages converted per second over the last {} seconds.'.format(RATE_WINDOW)),
+    ('djvumaker_pages_converted_total', 'counter', 'Pages of finished conversions.'),
+    ('djvumaker_input_bytes_total', 'counter', 'Bytes of converted source documents.'),
+    ('djvumaker_output_bytes_total', 'counter', 'Bytes of produced DJVU documents.'),
+    ('djvumaker_conversions_total', 'counter', 'Finished conversions.'),
+    ('djvumaker_failures_total', 'counter', 'Failed conversions by reason.'),
+    ('djvumaker_conversion_seconds', 'histogram', 'Wall time of backend conversions.'),
+])
+RATES = {'djvumaker_pages_per_second' : 'djvumaker_pages_converted_total'}
+
+def enabled():
+    return bool(os.environ.get(METRICS_ENV))
+
+def enable(folder, textfile=None):
+    """Turn metrics on, processes started from now on inherit it."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    os.environ[METRICS_ENV] = folder
+    if textfile:
+        os.environ[TEXTFILE_ENV] = textfile
+    else:
+        os.environ.pop(TEXTFILE_ENV, None)
+
+def disable():
+    os.environ.pop(METRICS_ENV, None)
+    os.environ.pop(TEXTFILE_ENV, None)
+
+def metrics_env():
+    """Metrics variables to pass as `env` of fork_job, empty if metrics are off."""
+    return {key : os.environ[key] for key in (METRICS_ENV, TEXTFILE_ENV) if os.environ.get(key)}
+
+def _key(name, labels):
+    return json.dumps([name, sorted((key, '{}'.format(value)) for key, value in labels.items())])
+
+def _empty():
+    return {'counters' : {}, 'gauges' : {}, 'histograms' : {}, 'recent' : {}}
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+
+def _write(path, data):
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(data)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path) # rename doesn't replace files on Windows
+    os.rename(temp, path)
+
+def _merge(into, snapshot, gauges=True, now=None):
+    """Add `snapshot` into merged snapshot `into`, gauges only if `gauges`."""
+    now = now or time.time()
+    for key, value in snapshot.get('counters', {}).items():
+        into['counters'][key] = into['counters'].get(key, 0) + value
+    if gauges:
+        for key, value in snapshot.get('gauges', {}).items():
+            into['gauges'][key] = into['gauges'].get(key, 0) + value
+    for key, buckets in snapshot.get('histograms', {}).items():
+        known = into['histograms'].get(key)
+        into['histograms'][key] = [a + b for a, b in zip(known, buckets)] if known else buckets
+    for key, events in snapshot.get('recent', {}).items():
+        into['recent'].setdefault(key, []).extend(event for event in events
+                                                  if now - event[0] <= RATE_WINDOW)
+    return into
+
+class Registry(object):
+    """Metrics of this process, see module docstring. Thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = _empty()
+        self.functions = {}
+        self.dirty = False
+        self.started = int(time.time())
+        self.writer = None
+
+    def _changed(self):
+        self.dirty = True
+        if self.writer is None and enabled():
+            self.writer = threading.Thread(target=self._write_loop, name='djvumaker metrics')
+            self.writer.daemon = True
+            self.writer.start()
+            atexit.register(self.flush)
+
+    def _write_loop(self):
+        while True:
+            time.sleep(WRITE_INTERVAL)
+            if self.dirty or self.functions:
+                self.flush()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.data['counters'][key] = self.data['counters'].get(key, 0) + value
+            if name in RATES.values():
+                self.data['recent'].setdefault(key, []).append([time.time(), value])
+            self._changed()
+
+    def add(self, name, delta, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.data['gauges'][key] = self.data['gauges'].get(key, 0) + delta
+            self._changed()
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            buckets = self.data['histograms'].setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            buckets[-2] += value # sum
+            buckets[-1] += 1 # count, also the +Inf bucket
+            self._changed()
+
+    def track(self, name, function):
+        with self.lock:
+            self.functions[_key(name, {})] = function
+            self._changed()
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            for key, events in self.data['recent'].items():
+                self.data['recent'][key] = [event for event in events
+                                            if now - event[0] <= RATE_WINDOW]
+            snapshot = json.loads(json.dumps(self.data))
+            functions = list(self.functions.items())
+            self.dirty = False
+        for key, function in functions:
+            try:
+                snapshot['gauges'][key] = snapshot['gauges'].get(key, 0) + function()
+            except Exception:
+                pass # metrics must never break conversion
+        return snapshot
+
+    def flush(self):
+        folder = os.environ.get(METRICS_ENV)
+        if not folder:
+            return
+        try:
+            path = os.path.join(folder, 'process-{}-{}.json'.format(os.getpid(), self.started))
+            _write(path, json.dumps(self.snapshot()).encode('utf-8'))
+            text = render(collect(folder))
+            _write(os.environ.get(TEXTFILE_ENV) or os.path.join(folder, 'djvumaker.prom'),
+                   text.encode('utf-8'))
+        except EnvironmentError:
+            pass # metrics must never break conversion
+
+_registry = Registry()
+
+def inc(name, value=1, **labels):
+    if enabled():
+        _registry.inc(name, value, **labels)
+
+def add(name, delta, **labels):
+    if enabled():
+        _registry.add(name, delta, **labels)
+
+def observe(name, value, **labels):
+    if enabled():
+        _registry.observe(name, value, **labels)
+
+def track(name, function):
+    if enabled():
+        _registry.track(name, function)
+
+@contextmanager
+def tracked(name, **labels):
+    add(name, 1, **labels)
+    try:
+        yield
+    finally:
+        add(name, -1, **labels)
+
+def flush():
+    _registry.flush()
+
+def _fold(folder, exited, now):
+    """Fold snapshots of exited processes into retired.json, unless other process does it."""
+    lock = os.path.join(folder, 'retired.lock')
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        break_stale_lock(lock) # folding process was killed, next collect folds
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(os.getpid()).encode('utf-8'))
+        retired = os.path.join(folder, 'retired.json')
+        merged = _merge(_empty(), _read(retired) or {}, gauges=False, now=now)
+        folded = []
+        for path in exited:
+            # read again under the lock, other process may have folded it since collect read it
+            snapshot = _read(path)
+            if snapshot is not None:
+                _merge(merged, snapshot, gauges=False, now=now)
+                folded.append(path)
+        if not folded:
+            return
+        _write(retired, json.dumps(merged).encode('utf-8'))
+        for path in folded:
+            os.remove(path)
+    finally:
+        os.remove(lock)
+
+def collect(folder):
+    """Merge snapshots of all processes, see module docstring."""
+    now = time.time()
+    merged = _merge(_empty(), _read(os.path.join(folder, 'retired.json')) or {}, gauges=False,
+                    now=now)
+    exited = []
+    for path in glob.glob(os.path.join(folder, 'process-*.json')):
+        match = re.search(r'process-(\d+)-\d+\.json$', path)
+        snapshot = _read(path)
+        if match is None or snapshot is None:
+            continue
+        running = process_alive(int(match.group(1)))
+        _merge(merged, snapshot, gauges=running, now=now)
+        if not running:
+            exited.append(path)
+    if exited:
+        try:
+            _fold(folder, exited, now)
+        except EnvironmentError:
+            pass # folded next time
+    return merged
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample(name, labels, value):
+    labels = ','.join('{}="{}"'.format(key, _escape(label)) for key, label in labels)
+    return '{}{} {}'.format(name, '{' + labels + '}' if labels else '', repr(float(value)))
+
+def render(merged):
+    """Prometheus text exposition format of merged snapshots."""
+    samples = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for key, value in merged[kind].items():
+            name, labels = json.loads(key)
+            samples.setdefault(name, []).append((labels, value))
+    for rate, source in RATES.items():
+        events = [event for key, recent in merged['recent'].items()
+                  if json.loads(key)[0] == source for event in recent]
+        samples[rate] = [([], sum(value for _, value in events) / RATE_WINDOW)]
+    lines = []
+    for name, (kind, text) in DEFINITIONS.items():
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        values = sorted(samples.get(name, []))
+        if not values and kind == 'gauge':
+            values = [([], 0)]
+        for labels, value in values:
+            if kind != 'histogram':
+                lines.append(_sample(name, labels, value))
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                lines.append(_sample(name + '_bucket', labels + [['le', '{}'.format(bound)]],
+                                     count))
+            lines.append(_sample(name + '_bucket', labels + [['le', '+Inf']], value[-1]))
+            lines.append(_sample(name + '_sum', labels, value[-2]))
+            lines.append(_sample(name + '_count', labels, value[-1]))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render(collect(self.server.folder)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes every few seconds would flood calibre's output
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """HTTP server of merged metrics of all processes on `host`:`port`, run .start() to serve."""
+    allow_reuse_address = True
+
+    def __init__(self, port, folder, host='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.folder = folder
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='djvumaker metrics server')
+        thread.daemon = True
+        thread.start()
+        return thread
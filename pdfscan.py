@@ -0,0 +1,1017 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pdfscan module for Calibre plugin djvumaker - lightweight reading of PDF document structure
+
+Podofo bindings shipped with Calibre expose only document-wide numbers (page count, image count),
+so this module reads page tree, page resources and content streams of PDF files by itself,
+using only python2.7 builtins. Objects are located through the cross-reference table (or stream),
+so inspecting a page costs the same for 10 and 10000 pages long documents. Broken cross-reference
+tables fall back to scanning the whole file for objects.
+
+References:
+(#NODOC)
+--- Errors ---
+PDFScanError(Exception)   -- document cannot be read by this module
+
+--- PDF objects ---
+Name(str)                 -- PDF name object, i.e.: /Image -> Name('Image')
+Ref(num, gen)             -- indirect reference, i.e.: 12 0 R
+Stream(dict, doc, offset, length)
+  .raw()                  -- undecoded stream data
+  .decoded()              -- stream data with supported filters applied
+
+--- Document ---
+PDFDocument(path)
+  .get(obj)               -- resolve indirect reference
+  .page_count()           -- number of pages from page tree root
+  .page(index)            -- one PDFPage, walks page tree using /Count of subtrees
+  .pages()                -- generator of all PDFPages
+  .close()
+PDFPage(doc, index, pagedict, inherited)
+  .size                   -- (width, height) of MediaBox in PostScript points
+  .contents()             -- decoded content stream(s)
+  .xobjects()             -- dict XObject name -> (Ref or None, Stream)
+  .analyze()              -- PageStats of page's content stream
+PageStats                 -- image coverage, text and painting operators of a page
+
+--- Raster detection ---
+DocumentProfile(raster, confidence, page_count, sampled, raster_pages, images, encodings, dpi)
+sample_indices(page_count, samples)  -- pages spread evenly over the document
+is_raster_page(stats)                -- whether PageStats describe a scanned page
+profile_document(path, samples=RASTER_SAMPLES) -- sample pages to tell scans from authored PDFs
+
+--- Page plans ---
+PageKey(key, size, blank)           -- content identity of a page
+scan_pages(path, stable=False)      -- PageKey of every page
+PagePlan(sources, blanks, sizes)    -- which pages have to be encoded and which are redundant
+plan_distinct_pages(path, log=None) -- find duplicate and blank pages of a document
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import hashlib
+import mmap
+import re
+import zlib
+
+class PDFScanError(Exception):
+    """Document structure cannot be read by pdfscan."""
+    pass
+
+class Name(str):
+    """PDF name object."""
+    pass
+
+class Keyword(str):
+    """PDF keyword or content stream operator."""
+    pass
+
+Ref = collections.namedtuple('Ref', ['num', 'gen'])
+
+_WS = b'\x00\t\n\x0c\r '
+_REGULAR = br'[^\x00\t\n\x0c\r ()<>\[\]{}/%]'
+_TOKEN_RE = re.compile(br'''
+      (?P<ws>(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)+)
+    | (?P<num>[+-]?(?:\d+\.?\d*|\.\d+)(?!''' + _REGULAR + br'''))
+    | (?P<name>/''' + _REGULAR + br'''*)
+    | (?P<dictopen><<)
+    | (?P<dictclose>>>)
+    | (?P<hex><[0-9A-Fa-f\x00\t\n\x0c\r ]*>)
+    | (?P<arropen>\[)
+    | (?P<arrclose>\])
+    | (?P<brace>[{}])
+    | (?P<str>\()
+    | (?P<kw>''' + _REGULAR + br'''+)
+''', re.VERBOSE)
+_NAME_ESCAPE_RE = re.compile(br'#([0-9A-Fa-f]{2})')
+_OBJ_HEADER_RE = re.compile(br'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj')
+_OBJ_SCAN_RE = re.compile(br'(?<!\d)(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj(?!'
+                          + _REGULAR + br')')
+_XREF_SUBSECTION_RE = re.compile(br'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]*')
+_XREF_ENTRY_RE = re.compile(br'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+([nf])')
+
+INHERITABLE = ('Resources', 'MediaBox', 'CropBox', 'Rotate')
+TEXT_OPERATORS = frozenset([b'Tj', b'TJ', b"'", b'"'])
+PAINT_OPERATORS = frozenset([b'S', b's', b'f', b'F', b'f*', b'B', b'B*', b'b', b'b*', b'sh'])
+BILEVEL_FILTERS = frozenset(['CCITTFaxDecode', 'JBIG2Decode'])
+BLANK_IMAGE_MAX_BYTES = 4 * 1024 * 1024 # larger decoded images are never checked for ink
+BLANK_CONTENT_MAX = 4096 # content streams longer than this are never treated as blank
+RASTER_SAMPLES = 16 # pages sampled to tell scans from digitally authored documents
+RASTER_COVERAGE = 0.5 # page is a scan when images cover this share of it...
+RASTER_MAX_TEXT_OPS = 10 # ...and it draws at most this many visible text operators,
+RASTER_FULL_COVERAGE = 0.9 # or when images cover almost whole page whatever text it has
+RASTER_PAGES_SHARE = 0.5 # document is a scan when this share of sampled pages are scans
+
+
+class _Lexer(object):
+    """Tokenizer and object parser working directly on (mmaped) document data."""
+
+    def __init__(self, data, pos=0, doc=None):
+        self.data = data
+        self.pos = pos
+        self.doc = doc
+
+    def token(self):
+        """Return next (kind, value) token, (None, None) at the end of data."""
+        while True:
+            match = _TOKEN_RE.match(self.data, self.pos)
+            if match is None:
+                if self.pos >= len(self.data):
+                    return None, None
+                raise PDFScanError('Unexpected character at offset {}'.format(self.pos))
+            kind = match.lastgroup
+            self.pos = match.end()
+            if kind == 'ws':
+                continue
+            if kind == 'str':
+                return 'str', self._literal_string()
+            return kind, match.group()
+
+    def _literal_string(self):
+        """Read literal string after opening parenthesis, nested parentheses are balanced."""
+        depth, start, data = 1, self.pos, self.data
+        pos = start
+        while depth:
+            if pos >= len(data):
+                raise PDFScanError('Unterminated string at offset {}'.format(start))
+            char = data[pos]
+            if char == b'\\':
+                pos += 1
+            elif char == b'(':
+                depth += 1
+            elif char == b')':
+                depth -= 1
+            pos += 1
+        self.pos = pos
+        return data[start:pos - 1]
+
+    def parse(self):
+        """Parse one object from current position."""
+        kind, value = self.token()
+        return self._object(kind, value)
+
+    def _object(self, kind, value):
+        if kind == 'num':
+            if b'.' not in value:
+                # integer can be the start of an indirect reference: `num gen R`
+                save = self.pos
+                kind2, value2 = self.token()
+                if kind2 == 'num' and b'.' not in value2:
+                    kind3, value3 = self.token()
+                    if kind3 == 'kw' and value3 == b'R':
+                        return Ref(int(value), int(value2))
+                self.pos = save
+                return int(value)
+            return float(value)
+        if kind == 'name':
+            return Name(_NAME_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), value[1:]))
+        if kind == 'dictopen':
+            result = {}
+            while True:
+                kind, value = self.token()
+                if kind == 'dictclose' or kind is None:
+                    break
+                key = self._object(kind, value)
+                result[key] = self.parse()
+            return result
+        if kind == 'arropen':
+            result = []
+            while True:
+                kind, value = self.token()
+                if kind == 'arrclose' or kind is None:
+                    break
+                result.append(self._object(kind, value))
+            return result
+        if kind == 'hex':
+            digits = re.sub(br'[^0-9A-Fa-f]', b'', value[1:-1])
+            if len(digits) % 2:
+                digits += b'0'
+            return digits.decode('hex')
+        if kind == 'str':
+            return value
+        if kind == 'kw':
+            if value == b'true':
+                return True
+            if value == b'false':
+                return False
+            if value == b'null':
+                return None
+            return Keyword(value)
+        if kind is None:
+            raise PDFScanError('Unexpected end of data')
+        return Keyword(value)
+
+    def parse_indirect(self, expected=None):
+        """Parse `num gen obj ... endobj` at current position, return (num, object)."""
+        match = _OBJ_HEADER_RE.match(self.data, self.pos)
+        if match is None:
+            raise PDFScanError('No object at offset {}'.format(self.pos))
+        num = int(match.group(1))
+        if expected is not None and num != expected:
+            raise PDFScanError('Object {} expected at offset {}, found {}'.format(
+                expected, self.pos, num))
+        self.pos = match.end()
+        obj = self.parse()
+        if isinstance(obj, dict):
+            save = self.pos
+            kind, value = self.token()
+            if kind == 'kw' and value == b'stream':
+                obj = self._stream(obj)
+            else:
+                self.pos = save
+        return num, obj
+
+    def _stream(self, streamdict):
+        data = self.data
+        start = self.pos
+        if data[start:start + 2] == b'\r\n':
+            start += 2
+        elif data[start:start + 1] in (b'\n', b'\r'):
+            start += 1
+        length = streamdict.get('Length')
+        if isinstance(length, Ref) and self.doc is not None:
+            try:
+                length = self.doc.get(length)
+            except PDFScanError:
+                length = None
+        if not isinstance(length, (int, long)) or length < 0 or \
+                data[start + length:start + length + 30].find(b'endstream') < 0:
+            # wrong /Length, which is common, find the end of stream by keyword
+            end = data.find(b'endstream', start)
+            if end < 0:
+                raise PDFScanError('Unterminated stream at offset {}'.format(start))
+            length = end - start
+            while length > 0 and data[start + length - 1] in _WS:
+                length -= 1
+        self.pos = start + length
+        return Stream(streamdict, self.doc, start, length)
+
+
+class Stream(object):
+    """PDF stream object, data is read lazily from document."""
+
+    def __init__(self, streamdict, doc, offset, length):
+        self.dict = streamdict
+        self.doc = doc
+        self.offset = offset
+        self.length = length
+
+    def get(self, key, default=None):
+        value = self.dict.get(key, default)
+        if isinstance(value, Ref) and self.doc is not None:
+            value = self.doc.get(value)
+        return value
+
+    def raw(self):
+        return self.doc.data[self.offset:self.offset + self.length]
+
+    def filters(self):
+        """List of filter names together with their decode parameters."""
+        filters = self.get('Filter') or []
+        params = self.get('DecodeParms') or self.get('DP')
+        if not isinstance(filters, list):
+            filters = [filters]
+        if not isinstance(params, list):
+            params = [params] * len(filters)
+        params = [self.doc.get(param) if isinstance(param, Ref) else param for param in params]
+        params += [None] * (len(filters) - len(params))
+        return list(zip([self.doc.get(f) if isinstance(f, Ref) else f for f in filters], params))
+
+    def decoded(self):
+        data = self.raw()
+        for name, params in self.filters():
+            data = _decode(data, name, params or {})
+        return data
+
+
+def _decode(data, name, params):
+    if name in ('FlateDecode', 'Fl'):
+        try:
+            data = zlib.decompressobj().decompress(data)
+        except zlib.error as err:
+            raise PDFScanError('Corrupted FlateDecode stream: {}'.format(err))
+        return _predictor(data, params)
+    if name in ('LZWDecode', 'LZW'):
+        return _predictor(_lzw_decode(data), params)
+    if name in ('ASCIIHexDecode', 'AHx'):
+        digits = re.sub(br'[^0-9A-Fa-f]', b'', data.split(b'>')[0])
+        if len(digits) % 2:
+            digits += b'0'
+        return digits.decode('hex')
+    if name in ('ASCII85Decode', 'A85'):
+        return _ascii85_decode(data)
+    raise PDFScanError('Unsupported filter {}'.format(name))
+
+def _predictor(data, params):
+    predictor = params.get('Predictor', 1)
+    if predictor < 10:
+        return data
+    columns = params.get('Columns', 1)
+    colors = params.get('Colors', 1)
+    bpc = params.get('BitsPerComponent', 8)
+    bpp = max(1, colors * bpc // 8)
+    rowlen = (columns * colors * bpc + 7) // 8
+    out = []
+    previous = bytearray(rowlen)
+    for start in range(0, len(data) - rowlen, rowlen + 1):
+        kind = ord(data[start])
+        row = bytearray(data[start + 1:start + 1 + rowlen])
+        if kind == 1:
+            for i in range(bpp, len(row)):
+                row[i] = (row[i] + row[i - bpp]) & 0xff
+        elif kind == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in range(len(row)):
+                left = row[i - bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(len(row)):
+                left = row[i - bpp] if i >= bpp else 0
+                upleft = previous[i - bpp] if i >= bpp else 0
+                estimate = left + previous[i] - upleft
+                pa, pb, pc = abs(estimate - left), abs(estimate - previous[i]), abs(estimate - upleft)
+                if pa <= pb and pa <= pc:
+                    row[i] = (row[i] + left) & 0xff
+                elif pb <= pc:
+                    row[i] = (row[i] + previous[i]) & 0xff
+                else:
+                    row[i] = (row[i] + upleft) & 0xff
+        out.append(bytes(row))
+        previous = row
+    return b''.join(out)
+
+def _lzw_decode(data):
+    out, table = [], [chr(i) for i in range(256)] + [None, None]
+    bits, buf, nbits, previous = 9, 0, 0, None
+    for char in data:
+        buf = (buf << 8) | ord(char)
+        nbits += 8
+        while nbits >= bits:
+            nbits -= bits
+            code = (buf >> nbits) & ((1 << bits) - 1)
+            if code == 256:
+                table, bits, previous = table[:258], 9, None
+                continue
+            if code == 257:
+                return b''.join(out)
+            if previous is None:
+                entry = table[code]
+            elif code < len(table):
+                entry = table[code]
+                table.append(previous + entry[0])
+            else:
+                entry = previous + previous[0]
+                table.append(entry)
+            out.append(entry)
+            previous = entry
+            if len(table) + 1 >= (1 << bits) and bits < 12:
+                bits += 1
+    return b''.join(out)
+
+def _ascii85_decode(data):
+    data = re.sub(br'[\x00\t\n\x0c\r ]', b'', data)
+    if data.startswith(b'<~'):
+        data = data[2:]
+    data = data.split(b'~>')[0].replace(b'z', b'!!!!!')
+    out = []
+    for start in range(0, len(data), 5):
+        group = data[start:start + 5]
+        padding = 5 - len(group)
+        value = 0
+        for char in group + b'u' * padding:
+            value = value * 85 + ord(char) - 33
+        chunk = bytearray(4)
+        for i in range(4):
+            chunk[3 - i] = (value >> (8 * i)) & 0xff
+        out.append(bytes(chunk[:4 - padding]))
+    return b''.join(out)
+
+
+class PDFDocument(object):
+    """Read-only, lazily parsed PDF document."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError) as err:
+            self._file.close()
+            raise PDFScanError('Cannot map {}: {}'.format(path, err))
+        self._xref = {}
+        self._cache = {}
+        self._objstm = {}
+        self.trailer = None
+        try:
+            self._read_xref()
+            self.root = self.get(self.trailer['Root'])
+            if not isinstance(self.root, dict):
+                raise PDFScanError('Missing document catalog')
+        except (PDFScanError, KeyError, ValueError, IndexError, TypeError):
+            self._scan_objects()
+
+    def close(self):
+        self._cache = {}
+        self._objstm = {}
+        self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # -- cross reference --
+    def _read_xref(self):
+        tail_start = max(0, len(self.data) - 2048)
+        tail = self.data[tail_start:]
+        idx = tail.rfind(b'startxref')
+        if idx < 0:
+            raise PDFScanError('No startxref')
+        offset = int(tail[idx + 9:].split()[0])
+        seen = set()
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            lexer = _Lexer(self.data, offset, self)
+            kind, value = lexer.token()
+            if kind == 'kw' and value == b'xref':
+                trailer = self._read_xref_table(lexer)
+                if isinstance(trailer.get('XRefStm'), (int, long)):
+                    self._read_xref_stream(trailer['XRefStm'])
+            else:
+                trailer = self._read_xref_stream(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            offset = trailer.get('Prev')
+
+    def _read_xref_table(self, lexer):
+        data, pos = self.data, lexer.pos
+        while True:
+            match = _XREF_SUBSECTION_RE.match(data, pos)
+            if match is None:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            pos = match.end()
+            for num in range(first, first + count):
+                entry = _XREF_ENTRY_RE.match(data, pos)
+                if entry is None:
+                    raise PDFScanError('Broken xref table at offset {}'.format(pos))
+                pos = entry.end()
+                if entry.group(3) == b'n':
+                    self._xref.setdefault(num, ('o', int(entry.group(1))))
+                else:
+                    self._xref.setdefault(num, None)
+        lexer.pos = pos
+        kind, value = lexer.token()
+        if kind != 'kw' or value != b'trailer':
+            raise PDFScanError('Missing trailer')
+        return lexer.parse()
+
+    def _read_xref_stream(self, offset):
+        _, stream = _Lexer(self.data, offset, self).parse_indirect()
+        if not isinstance(stream, Stream) or stream.get('Type') != 'XRef':
+            raise PDFScanError('No xref stream at offset {}'.format(offset))
+        widths = stream.get('W')
+        index = stream.get('Index') or [0, stream.get('Size')]
+        data = stream.decoded()
+        pos = 0
+        for section in range(0, len(index) - 1, 2):
+            first, count = index[section], index[section + 1]
+            for num in range(first, first + count):
+                fields = []
+                for width in widths:
+                    value = 0
+                    for char in data[pos:pos + width]:
+                        value = (value << 8) | ord(char)
+                    fields.append(value)
+                    pos += width
+                if widths[0] == 0:
+                    fields[0] = 1
+                if pos > len(data):
+                    break
+                if fields[0] == 1:
+                    self._xref.setdefault(num, ('o', fields[1]))
+                elif fields[0] == 2:
+                    self._xref.setdefault(num, ('s', fields[1], fields[2]))
+                else:
+                    self._xref.setdefault(num, None)
+        return stream.dict
+
+    def _scan_objects(self):
+        """Fallback for broken cross reference, finds all objects by reading the whole file."""
+        self._xref, self._cache, self._objstm = {}, {}, {}
+        for match in _OBJ_SCAN_RE.finditer(self.data):
+            # later objects win, like incremental updates
+            self._xref[int(match.group(1))] = ('o', match.start())
+        trailer_pos = self.data.rfind(b'trailer')
+        trailer = None
+        if trailer_pos >= 0:
+            try:
+                trailer = _Lexer(self.data, trailer_pos + 7, self).parse()
+            except PDFScanError:
+                trailer = None
+        objstms = []
+        for num, entry in list(self._xref.items()):
+            try:
+                obj = self.get(Ref(num, 0))
+            except PDFScanError:
+                continue
+            if isinstance(obj, Stream) and obj.get('Type') == 'ObjStm':
+                objstms.append(num)
+            elif isinstance(obj, Stream) and obj.get('Type') == 'XRef' and trailer is None:
+                trailer = obj.dict
+        for stm in objstms:
+            try:
+                for idx, num in enumerate(self._objstm_header(stm)[0]):
+                    self._xref.setdefault(num, ('s', stm, idx))
+            except PDFScanError:
+                continue
+        root = trailer.get('Root') if isinstance(trailer, dict) else None
+        if root is None:
+            for num in self._xref:
+                try:
+                    obj = self.get(Ref(num, 0))
+                except PDFScanError:
+                    continue
+                if isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                    root = Ref(num, 0)
+                    break
+        if root is None:
+            raise PDFScanError('Cannot find document catalog of {}'.format(self.path))
+        self.trailer = trailer if isinstance(trailer, dict) else {'Root' : root}
+        self.root = self.get(root)
+
+    # -- objects --
+    def get(self, obj):
+        """Resolve indirect reference, other objects are returned unchanged."""
+        if not isinstance(obj, Ref):
+            return obj
+        if obj.num in self._cache:
+            return self._cache[obj.num]
+        entry = self._xref.get(obj.num)
+        if entry is None:
+            result = None
+        elif entry[0] == 'o':
+            _, result = _Lexer(self.data, entry[1], self).parse_indirect(obj.num)
+        else:
+            nums, offsets, content = self._objstm_header(entry[1])
+            idx = entry[2]
+            if idx >= len(nums) or nums[idx] != obj.num:
+                if obj.num not in nums:
+                    raise PDFScanError('Object {} not in object stream {}'.format(obj.num, entry[1]))
+                idx = nums.index(obj.num)
+            result = _Lexer(content, offsets[idx], self).parse()
+        self._cache[obj.num] = result
+        return result
+
+    def _objstm_header(self, num):
+        if num not in self._objstm:
+            stream = self.get(Ref(num, 0))
+            if not isinstance(stream, Stream):
+                raise PDFScanError('Object {} is not an object stream'.format(num))
+            content = stream.decoded()
+            first = stream.get('First')
+            header = content[:first].split()
+            nums = [int(x) for x in header[0::2]]
+            offsets = [first + int(x) for x in header[1::2]]
+            self._objstm[num] = (nums, offsets, content)
+        return self._objstm[num]
+
+    # -- pages --
+    def _pages_root(self):
+        pages = self.get(self.root.get('Pages'))
+        if not isinstance(pages, dict):
+            raise PDFScanError('Missing page tree')
+        return pages
+
+    def page_count(self):
+        count = self.get(self._pages_root().get('Count'))
+        if not isinstance(count, (int, long)):
+            raise PDFScanError('Missing page count')
+        return count
+
+    def page(self, index):
+        """Return page with 0-based `index`, only the branches of page tree leading to it are read."""
+        node, inherited = self._pages_root(), {}
+        base = 0
+        for _ in range(64): # depth limit, guards against cyclic trees
+            inherited = _inherit(node, inherited, self)
+            for kid in node.get('Kids') or []:
+                kid = self.get(kid)
+                if not isinstance(kid, dict):
+                    continue
+                if kid.get('Type') == 'Pages' or 'Kids' in kid:
+                    count = self.get(kid.get('Count')) or 0
+                    if index < base + count:
+                        node = kid
+                        break
+                    base += count
+                else:
+                    if base == index:
+                        return PDFPage(self, index, kid, inherited)
+                    base += 1
+            else:
+                raise PDFScanError('Page {} not found'.format(index))
+        raise PDFScanError('Page tree too deep')
+
+    def pages(self):
+        """Yield every page in document order."""
+        index = [0]
+        def walk(node, inherited, depth):
+            if depth > 64:
+                raise PDFScanError('Page tree too deep')
+            inherited = _inherit(node, inherited, self)
+            for kid in node.get('Kids') or []:
+                kid = self.get(kid)
+                if not isinstance(kid, dict):
+                    continue
+                if kid.get('Type') == 'Pages' or 'Kids' in kid:
+                    for page in walk(kid, inherited, depth + 1):
+                        yield page
+                else:
+                    yield PDFPage(self, index[0], kid, inherited)
+                    index[0] += 1
+        return walk(self._pages_root(), {}, 0)
+
+def _inherit(node, inherited, doc):
+    result = dict(inherited)
+    for key in INHERITABLE:
+        if key in node:
+            result[key] = doc.get(node[key])
+    return result
+
+
+PageStats = collections.namedtuple('PageStats', ['image_coverage', 'images', 'text_ops',
+                                                 'paint_ops', 'image_streams', 'hidden_text_ops'])
+
+class PDFPage(object):
+    """One page of PDFDocument together with attributes inherited from page tree."""
+
+    def __init__(self, doc, index, pagedict, inherited):
+        self.doc = doc
+        self.index = index
+        self.dict = pagedict
+        attrs = _inherit(pagedict, inherited, doc)
+        self.resources = attrs.get('Resources') or {}
+        self.rotate = attrs.get('Rotate') or 0
+        box = attrs.get('MediaBox') or [0, 0, 612, 792]
+        try:
+            box = [float(doc.get(x)) for x in box]
+            self.mediabox = (min(box[0], box[2]), min(box[1], box[3]),
+                             max(box[0], box[2]), max(box[1], box[3]))
+        except (TypeError, ValueError, IndexError):
+            self.mediabox = (0.0, 0.0, 612.0, 792.0)
+
+    @property
+    def size(self):
+        return self.mediabox[2] - self.mediabox[0], self.mediabox[3] - self.mediabox[1]
+
+    def contents(self):
+        contents = self.doc.get(self.dict.get('Contents'))
+        if contents is None:
+            return b''
+        if not isinstance(contents, list):
+            contents = [contents]
+        parts = []
+        for part in contents:
+            part = self.doc.get(part)
+            if isinstance(part, Stream):
+                parts.append(part.decoded())
+        return b'\n'.join(parts)
+
+    def xobjects(self, resources=None):
+        resources = self.resources if resources is None else resources
+        xobjects = self.doc.get(resources.get('XObject')) or {}
+        result = {}
+        for name, ref in xobjects.items():
+            stream = self.doc.get(ref)
+            if isinstance(stream, Stream):
+                result[name] = (ref if isinstance(ref, Ref) else None, stream)
+        return result
+
+    def analyze(self, max_depth=3):
+        """
+        Interpret page content stream to measure fraction of page area covered by images,
+        number of drawn images, text drawing operators and vector painting operators.
+        Text drawn in invisible rendering mode (OCR layer of scans) is counted separately.
+        """
+        stats = {'area' : 0.0, 'images' : 0, 'text' : 0, 'paint' : 0, 'streams' : [], 'hidden' : 0}
+        self._interpret(self.contents(), (1, 0, 0, 1, 0, 0), self.resources, stats, max_depth)
+        width, height = self.size
+        coverage = min(1.0, stats['area'] / (width * height)) if width * height > 0 else 0.0
+        return PageStats(coverage, stats['images'], stats['text'], stats['paint'],
+                         stats['streams'], stats['hidden'])
+
+    def _interpret(self, content, ctm, resources, stats, depth):
+        lexer = _Lexer(content)
+        stack, operands = [], []
+        xobjects = None
+        render_mode = 0
+        while True:
+            try:
+                kind, value = lexer.token()
+            except PDFScanError:
+                break # garbage in content stream, stop like viewers do
+            if kind is None:
+                break
+            if kind != 'kw':
+                try:
+                    operands.append(lexer._object(kind, value))
+                except PDFScanError:
+                    break
+                continue
+            if value == b'q':
+                stack.append((ctm, render_mode))
+            elif value == b'Q':
+                ctm, render_mode = stack.pop() if stack else (ctm, render_mode)
+            elif value == b'Tr':
+                if operands and isinstance(operands[-1], (int, long)):
+                    render_mode = operands[-1]
+            elif value == b'cm':
+                if len(operands) >= 6 and all(isinstance(x, (int, long, float))
+                                              for x in operands[-6:]):
+                    ctm = _multiply(operands[-6:], ctm)
+            elif value == b'Do':
+                if xobjects is None:
+                    xobjects = self.xobjects(resources)
+                if operands and operands[-1] in xobjects:
+                    _, stream = xobjects[operands[-1]]
+                    subtype = stream.get('Subtype')
+                    if subtype == 'Image':
+                        self._add_image(stats, ctm)
+                        stats['streams'].append(stream)
+                    elif subtype == 'Form' and depth > 0:
+                        matrix = stream.get('Matrix') or [1, 0, 0, 1, 0, 0]
+                        try:
+                            self._interpret(stream.decoded(), _multiply(matrix, ctm),
+                                            self.doc.get(stream.get('Resources')) or resources,
+                                            stats, depth - 1)
+                        except PDFScanError:
+                            pass
+            elif value == b'BI':
+                end = _skip_inline_image(content, lexer.pos)
+                if end is None:
+                    break
+                lexer.pos = end
+                self._add_image(stats, ctm)
+            elif value in TEXT_OPERATORS:
+                stats['hidden' if render_mode == 3 else 'text'] += 1
+            elif value in PAINT_OPERATORS:
+                stats['paint'] += 1
+            operands = []
+
+    def _add_image(self, stats, ctm):
+        a, b, c, d, e, f = ctm
+        xs = [e, a + e, c + e, a + c + e]
+        ys = [f, b + f, d + f, b + d + f]
+        x0, y0, x1, y1 = self.mediabox
+        width = min(max(xs), x1) - max(min(xs), x0)
+        height = min(max(ys), y1) - max(min(ys), y0)
+        if width > 0 and height > 0:
+            stats['area'] += width * height
+        stats['images'] += 1
+
+def _multiply(m, n):
+    a, b, c, d, e, f = [float(x) for x in m]
+    a2, b2, c2, d2, e2, f2 = [float(x) for x in n]
+    return (a * a2 + b * c2, a * b2 + b * d2,
+            c * a2 + d * c2, c * b2 + d * d2,
+            e * a2 + f * c2 + e2, e * b2 + f * d2 + f2)
+
+def _skip_inline_image(content, pos):
+    """Return position after `EI` of inline image which dictionary starts at `pos`."""
+    idx = content.find(b'ID', pos)
+    if idx < 0:
+        return None
+    match = re.compile(br'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ]|$)').search(content, idx + 3)
+    return None if match is None else match.end()
+
+
+class PagePlan(object):
+    """
+    Plan of encoding of a document, where only distinct non-blank pages are encoded.
+
+    sources[i]  -- index of page which encoding is reused for page i (i for distinct pages)
+    blanks      -- set of indexes of blank pages, rendered as empty pages without encoding
+    sizes[i]    -- (width, height) of page i in PostScript points
+    """
+
+    def __init__(self, sources, blanks, sizes):
+        self.sources = sources
+        self.blanks = blanks
+        self.sizes = sizes
+
+    @property
+    def page_count(self):
+        return len(self.sources)
+
+    @property
+    def encode_pages(self):
+        """Sorted 0-based indexes of pages which have to be encoded by backend."""
+        return [i for i, source in enumerate(self.sources) if source == i and i not in self.blanks]
+
+    @property
+    def redundant(self):
+        return self.page_count - len(self.encode_pages)
+
+    @property
+    def duplicates(self):
+        return self.page_count - len(self.encode_pages) - len(self.blanks)
+
+def _is_white(stream):
+    """
+    Whether bilevel image decodes to white pixels only. Images which cannot be decoded here
+    (CCITT, JBIG2, JPEG) are never white: their size says nothing about a line of text on them.
+    """
+    width, height = stream.get('Width') or 0, stream.get('Height') or 0
+    if stream.get('ImageMask'):
+        paint = 0 # samples 0 are painted with fill color
+    elif stream.get('BitsPerComponent') == 1 and stream.get('ColorSpace') == 'DeviceGray':
+        paint = 0 # black
+    else:
+        return False
+    decode = stream.get('Decode')
+    if isinstance(decode, list) and decode and decode[0] == 1:
+        paint = 1 - paint
+    rowlen = (width + 7) // 8
+    if width <= 0 or height <= 0 or rowlen * height > BLANK_IMAGE_MAX_BYTES:
+        return False
+    if any(name in BILEVEL_FILTERS for name, _ in stream.filters()):
+        return False
+    try:
+        data = stream.decoded()
+    except PDFScanError:
+        return False
+    if len(data) < rowlen * height:
+        return False
+    white = b'\x00' if paint else b'\xff'
+    full, rest = divmod(width, 8)
+    mask = (0xff << (8 - rest)) & 0xff # bits of last byte holding pixels, the rest is padding
+    for row in range(height):
+        start = row * rowlen
+        if data[start:start + full].strip(white):
+            return False
+        if rest and (ord(data[start + full]) ^ ord(white)) & mask:
+            return False
+    return True
+
+def _is_blank(page, content):
+    """
+    Whether page draws nothing: its content stream is empty, or it draws no text and no paths
+    and all its images are bilevel images decoding to white pixels only.
+    """
+    if not content.strip():
+        return True
+    if len(content) > BLANK_CONTENT_MAX:
+        return False
+    stats = page.analyze()
+    if stats.text_ops or stats.hidden_text_ops or stats.paint_ops:
+        return False
+    if not all(_is_white(stream) for stream in stats.image_streams):
+        return False
+    return stats.images == len(stats.image_streams) # inline images are never treated as blank
+
+def _stream_identity(stream):
+    """Hash of stream data and of its decode parameters, i.e. JBIG2Globals shared by pages."""
+    params = []
+    for name, param in stream.filters():
+        param = dict(param or {})
+        for key, value in sorted(param.items()):
+            value = stream.doc.get(value) if isinstance(value, Ref) else value
+            param[key] = hashlib.sha1(value.raw()).hexdigest() if isinstance(value, Stream) \
+                else value
+        params.append((name, sorted(param.items())))
+    return hashlib.sha1(repr(params).encode('utf-8') + b'\0' + stream.raw()).digest()
+
+def _image_fingerprint(stream):
+    """Cheap identity of image stream, streams with equal fingerprints are compared by hash."""
+    return (stream.length, repr(stream.get('Filter')), stream.get('Width'), stream.get('Height'),
+            stream.get('BitsPerComponent'), repr(stream.dict.get('DecodeParms')))
+
+DocumentProfile = collections.namedtuple('DocumentProfile', [
+    'raster', 'confidence', 'page_count', 'sampled', 'raster_pages', 'images', 'encodings', 'dpi'])
+
+def sample_indices(page_count, samples=RASTER_SAMPLES):
+    """Indices of at most `samples` pages spread evenly over the document."""
+    if page_count <= samples:
+        return list(range(page_count))
+    return sorted(set(int((i + 0.5) * page_count / samples) for i in range(samples)))
+
+def is_raster_page(stats):
+    """
+    Whether page with PageStats `stats` is a scan: images cover most of it and it draws little
+    visible text. Hidden OCR text and text under a full page image do not count against it.
+    """
+    if stats.image_coverage >= RASTER_FULL_COVERAGE:
+        return True
+    return stats.image_coverage >= RASTER_COVERAGE and stats.text_ops <= RASTER_MAX_TEXT_OPS
+
+def profile_document(path, samples=RASTER_SAMPLES):
+    """
+    Sample at most `samples` pages of PDF document and measure their image coverage and text,
+    cost doesn't depend on the length of the document. Return DocumentProfile:
+      raster      -- whether document is a scan
+      confidence  -- share of sampled pages agreeing with the verdict
+      images      -- image count extrapolated from sampled pages
+      encodings   -- dict image filter (i.e. 'DCTDecode', 'raw') -> count in sampled pages
+      dpi         -- median resolution of images of scanned pages, None if there are none
+    Raises PDFScanError when document structure cannot be read.
+    """
+    encodings = collections.Counter()
+    resolutions = []
+    with PDFDocument(path) as doc:
+        page_count = doc.page_count()
+        indices = sample_indices(page_count, samples)
+        raster_pages = images = 0
+        for index in indices:
+            page = doc.page(index)
+            stats = page.analyze()
+            images += stats.images
+            for stream in stats.image_streams:
+                filters = [name for name, _ in stream.filters()]
+                encodings[filters[-1] if filters else 'raw'] += 1
+            if is_raster_page(stats):
+                raster_pages += 1
+                width = page.size[1] if page.rotate % 180 else page.size[0]
+                pixels = max([stream.get('Width') or 0 for stream in stats.image_streams] or [0])
+                if width > 0 and pixels > 0:
+                    resolutions.append(int(round(pixels * 72 / width)))
+    if not indices:
+        return DocumentProfile(False, 1.0, page_count, 0, 0, 0, {}, None)
+    share = raster_pages / len(indices)
+    raster = share >= RASTER_PAGES_SHARE
+    dpi = sorted(resolutions)[len(resolutions) // 2] if resolutions else None
+    return DocumentProfile(raster, share if raster else 1 - share, page_count, len(indices),
+                           raster_pages, int(round(images * page_count / len(indices))),
+                           dict(encodings), dpi)
+
+PageKey = collections.namedtuple('PageKey', ['key', 'size', 'blank'])
+
+def scan_pages(path, stable=False):
+    """
+    Return PageKey of every page of PDF document. Pages have equal keys when their content
+    streams are equal and they draw the same image XObjects, or different XObjects with identical
+    stream data. Streams are hashed only when another stream has the same length and image
+    parameters, unless `stable` is True: then every stream is hashed and keys don't depend
+    on object numbering, so they can be compared between different files.
+    Raises PDFScanError when document structure cannot be read.
+    """
+    with PDFDocument(path) as doc:
+        pages = []
+        streams_by_fingerprint = collections.defaultdict(set)
+        for page in doc.pages():
+            content = page.contents()
+            xobjects = []
+            for name, (ref, stream) in sorted(page.xobjects().items()):
+                key = ref.num if ref is not None else id(stream)
+                xobjects.append((name, key))
+                fingerprint = key if stable else _image_fingerprint(stream)
+                streams_by_fingerprint[fingerprint].add((key, stream))
+            fonts = doc.get(page.resources.get('Font')) or {}
+            if stable:
+                fonts = sorted((name, repr((doc.get(font) or {}).get('BaseFont')))
+                               for name, font in fonts.items())
+            else:
+                fonts = sorted((name, ref.num if isinstance(ref, Ref) else None)
+                               for name, ref in fonts.items())
+            pages.append((page.size, page.rotate, hashlib.sha1(content).digest(), xobjects, fonts,
+                          _is_blank(page, content)))
+
+        # canonical identity of every XObject, equal for XObjects with identical data
+        canonical = {}
+        for group in streams_by_fingerprint.values():
+            if len(group) == 1 and not stable:
+                key, _ = next(iter(group))
+                canonical[key] = ('obj', key)
+                continue
+            for key, stream in group:
+                canonical[key] = ('sha1', _stream_identity(stream))
+
+        result = []
+        for size, rotate, content, xobjects, fonts, blank in pages:
+            size = (round(size[0], 2), round(size[1], 2))
+            key = hashlib.sha1(repr((size, rotate, content, fonts,
+                                     [(name, canonical[obj]) for name, obj in xobjects]))).hexdigest()
+            result.append(PageKey(key, size, blank))
+    return result
+
+def plan_distinct_pages(path, log=None):
+    """
+    Find pages of PDF document which are blank or identical to an earlier page, see scan_pages.
+    Raises PDFScanError when document structure cannot be read.
+    """
+    sources, blanks, sizes, first_by_key = [], set(), [], {}
+    for index, page in enumerate(scan_pages(path)):
+        sizes.append(page.size)
+        if page.blank:
+            blanks.add(index)
+        sources.append(first_by_key.setdefault(page.key, index))
+    plan = PagePlan(sources, blanks, sizes)
+    if log is not None:
+        log('{} pages: {} duplicate, {} blank, {} to encode'.format(
+            plan.page_count, plan.duplicates, len(plan.blanks), len(plan.encode_pages)))
+    return plan
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pipeline module for Calibre plugin djvumaker - streaming page conversion engine
+
+Conversion runs in three overlapping stages connected by bounded queues:
+1. sources  -- extract or rasterize pages into single page image files, every source runs in its
+               own thread; ghostscript rasterizers stream pages through a pipe and several of them
+               can render disjoint page ranges of one document in parallel
+2. encoders -- encode page images with DjVuLibre (cjb2 for bilevel pages, c44 for the others),
+               every encoder thread runs its own encoder process
+3. bundler  -- collects encoded pages, which are small, and bundles them in document order
+Bounded queue between sources and encoders gives backpressure: when encoders fall behind, sources
+block and ghostscript blocks on the full pipe, so only a few raw page images exist at any time,
+no matter how big the book is.
+
+References:
+(#NODOC)
+PipelineError(Exception)
+PageImage(number, path, bilevel, dpi, temporary) -- page image waiting for encoding
+Pipeline(encode, encoders, in_flight, abort, progress)
+  .run(sources, dest)            -- run sources through encoders and bundle pages to dest
+encode_page(src, dest, bilevel, dpi) -- encode one page image with DjVuLibre encoder
+read_pnm(stream, dest_base)      -- copy one PNM image from stream to file
+find_ghostscript()               -- path to ghostscript executable
+gs_command(srcdoc, dpi, first, last, gs) -- ghostscript command rendering pages to stdout
+GsTuning(threads, max_bitmap, buffer_space, raster) -- ghostscript rendering parameters
+  .defines()                     -- ghostscript -d options of the parameters
+gs_tuning(size, dpi, threads, memory=None) -- rendering parameters for page size, DPI and budget
+gs_pages(srcdoc, runs, dpi, tmpdir) -- source of pages rendered by ghostscript
+page_runs(pages)                 -- 0-based page indexes to (first, last) runs
+rasterizer_sources(srcdoc, pages, dpi, rasterizers) -- sources rendering pages in parallel
+parse_flags(cmdflags)            -- pipeline options from backend flags
+rasterize_to_djvu(srcdoc, dest, cmdflags, ...) -- convert PDF or PostScript document
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import argparse
+import collections
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from distutils.spawn import find_executable
+from functools import partial
+from Queue import Queue
+
+from calibre_plugins.djvumaker.djvu import bundle_pages, DjVuError
+from calibre_plugins.djvumaker.tracing import span
+from calibre_plugins.djvumaker.utils import cpu_count
+
+DEFAULT_DPI = 300 # typical scanning resolution, when the image doesn't say
+DEFAULT_PAGE_SIZE = (8.5, 11) # inches, when the document doesn't say
+RENDER_MEMORY = 1024 # MB for rendering one document when physical memory is unknown
+MIN_BAND_BUFFER = 4 * 1024 * 1024
+THREADED_RASTER = 32 * 1024 * 1024 # smaller pages render faster in one piece by one thread
+COPY_BUFSIZE = 1 << 20
+GHOSTSCRIPT_NAMES = ('gs', 'gswin64c', 'gswin32c')
+
+class PipelineError(Exception):
+    """Some page couldn't be extracted, rendered or encoded."""
+    pass
+
+PageImage = collections.namedtuple('PageImage', ['number', 'path', 'bilevel', 'dpi', 'temporary'])
+
+
+# -- encoding --
+def _decode_to_pnm(src, dest_base):
+    """Decode image with Qt to PBM (1-bit images) or PPM, return (path, bilevel, dpi)."""
+    from PyQt5.Qt import QImage
+    image = QImage(src)
+    if image.isNull():
+        raise ValueError('Cannot decode image {}'.format(src))
+    bilevel = image.format() in (QImage.Format_Mono, QImage.Format_MonoLSB)
+    dest = dest_base + ('.pbm' if bilevel else '.ppm')
+    if not image.save(dest, b'PBM' if bilevel else b'PPM'):
+        raise ValueError('Cannot write decoded image {}'.format(dest))
+    dpi = int(round(image.dotsPerMeterX() * 0.0254)) or None
+    return dest, bilevel, dpi
+
+def encode_page(src, dest, bilevel=None, dpi=None):
+    """
+    Encode one page image to single page DJVU `dest`. Bilevel images are encoded with cjb2,
+    the others with c44. Images which the encoders cannot read are decoded with Qt first.
+    Return encoder output.
+    """
+    ext = os.path.splitext(src)[1].lower().lstrip('.')
+    decoded = None
+    try:
+        if (ext in ('tif', 'tiff') and not bilevel) or ext not in (
+                'tif', 'tiff', 'jpg', 'jpeg', 'pbm', 'pgm', 'ppm', 'pnm'):
+            decoded, bilevel, decoded_dpi = _decode_to_pnm(src, os.path.splitext(dest)[0])
+            src, dpi = decoded, dpi or decoded_dpi
+        encoder = 'cjb2' if bilevel else 'c44'
+        cmd = [encoder, '-dpi', str(dpi or DEFAULT_DPI), src, dest]
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    finally:
+        if decoded is not None and os.path.exists(decoded):
+            os.remove(decoded)
+
+
+# -- engine --
+class Pipeline(object):
+    """
+    Streaming conversion of pages produced by sources into one bundled DJVU.
+
+    Arguments:
+        encode    -- function(src, dest, bilevel, dpi) encoding page image to single page DJVU
+        encoders  -- number of parallel encoders, number of CPU cores by default
+        in_flight -- number of page images waiting for encoder, same as encoders by default;
+                     at most in_flight + encoders + number of sources page images exist at once
+        abort     -- threading.Event stopping the conversion
+        progress  -- function(encoded_pages) called after every encoded page
+    """
+    def __init__(self, encode=encode_page, encoders=None, in_flight=None, abort=None,
+                 progress=None):
+        self.encode = encode
+        self.encoders = encoders or cpu_count()
+        self.in_flight = in_flight or self.encoders
+        self.abort = abort
+        self.progress = progress
+        self.errors = []
+
+    def stopped(self):
+        return bool(self.errors) or (self.abort is not None and self.abort.is_set())
+
+    def _feed(self, source, queue):
+        """Source stage: put pages from source to queue, until source ends or pipeline stops."""
+        pages = iter(source)
+        try:
+            for page in pages:
+                if self.stopped():
+                    if page.temporary:
+                        os.remove(page.path)
+                    break
+                queue.put(page) # blocks while all encoders are busy
+        except Exception as err:
+            self.errors.append('{}'.format(err))
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close() # stops ghostscript process of the source
+
+    def _encode(self, queue, results, tmpdir):
+        """Encoder stage: encode pages from queue, skip them after the pipeline stopped."""
+        try:
+            while True:
+                page = queue.get()
+                if page is None:
+                    return
+                dest = os.path.join(tmpdir, 'page{:06d}.djvu'.format(page.number))
+                try:
+                    if not self.stopped():
+                        with span('encode', page=page.number + 1):
+                            self.encode(page.path, dest, page.bilevel, page.dpi)
+                        results.put((page.number, dest))
+                except Exception as err: # any failure has to reach the bundler, not kill thread
+                    self.errors.append('page {}: {}'.format(
+                        page.number + 1, getattr(err, 'output', None) or err))
+                finally:
+                    if page.temporary and os.path.exists(page.path):
+                        os.remove(page.path)
+        finally:
+            results.put(None) # bundler counts finished encoders
+
+    def run(self, sources, dest):
+        """
+        Convert pages of `sources`, which are functions(tmpdir) returning iterables of PageImage,
+        and bundle them in page number order into `dest`. Return number of pages, or None if
+        aborted. Raises PipelineError when some page cannot be converted.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='djvumaker_pipeline_')
+        queue, results = Queue(maxsize=self.in_flight), Queue()
+        del self.errors[:]
+        try:
+            feeders = [threading.Thread(target=self._feed, args=(source(tmpdir), queue),
+                                        name='djvumaker-source-{}'.format(number))
+                       for number, source in enumerate(sources)]
+            encoders = [threading.Thread(target=self._encode, args=(queue, results, tmpdir),
+                                         name='djvumaker-encoder-{}'.format(number))
+                        for number in range(self.encoders)]
+            for thread in feeders + encoders:
+                thread.daemon = True
+                thread.start()
+
+            def close_queue():
+                for thread in feeders:
+                    thread.join()
+                for _ in encoders:
+                    queue.put(None)
+            closer = threading.Thread(target=close_queue, name='djvumaker-sources-end')
+            closer.daemon = True
+            closer.start()
+
+            # bundler stage, encoded pages are collected as they come
+            encoded, running = {}, len(encoders)
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                encoded[result[0]] = result[1]
+                if self.progress is not None:
+                    self.progress(len(encoded))
+            closer.join()
+
+            if self.abort is not None and self.abort.is_set():
+                return None
+            if self.errors:
+                raise PipelineError('\n'.join(self.errors))
+            if not encoded:
+                raise PipelineError('Document has no pages')
+            try:
+                with span('bundle', pages=len(encoded)):
+                    bundle_pages(dest, [encoded[number] for number in sorted(encoded)])
+            except DjVuError as err:
+                raise PipelineError('{}'.format(err))
+            return len(encoded)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# -- ghostscript rasterizer --
+def _read_token(stream):
+    """Read whitespace separated token of PNM header, skipping comments."""
+    token = b''
+    while True:
+        char = stream.read(1)
+        if not char:
+            return token or None
+        if char == b'#':
+            while char not in (b'\n', b''):
+                char = stream.read(1)
+            char = b'\n'
+        if char.isspace():
+            if token:
+                return token
+            continue
+        token += char
+
+def read_pnm(stream, dest_base):
+    """
+    Copy one raw PNM image (P4, P5 or P6) from stream to `dest_base` with proper extension.
+    Return (path, bilevel) or None at the end of stream.
+    """
+    magic = _read_token(stream)
+    if magic is None:
+        return None
+    try:
+        width, height = int(_read_token(stream)), int(_read_token(stream))
+        maxval = 1 if magic == b'P4' else int(_read_token(stream))
+    except (TypeError, ValueError):
+        raise PipelineError('Malformed PNM header')
+    if magic == b'P4':
+        size, ext = (width + 7) // 8 * height, '.pbm'
+    elif magic in (b'P5', b'P6'):
+        size = width * height * (1 if maxval < 256 else 2) * (1 if magic == b'P5' else 3)
+        ext = '.pgm' if magic == b'P5' else '.ppm'
+    else:
+        raise PipelineError('Unsupported PNM image {!r}'.format(magic))
+    path = dest_base + ext
+    with open(path, 'wb') as out:
+        out.write(b'{} {} {}\n'.format(magic, width, height))
+        if magic != b'P4':
+            out.write(b'{}\n'.format(maxval))
+        while size > 0:
+            buf = stream.read(min(COPY_BUFSIZE, size))
+            if not buf:
+                raise PipelineError('Truncated PNM image')
+            out.write(buf)
+            size -= len(buf)
+    return path, magic == b'P4'
+
+def find_ghostscript():
+    for name in GHOSTSCRIPT_NAMES:
+        path = find_executable(name)
+        if path is not None:
+            return path
+    return None
+
+def gs_command(srcdoc, dpi, first=None, last=None, gs='gs'):
+    """
+    Ghostscript command writing pages from `first` to `last` (1-based) to stdout. pnmraw device
+    chooses PBM, PGM or PPM for every page by its content, so text pages stay bilevel.
+    """
+    cmd = [gs, '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sstdout=%stderr', '-sDEVICE=pnmraw',
+           '-r{}'.format(dpi)]
+    if first is not None:
+        cmd += ['-dFirstPage={}'.format(first), '-dLastPage={}'.format(last)]
+    return cmd + ['-sOutputFile=-', srcdoc]
+
+class GsTuning(collections.namedtuple('GsTuning',
+                                      ['threads', 'max_bitmap', 'buffer_space', 'raster'])):
+    """
+    Ghostscript rendering parameters: pages up to `max_bitmap` bytes are rendered in one piece,
+    bigger ones in bands through `buffer_space` bytes band buffers by `threads` threads. `raster`
+    is the size of the biggest page's bitmap. Parameters which are None are left to ghostscript.
+    """
+
+    def defines(self):
+        defines = [('NumRenderingThreads', self.threads), ('MaxBitmap', self.max_bitmap),
+                   ('BufferSpace', self.buffer_space)]
+        return ['-d{}={}'.format(name, value) for name, value in defines if value is not None]
+
+    def __str__(self):
+        mb = lambda size: '{:.0f} MB'.format(size / (1024 * 1024))
+        if self.buffer_space is None:
+            return 'whole page ({}) in memory, 1 rendering thread'.format(mb(self.raster))
+        return 'page ({}) in bands of {} buffer space, {} rendering thread{}'.format(
+            mb(self.raster), mb(self.buffer_space), self.threads, 's' if self.threads > 1 else '')
+
+def gs_tuning(size, dpi, threads, memory=None):
+    """
+    Rendering parameters of ghostscript for pages of `size` (width, height) inches (None if not
+    known) rendered in 24-bit color at `dpi` on `threads` cores with `memory` MB. Pages fitting in
+    half of the memory are rendered in one piece, unless they are big enough for threads to pay
+    off. Bands are as big as the memory allows, every rendering thread has its own band buffer.
+    """
+    width, height = size or DEFAULT_PAGE_SIZE
+    raster = int(-(-width * dpi // 1)) * 3 * int(-(-height * dpi // 1))
+    budget = (memory or RENDER_MEMORY) * 1024 * 1024 // 2
+    threads = max(1, threads)
+    if raster <= budget and (threads == 1 or raster <= THREADED_RASTER):
+        return GsTuning(None, raster + MIN_BAND_BUFFER, None, raster)
+    buffer_space = max(MIN_BAND_BUFFER, min(budget // (threads + 1), raster // threads))
+    return GsTuning(threads, 0, buffer_space, raster)
+
+def gs_pages(srcdoc, runs, dpi, tmpdir, gs=None):
+    """
+    Source of pages of `srcdoc` rendered by ghostscript, runs are (first, last) 0-based page
+    indexes or None for the whole document. Pages are read from ghostscript's stdout one by one,
+    ghostscript waits on the full pipe until the pipeline takes the page.
+    """
+    gs = gs or find_ghostscript() or GHOSTSCRIPT_NAMES[0]
+    for run in runs or [None]:
+        first = None if run is None else run[0]
+        cmd = gs_command(srcdoc, dpi, None if run is None else run[0] + 1,
+                         None if run is None else run[1] + 1, gs)
+        errors = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+        try:
+            number = first or 0
+            while run is None or number <= run[1]:
+                image = read_pnm(proc.stdout, os.path.join(tmpdir, 'raster{:06d}'.format(number)))
+                if image is None:
+                    if run is None:
+                        break
+                    proc.wait()
+                    errors.seek(0)
+                    raise PipelineError('ghostscript stopped before page {}: {}'.format(
+                        number + 1, errors.read().strip()))
+                yield PageImage(number, image[0], image[1], dpi, True)
+                number += 1
+            proc.stdout.close()
+            if proc.wait() != 0:
+                errors.seek(0)
+                raise PipelineError('ghostscript failed: {}'.format(errors.read().strip()))
+        finally:
+            if proc.poll() is None: # pipeline stopped, don't wait for the rest of pages
+                proc.kill()
+                proc.wait()
+            errors.close()
+
+def page_runs(pages):
+    """Conversion from 0-based page indexes [0, 1, 2, 5] to runs [(0, 2), (5, 5)]."""
+    runs = []
+    for page in sorted(set(pages)):
+        if runs and runs[-1][1] == page - 1:
+            runs[-1] = (runs[-1][0], page)
+        else:
+            runs.append((page, page))
+    return runs
+
+def rasterizer_sources(srcdoc, pages, dpi, rasterizers):
+    """
+    Split 0-based `pages` into `rasterizers` continuous parts, every one rendered by its own
+    ghostscript process. If `pages` is None (page count unknown), one process renders all.
+    """
+    if pages is None:
+        return [partial(gs_pages, srcdoc, None, dpi)]
+    pages = sorted(set(pages))
+    size = max(1, -(-len(pages) // rasterizers))
+    return [partial(gs_pages, srcdoc, page_runs(pages[start:start + size]), dpi)
+            for start in range(0, len(pages), size)]
+
+def parse_flags(cmdflags):
+    """
+    Pipeline options from backend flags:
+        --dpi=N          rendering resolution
+        --pages=RANGES   1-based pages to convert, i.e.: 1-3,6
+        --rasterizers=N  parallel ghostscript processes
+        --encoders=N     parallel DjVuLibre encoders
+        --in-flight=N    page images waiting for encoder
+    Raises PipelineError for unknown flags.
+    """
+    parser = argparse.ArgumentParser(prog='djvulibre', add_help=False)
+    parser.add_argument('-d', '--dpi', type=int)
+    parser.add_argument('--pages')
+    parser.add_argument('--rasterizers', type=int)
+    parser.add_argument('--encoders', type=int)
+    parser.add_argument('--in-flight', type=int)
+    options, unknown = parser.parse_known_args(cmdflags or [])
+    if unknown:
+        raise PipelineError('Unknown djvulibre flags: {}'.format(' '.join(unknown)))
+    if options.pages is not None:
+        pages = set()
+        try:
+            for part in options.pages.split(','):
+                first, _, last = part.partition('-')
+                pages.update(range(int(first) - 1, int(last or first)))
+        except ValueError:
+            raise PipelineError('Wrong page ranges: {}'.format(options.pages))
+        options.pages = sorted(pages)
+    return options
+
+def rasterize_to_djvu(srcdoc, dest, cmdflags=None, page_count=None, abort=None, progress=None):
+    """
+    Convert PDF or PostScript document with ghostscript and DjVuLibre encoders, options are
+    given as backend flags (see parse_flags). By default a quarter of CPU cores renders pages
+    and all cores encode them. Return number of pages or None if aborted.
+    """
+    options = parse_flags(cmdflags)
+    pages = options.pages
+    if pages is None and page_count is not None:
+        pages = range(page_count)
+    encoders = options.encoders or cpu_count()
+    rasterizers = options.rasterizers or max(1, encoders // 4)
+    pipeline = Pipeline(encode_page, encoders, options.in_flight, abort, progress)
+    return pipeline.run(rasterizer_sources(srcdoc, pages, options.dpi or DEFAULT_DPI, rasterizers),
+                        dest)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+processes module for Calibre plugin djvumaker - process trees of backend commands
+
+Backend commands are often scripts starting other programs (djvudigital runs ghostscript and
+csepdjvu), killing the script leaves them running. Every backend command is started in its own
+session on POSIX (process group on Windows), so the whole tree is terminated at once: SIGTERM
+first, SIGKILL to what is left after GRACE seconds (taskkill /T /F on Windows). Its temporary
+files go to a private scratch folder removed after the run, even when the tree was killed.
+
+Conversions run in calibre's process, in fork_job workers and in other calibre-debug processes.
+Each one registers itself by a small file named after its process ID in a shared folder, so
+threads of a starting conversion are computed from cores and conversions running machine-wide.
+The file lists process groups of its backend commands and its partial outputs, when the process
+is killed (fork_job timeout) they are terminated and removed by whoever finds it stale.
+
+References:
+(#NODOC)
+GRACE                     -- seconds between SIGTERM and SIGKILL
+process_alive(pid)        -- whether process `pid` is running
+break_stale_lock(path)    -- remove lock file of process which is gone, True if it was removed
+lock_file(path, timeout=LOCK_TIMEOUT) -- context holding lock file shared by processes
+popen_group(cmd, **kwargs) -- subprocess.Popen of `cmd` in its own process group
+wait_cpu(proc)            -- wait for `proc`, return CPU time of it and descendants it waited for
+process_cpu_time()        -- CPU time of this process and its finished children
+group_alive(pgid)         -- whether any process of group `pgid` is running
+terminate_group(pgid, proc=None, grace=GRACE) -- terminate process group, reap `proc` if given
+watch_abort(proc, abort, on_abort=None) -- thread terminating tree of `proc` once `abort` is set
+scratch_env(env, folder)  -- copy of environment with temporary folder set to `folder`
+running_job(folder=None) -- context of one running conversion, registered in `folder` if given
+register_group(pgid)     -- record process group of backend command of conversion in this thread
+register_path(path)      -- record partial output or scratch folder of conversion in this thread
+running_jobs(folder=None) -- number of conversions running in this process or registered in `folder`
+reap_orphans(folder)     -- terminate backend commands left by killed processes registered in `folder`
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import errno
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+GRACE = 5
+LOCK_POLL = 0.05
+LOCK_TIMEOUT = 30
+BREAK_TIMEOUT = 10
+CREATE_NEW_PROCESS_GROUP = 0x00000200
+
+_running = [0]
+_running_lock = threading.Lock()
+_job_numbers = itertools.count()
+_current = threading.local() # registration file of conversion running in the thread
+
+def process_alive(pid):
+    if os.name == 'nt':
+        import ctypes # os.kill would terminate the process on Windows
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def _lock_owner(path):
+    """Process ID recorded in lock file, None if it's gone or not written yet."""
+    try:
+        with open(path, 'rb') as f:
+            owner = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+    return owner.get('pid') if isinstance(owner, dict) else owner
+
+def break_stale_lock(path):
+    """
+    Remove lock file `path` of process which is gone, return True if it was removed. Processes
+    breaking the same lock at once take turns by `path`.break file and re-read the lock, so
+    lock created meanwhile by one of them isn't removed by the other.
+    """
+    breaker = path + '.break'
+    try:
+        fd = os.open(breaker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        try:
+            if time.time() - os.path.getmtime(breaker) > BREAK_TIMEOUT:
+                os.remove(breaker) # breaking process was killed
+        except EnvironmentError:
+            pass
+        return False
+    os.close(fd)
+    try:
+        owner = _lock_owner(path)
+        if owner is None or process_alive(owner):
+            return False
+        os.remove(path)
+        return True
+    finally:
+        os.remove(breaker)
+
+@contextmanager
+def lock_file(path, timeout=LOCK_TIMEOUT):
+    """
+    Hold lock file `path` shared by processes while inside, lock of killed process is broken.
+    Raises EnvironmentError if other process holds it longer than `timeout` seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if not break_stale_lock(path):
+            if time.time() > deadline:
+                raise IOError(errno.ETIMEDOUT, 'lock is held by other process', path)
+            time.sleep(LOCK_POLL)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps({'pid' : os.getpid()}).encode('utf-8'))
+        yield
+    finally:
+        os.remove(path)
+
+def popen_group(cmd, **kwargs):
+    """Start `cmd` as leader of new process group, its pid is the group's ID."""
+    if os.name == 'nt':
+        kwargs['creationflags'] = kwargs.get('creationflags', 0) | CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['preexec_fn'] = os.setsid # python 2 has no start_new_session
+    return subprocess.Popen(cmd, **kwargs)
+
+def wait_cpu(proc):
+    """
+    Wait for `proc` like proc.wait(), return CPU seconds (user and system) used by it and by
+    descendants it waited for. None where it isn't known: on Windows, or when other thread
+    (abort watcher) reaped the process first.
+    """
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    while True:
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+            break
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno != errno.ECHILD:
+                raise
+            proc.wait() # already reaped, returncode is set by whoever did it
+            return None
+    # negative signal number like Popen.returncode, the status was reaped here instead of by proc
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return usage.ru_utime + usage.ru_stime
+
+def process_cpu_time():
+    """
+    CPU seconds of all threads of this process and of its finished children, None on Windows,
+    which doesn't count children.
+    """
+    if os.name == 'nt':
+        return None
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def group_alive(pgid):
+    if os.name == 'nt':
+        return process_alive(pgid) # taskkill /T finds the rest of the tree from its leader
+    try:
+        os.killpg(pgid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def _signal_group(pgid, signum):
+    try:
+        os.killpg(pgid, signum)
+    except OSError as err:
+        if err.errno != errno.ESRCH:
+            raise
+
+def terminate_group(pgid, proc=None, grace=GRACE):
+    """
+    Terminate every process of group `pgid`: SIGTERM, then SIGKILL after `grace` seconds.
+    `proc`, the group's leader started by this process, is reaped so it doesn't keep the group
+    alive as zombie. Return True if the group had to be killed.
+    """
+    if os.name == 'nt':
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.call(['taskkill', '/T', '/F', '/PID', str(pgid)], stdout=devnull,
+                            stderr=devnull)
+        if proc is not None:
+            proc.wait()
+        return True
+    _signal_group(pgid, signal.SIGTERM)
+    deadline = time.time() + grace
+    while time.time() < deadline:
+        if proc is not None:
+            proc.poll()
+        if not group_alive(pgid):
+            return False
+        time.sleep(0.1)
+    _signal_group(pgid, signal.SIGKILL)
+    if proc is not None:
+        proc.wait()
+    return True
+
+def watch_abort(proc, abort, on_abort=None):
+    """
+    Start daemon thread terminating process tree of `proc` (started by popen_group) as soon as
+    `abort` is set, even when the tree prints nothing. `on_abort()` is called before.
+    """
+    def watch():
+        while proc.poll() is None:
+            abort.wait(1)
+            if abort.is_set():
+                if proc.poll() is None:
+                    if on_abort is not None:
+                        on_abort()
+                    terminate_group(proc.pid, proc)
+                return
+    thread = threading.Thread(target=watch, name='djvumaker abort watcher')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def scratch_env(env, folder):
+    """Copy of environment `env` whose programs put temporary files into `folder`."""
+    env = dict(env)
+    for name in ('TMPDIR', 'TMP', 'TEMP'):
+        env[name] = folder
+    return env
+
+def _reap(path):
+    """
+    Remove registration of conversion whose process is gone: process groups of its backend
+    commands still running (the process was killed, i.e. by fork_job timeout) are terminated,
+    its partial output and scratch folders are removed. Return number of terminated groups.
+    """
+    terminated = 0
+    try:
+        with open(path, 'rb') as f:
+            entries = [line.decode('utf-8').split(' ', 1) for line in f.read().splitlines()]
+    except EnvironmentError:
+        entries = []
+    for kind, value in (entry for entry in entries if len(entry) == 2):
+        if kind == 'group' and value.isdigit() and group_alive(int(value)):
+            terminate_group(int(value))
+            terminated += 1
+        elif kind == 'path':
+            if os.path.isdir(value):
+                shutil.rmtree(value, ignore_errors=True)
+            elif os.path.exists(value):
+                try:
+                    os.remove(value)
+                except EnvironmentError:
+                    pass
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+    return terminated
+
+@contextmanager
+def running_job(folder=None):
+    """
+    Count conversion as running while inside, threads are shared between running ones.
+    With `folder`, conversion is registered there for other processes too.
+    """
+    path = None
+    if folder is not None:
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            path = os.path.join(folder, '{}-{}.job'.format(os.getpid(), next(_job_numbers)))
+            open(path, 'wb').close()
+        except EnvironmentError:
+            path = None # counted only in this process
+    with _running_lock:
+        _running[0] += 1
+    outer, _current.path = getattr(_current, 'path', None), path
+    try:
+        yield
+    finally:
+        _current.path = outer
+        with _running_lock:
+            _running[0] -= 1
+        if path is not None:
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+
+def _register(kind, value):
+    path = getattr(_current, 'path', None)
+    if path is not None:
+        try:
+            with open(path, 'ab') as f:
+                f.write('{} {}\n'.format(kind, value).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+def register_group(pgid):
+    """Record process group of backend command of conversion running in this thread."""
+    _register('group', pgid)
+
+def register_path(path):
+    """Record partial output or scratch folder of conversion running in this thread."""
+    _register('path', path)
+
+def reap_orphans(folder):
+    """
+    Terminate backend commands of conversions registered in `folder` whose processes are gone,
+    return number of terminated process groups.
+    """
+    try:
+        names = os.listdir(folder)
+    except EnvironmentError:
+        return 0
+    terminated = 0
+    for name in names:
+        try:
+            pid = int(name.split('-')[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not process_alive(pid):
+            terminated += _reap(os.path.join(folder, name))
+    return terminated
+
+def running_jobs(folder=None):
+    """
+    Number of running conversions: registered in `folder` by live processes (registrations of
+    killed ones are reaped) or, without `folder`, running in this process.
+    """
+    with _running_lock:
+        local = _running[0]
+    if folder is None:
+        return local
+    try:
+        names = os.listdir(folder)
+    except EnvironmentError:
+        return local
+    jobs, alive = 0, {os.getpid() : True}
+    for name in names:
+        try:
+            pid = int(name.split('-')[0])
+        except ValueError:
+            continue
+        if pid not in alive:
+            alive[pid] = process_alive(pid)
+        if alive[pid]:
+            jobs += 1
+        else:
+            _reap(os.path.join(folder, name))
+    return max(jobs, local)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+results module for Calibre plugin djvumaker - batched library writes of converted documents
+
+Adding every converted DJVU by itself costs a database transaction, a run of file type plugins
+and a metadata update per book, and in bulk runs these writes contend with the GUI.
+ResultCollector gathers finished DJVUs and adds them in batches: import plugins of the whole
+batch run first, then the formats are added, then postimport plugins run for the batch and the
+caller refreshes the GUI once. Every format is added under the library write lock by itself, so
+the GUI can read the library between books of a batch. A flusher thread writes a batch once its
+first document waited MAX_DELAY seconds, also when no more documents come.
+
+References:
+(#NODOC)
+BATCH_SIZE                -- number of finished DJVUs written at once
+MAX_DELAY                 -- seconds after which a batch is written even if not full
+ResultCollector(db, prints, batch_size=BATCH_SIZE, max_delay=MAX_DELAY, on_batch=None,
+                expected=None)
+  .add(book_id, path, fmt='DJVU', after=None, failed=None) -- queue finished document, `after` runs
+                             once added, `failed` if it cannot be added
+  .job_done()             -- one of `expected` jobs ended, last one writes the batch
+  .flush()                -- write queued documents now, return ids of books written
+  .take_written()         -- ids of books written since last call, for GUI refresh
+  .close()                -- stop flusher thread and write queued documents
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import collections
+import os
+import threading
+import time
+import traceback
+
+from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postimport
+
+BATCH_SIZE = 20
+MAX_DELAY = 60
+
+_Result = collections.namedtuple('_Result', ['book_id', 'fmt', 'path', 'after', 'failed'])
+
+class ResultCollector(object):
+    """
+    Collect converted documents of library `db` (legacy calibre database, postimport plugins
+    expect it) and add them in batches. Thread-safe, use as context manager to write the rest
+    on exit. `on_batch(book_ids)` is called after every written batch, i.e. to refresh GUI.
+    With `expected` number of jobs, the batch is written when the last job calls job_done.
+    """
+
+    def __init__(self, db, prints, batch_size=BATCH_SIZE, max_delay=MAX_DELAY, on_batch=None,
+                 expected=None):
+        self.db = db
+        self.prints = prints
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_batch = on_batch
+        self.expected = expected
+        self.pending = []
+        self.first_pending = None
+        self.written = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.flusher = None
+
+    def add(self, book_id, path, fmt='DJVU', after=None, failed=None):
+        with self.lock:
+            self.pending.append(_Result(book_id, fmt, path, after, failed))
+            if self.first_pending is None:
+                self.first_pending = time.time()
+                self._start_flusher()
+                self.wakeup.notify()
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def _start_flusher(self):
+        if self.flusher is None and not self.closed:
+            self.flusher = threading.Thread(target=self._flush_late,
+                                            name='djvumaker-result-flusher')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def _flush_late(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                if self.first_pending is None:
+                    self.wakeup.wait()
+                    continue
+                wait = self.first_pending + self.max_delay - time.time()
+                if wait > 0:
+                    self.wakeup.wait(wait)
+                    continue
+            self.flush()
+
+    def job_done(self):
+        with self.lock:
+            if self.expected is None:
+                return
+            self.expected -= 1
+            last = self.expected <= 0
+        if last:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.first_pending = None
+            if not batch:
+                return []
+            api = getattr(self.db, 'new_api', self.db)
+
+            # file type plugins may replace the file, they run before the write lock is taken
+            # like in calibre's own add_format, because some of them spin the GUI event loop
+            prepared = []
+            for result in batch:
+                try:
+                    path = run_plugins_on_import(result.path, result.fmt.lower())
+                    fmt = os.path.splitext(path)[1].lstrip('.').upper() or result.fmt
+                except Exception:
+                    self.prints(traceback.format_exc())
+                    path, fmt = result.path, result.fmt
+                prepared.append((result, path, fmt))
+
+            # add_format takes the write lock for one book, GUI isn't blocked for whole batch
+            added = []
+            for result, path, fmt in prepared:
+                try:
+                    api.add_format(result.book_id, fmt, path, run_hooks=False)
+                    added.append((result, fmt))
+                except Exception as err:
+                    self.prints("cannot add '{}' document to book ID #{}: {}".format(
+                        fmt, result.book_id, err))
+                    if result.failed is not None:
+                        result.failed()
+
+            for result, fmt in added:
+                try:
+                    run_plugins_on_postimport(self.db, result.book_id, fmt)
+                except Exception:
+                    self.prints(traceback.format_exc())
+                if result.after is not None:
+                    result.after()
+            book_ids = [result.book_id for result, _ in added]
+            if book_ids:
+                self.prints("added 'DJVU' documents of {} books to library in one batch: {}".format(
+                    len(book_ids), ', '.join('#{}'.format(book_id) for book_id in book_ids)))
+            with self.lock:
+                self.written.extend(book_ids)
+        if self.on_batch is not None and book_ids:
+            self.on_batch(book_ids)
+        return book_ids
+
+    def take_written(self):
+        with self.lock:
+            book_ids, self.written = self.written, []
+        return book_ids
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
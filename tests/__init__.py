@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Unit tests of modules which don't need calibre, run by `make unittest`.
+
+Calibre imports plugin modules as calibre_plugins.djvumaker.<module>, the package is registered
+here pointing to the repository, so modules are imported without running plugin's __init__.py.
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'calibre_plugins.djvumaker' not in sys.modules:
+    calibre_plugins = sys.modules.setdefault(str('calibre_plugins'),
+                                             types.ModuleType(str('calibre_plugins')))
+    calibre_plugins.__path__ = []
+    package = types.ModuleType(str('calibre_plugins.djvumaker'))
+    package.__path__ = [ROOT]
+    sys.modules[str('calibre_plugins.djvumaker')] = package
+    calibre_plugins.djvumaker = package
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import batch
+
+EXTENSIONS = ('pdf', 'tif')
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def touch(self, *parts):
+        path = os.path.join(self.folder, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        return path
+
+    def test_tree(self):
+        first = self.touch('b', 'one.PDF')
+        second = self.touch('a.tif')
+        self.touch('notes.txt')
+        self.assertEqual(batch.batch_sources(self.folder, EXTENSIONS),
+                         [(second, 'a.tif'), (first, os.path.join('b', 'one.PDF'))])
+
+    def test_listed_paths_are_relative_to_common_folder(self):
+        first = self.touch('books', 'x', 'one.pdf')
+        second = self.touch('books', 'y', 'two.pdf')
+        listing = self.touch('list.txt')
+        with open(listing, 'wb') as f:
+            f.write('# scans\n{}\n\n{}\n'.format(first, second).encode('utf-8'))
+        self.assertEqual(batch.batch_sources(listing, EXTENSIONS),
+                         [(first, os.path.join('x', 'one.pdf')),
+                          (second, os.path.join('y', 'two.pdf'))])
+
+    def test_common_prefix_is_not_a_folder(self):
+        # 'books/ab' and 'books/ac' share 'books/a', paths are relative to 'books'
+        first = self.touch('books', 'ab', 'one.pdf')
+        second = self.touch('books', 'ac', 'two.pdf')
+        stdin = io.BytesIO('{}\n{}\n'.format(first, second).encode('utf-8'))
+        self.assertEqual([relative for _, relative in batch.batch_sources('-', EXTENSIONS, stdin)],
+                         [os.path.join('ab', 'one.pdf'), os.path.join('ac', 'two.pdf')])
+
+    def test_single_listed_path(self):
+        path = self.touch('one.pdf')
+        stdin = io.BytesIO(path.encode('utf-8') + b'\n')
+        self.assertEqual(batch.batch_sources('-', EXTENSIONS, stdin), [(path, 'one.pdf')])
+        self.assertEqual(batch.batch_sources('-', EXTENSIONS, io.BytesIO(b'')), [])
+
+    def test_output_path(self):
+        source = os.path.join(self.folder, 'b', 'one.pdf')
+        relative = os.path.join('b', 'one.pdf')
+        self.assertEqual(batch.output_path(source, relative),
+                         os.path.join(self.folder, 'b', 'one.djvu'))
+        self.assertEqual(batch.output_path(source, relative, '/out'),
+                         os.path.join('/out', 'b', 'one.djvu'))
+
+    def test_up_to_date(self):
+        source = self.touch('one.pdf')
+        output = os.path.join(self.folder, 'one.djvu')
+        self.assertFalse(batch.up_to_date(source, output))
+        self.touch('one.djvu')
+        os.utime(source, (1000, 1000))
+        self.assertTrue(batch.up_to_date(source, output))
+
+    def test_publish_from_threads(self):
+        output = os.path.join(self.folder, 'out', 'one.djvu')
+        djvus = []
+        for number in range(4):
+            djvu = os.path.join(self.folder, '{}.djvu'.format(number))
+            with open(djvu, 'wb') as f:
+                f.write(b'AT&TFORM' * 1000)
+            djvus.append(djvu)
+        errors = []
+        def publish(djvu):
+            try:
+                batch.publish(djvu, output)
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=publish, args=(djvu,)) for djvu in djvus]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(os.path.dirname(output)), ['one.djvu'])
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), b'AT&TFORM' * 1000)
+
+    def test_summary(self):
+        results = [batch.FileResult('a.pdf', 'a.djvu', 'converted', 1.0, None),
+                   batch.FileResult('b.pdf', 'b.djvu', 'failed', 0.5, 'backend produced no DJVU')]
+        data = batch.summary(results)
+        self.assertEqual((data['converted'], data['failed'], data['skipped']), (1, 1, 0))
+        self.assertEqual(data['files'][1]['error'], 'backend produced no DJVU')
+
+
+if __name__ == '__main__':
+    unittest.main()
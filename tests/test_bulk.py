@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import threading
+import time
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import bulk
+
+class Monitor(object):
+
+    def __init__(self, reason=None):
+        self.reason = reason
+
+    def pressure(self):
+        return self.reason
+
+
+class AdjustTest(unittest.TestCase):
+
+    def limit(self, start=2, maximum=8, reason=None, fixed=None):
+        self.log = []
+        limit = bulk.ConcurrencyLimit(start, maximum, fixed=fixed, log=self.log.append,
+                                      monitor=Monitor(reason))
+        limit.last_check = time.time() # memory isn't checked unless a test wants it
+        return limit
+
+    def finish_epoch(self, limit, pages, seconds=bulk.MIN_EPOCH, waited=True):
+        """Finish `limit` books of `pages` pages in epoch which took `seconds`."""
+        limit.epoch_start = time.time() - seconds
+        limit.epoch_waited = waited
+        for _ in range(limit.limit):
+            limit._finished(pages)
+        with limit.cond:
+            limit._adjust()
+
+    def test_increase_while_throughput_holds(self):
+        limit = self.limit()
+        self.finish_epoch(limit, 100)
+        self.assertEqual(limit.limit, 3)
+        self.finish_epoch(limit, 100)
+        self.assertEqual(limit.limit, 4)
+        self.assertEqual(len(self.log), 2)
+
+    def test_no_increase_without_waiting_conversions(self):
+        limit = self.limit()
+        self.finish_epoch(limit, 100, waited=False)
+        self.assertEqual(limit.limit, 2)
+
+    def test_no_increase_over_maximum(self):
+        limit = self.limit(start=8, maximum=8)
+        self.finish_epoch(limit, 100)
+        self.assertEqual(limit.limit, 8)
+
+    def test_decrease_when_throughput_falls(self):
+        limit = self.limit(start=4)
+        self.finish_epoch(limit, 100)
+        self.assertEqual(limit.limit, 5)
+        self.finish_epoch(limit, 10) # 5 books of 10 pages instead of 5 of 100
+        self.assertEqual(limit.limit, 2)
+        self.assertIn('throughput fell', self.log[-1])
+
+    def test_short_epoch_is_not_closed(self):
+        limit = self.limit()
+        self.finish_epoch(limit, 100, seconds=1)
+        self.assertEqual(limit.limit, 2)
+        self.assertIsNone(limit.last_rate)
+
+    def test_decrease_on_memory_pressure(self):
+        limit = self.limit(start=6, reason='swapping')
+        limit.last_check = 0
+        with limit.cond:
+            limit._adjust()
+        self.assertEqual(limit.limit, 3)
+        self.assertIsNone(limit.last_rate)
+        self.assertIn('swapping', self.log[-1])
+
+    def test_fixed_limit_is_not_adapted(self):
+        limit = self.limit(fixed=3, reason='swapping')
+        limit.last_check = 0
+        self.finish_epoch(limit, 100)
+        self.assertEqual(limit.limit, 3)
+        self.assertEqual(self.log, [])
+
+
+class SlotTest(unittest.TestCase):
+
+    def test_nested_slot_does_not_wait(self):
+        limit = bulk.ConcurrencyLimit(1, 1, monitor=Monitor())
+        def job():
+            with limit.slot():
+                return limit.running
+        done = []
+        thread = threading.Thread(target=lambda: done.append(limit.run(job, 10)))
+        thread.start()
+        thread.join(5)
+        self.assertEqual(done, [1])
+        self.assertEqual(limit.running, 0)
+        self.assertEqual(limit.epoch_books, 1)
+
+    def test_slot_waits_for_other_thread(self):
+        limit = bulk.ConcurrencyLimit(1, 1, monitor=Monitor())
+        entered, release = threading.Event(), threading.Event()
+        def hold():
+            with limit.slot():
+                entered.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        entered.wait(5)
+        abort = threading.Event()
+        abort.set()
+        with limit.slot(abort=abort): # abort ends waiting
+            self.assertEqual(limit.running, 2)
+        release.set()
+        thread.join(5)
+        self.assertEqual(limit.running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import djvu
+
+HAS_BZZ = find_executable('bzz') is not None
+
+def page_form(width, height, extra=b''):
+    """FORM:DJVU chunk of page with INFO chunk and `extra` chunks."""
+    info = struct.pack(b'>HHBB', width, height, 26, 0) + struct.pack(b'<HBB', 300, 22, 1)
+    body = b'DJVU' + b'INFO' + struct.pack(b'>I', len(info)) + info + extra
+    return b'FORM' + struct.pack(b'>I', len(body)) + body
+
+def chunk(chunk_id, data):
+    return chunk_id + struct.pack(b'>I', len(data)) + data + b'\0' * (len(data) & 1)
+
+def bundle(forms, directory=b'\0\0\0', offsets=None):
+    """
+    Bundled document of `forms`, DIRM directory isn't decoded by the validation, so any bytes
+    do. `offsets` replace the computed ones.
+    """
+    dirm_size = 3 + 4 * len(forms) + len(directory)
+    pos = 4 + 12 + 8 + dirm_size + (dirm_size & 1)
+    computed = []
+    for form in forms:
+        computed.append(pos)
+        pos += len(form) + (len(form) & 1)
+    dirm = (struct.pack(b'>BH', 0x81, len(forms))
+            + struct.pack(b'>{}I'.format(len(forms)), *(offsets or computed)) + directory)
+    body = b'DJVM' + chunk(b'DIRM', dirm) + b''.join(
+        form + b'\0' * (len(form) & 1) for form in forms[:-1]) + forms[-1]
+    return djvu.MAGIC + b'FORM' + struct.pack(b'>I', len(body)) + body
+
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_blank_page_round_trip(self):
+        path = djvu.write_blank_page(os.path.join(self.folder, 'blank.djvu'), 2550, 3300, 600)
+        self.assertEqual(djvu.validate_document(path, pages=1).pages, 1)
+        offset, size = djvu.page_components(path)[0]
+        with open(path, 'rb') as f:
+            self.assertEqual(djvu.page_info(f, offset), (2550, 3300, 600))
+            self.assertFalse(djvu.has_includes(f, offset, size))
+            copy = djvu.write_component(f, offset, size, os.path.join(self.folder, 'copy.djvu'))
+        with open(path, 'rb') as a, open(copy, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_bundle(self):
+        # odd sized first page is padded, second one starts at even offset
+        forms = [page_form(100, 200, chunk(b'Sjbz', b'abc')), page_form(300, 400)]
+        path = self.write('bundle.djvu', bundle(forms))
+        summary = djvu.validate_document(path, pages=2)
+        self.assertEqual((summary.pages, summary.components), (2, 2))
+        self.assertEqual([size for _, size in djvu.page_components(path)],
+                         [len(form) for form in forms])
+        with open(path, 'rb') as f:
+            self.assertEqual([djvu.page_info(f, offset)[:2]
+                              for offset, _ in djvu.page_components(path)],
+                             [(100, 200), (300, 400)])
+
+    def test_wrong_page_count(self):
+        path = self.write('bundle.djvu', bundle([page_form(10, 10), page_form(10, 10)]))
+        with self.assertRaisesRegexp(djvu.DjVuError, '2 pages, 3 expected'):
+            djvu.validate_document(path, pages=3)
+
+    def test_truncated(self):
+        data = bundle([page_form(10, 10), page_form(10, 10)])
+        path = self.write('truncated.djvu', data[:-10])
+        with self.assertRaisesRegexp(djvu.DjVuError, 'truncated'):
+            djvu.validate_document(path)
+
+    def test_trailing_bytes(self):
+        path = self.write('trailing.djvu', bundle([page_form(10, 10)]) + b'junk')
+        with self.assertRaisesRegexp(djvu.DjVuError, 'after end of document'):
+            djvu.validate_document(path)
+
+    def test_wrong_directory_offsets(self):
+        forms = [page_form(10, 10), page_form(10, 10)]
+        good = bundle(forms)
+        offsets = list(struct.unpack(b'>2I', good[27:35]))
+        path = self.write('offsets.djvu', bundle(forms, offsets=[offsets[0], offsets[1] + 2]))
+        with self.assertRaisesRegexp(djvu.DjVuError, 'offsets do not match'):
+            djvu.validate_document(path)
+
+    def test_page_without_info(self):
+        body = b'DJVU' + chunk(b'Sjbz', b'data')
+        path = self.write('noinfo.djvu', djvu.MAGIC + b'FORM' + struct.pack(b'>I', len(body))
+                          + body)
+        with self.assertRaisesRegexp(djvu.DjVuError, 'INFO'):
+            djvu.validate_document(path)
+
+    def test_chunk_exceeding_its_form(self):
+        form = page_form(10, 10)
+        # INFO chunk claims more bytes than its page has
+        form = form[:16] + struct.pack(b'>I', 100) + form[20:]
+        path = self.write('chunk.djvu', djvu.MAGIC + form)
+        with self.assertRaisesRegexp(djvu.DjVuError, 'exceeds its container'):
+            djvu.validate_document(path)
+
+    def test_not_djvu(self):
+        path = self.write('test.pdf', b'%PDF-1.5\n')
+        with self.assertRaises(djvu.DjVuError):
+            djvu.validate_document(path)
+
+
+@unittest.skipUnless(HAS_BZZ, "DjVuLibre's bzz is needed to write bundled documents")
+class WriteBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def pages(self, sizes):
+        paths = []
+        for number, (width, height) in enumerate(sizes):
+            path = os.path.join(self.folder, 'page{}.djvu'.format(number))
+            with open(path, 'wb') as f:
+                f.write(djvu.MAGIC + page_form(width, height, chunk(b'Sjbz', b'x' * number)))
+            paths.append(path)
+        return paths
+
+    def test_bundle_pages_round_trip(self):
+        sizes = [(100, 200), (300, 400), (500, 600)]
+        dest = os.path.join(self.folder, 'book.djvu')
+        djvu.bundle_pages(dest, self.pages(sizes))
+        self.assertEqual(djvu.validate_document(dest, pages=3).components, 3)
+        with open(dest, 'rb') as f:
+            self.assertEqual([djvu.page_info(f, offset)[:2]
+                              for offset, _ in djvu.page_components(dest)], sizes)
+
+    def test_assemble_pages_reuses_and_blanks(self):
+        source = os.path.join(self.folder, 'source.djvu')
+        djvu.bundle_pages(source, self.pages([(100, 200), (300, 400)]))
+        dest = os.path.join(self.folder, 'book.djvu')
+        djvu.assemble_pages(dest, [(source, 1), djvu.BlankPage(50, 60, 300), (source, 0),
+                                   (source, 1)])
+        djvu.validate_document(dest, pages=4)
+        with open(dest, 'rb') as f:
+            self.assertEqual([djvu.page_info(f, offset)[:2]
+                              for offset, _ in djvu.page_components(dest)],
+                             [(300, 400), (50, 60), (100, 200), (300, 400)])
+
+    def test_indirect_document(self):
+        dest = os.path.join(self.folder, 'index.djvu')
+        djvu.bundle_pages(dest, self.pages([(100, 200), (300, 400)]), indirect=True)
+        for name in ('p000001.djvu', 'p000002.djvu'):
+            djvu.validate_document(os.path.join(self.folder, name), pages=1)
+        with self.assertRaisesRegexp(djvu.DjVuError, 'indirect'):
+            djvu.page_components(dest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import BaseHTTPServer
+import hashlib
+import os
+import re
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import download
+
+DATA = os.urandom(5 * download.CHUNK + 123)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+class FolderHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves server's folder, ignores Range headers like SimpleHTTPServer does."""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.folder, path.lstrip('/').split('?')[0])
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class RangeHandler(FolderHandler):
+    """Answers Range requests with 206, the first `server.cut` responses are cut off midway."""
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        start = int(match.group(1)) if match else 0
+        if start >= len(data) and data:
+            self.send_error(416)
+            return
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1,
+                                                                   len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if self.server.cut:
+            self.server.cut -= 1
+            body = body[:len(body) // 2] # client sees connection closed early
+        self.wfile.write(body)
+
+
+class ServerTest(unittest.TestCase):
+    """Serves DATA as backend.zip on localhost."""
+
+    handler = RangeHandler
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.served = os.path.join(self.folder, 'served')
+        os.mkdir(self.served)
+        with open(os.path.join(self.served, 'backend.zip'), 'wb') as f:
+            f.write(DATA)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), self.handler)
+        self.server.folder = self.served
+        self.server.requests = []
+        self.server.cut = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/backend.zip'.format(self.server.server_address[1])
+        self.dest = os.path.join(self.folder, 'backend.zip')
+        self.log = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class FetchTest(ServerTest):
+
+    def test_resume_part_file(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(DATA[:1000])
+        progress = []
+        download.fetch(self.url, self.dest, SHA256, lambda done, total: progress.append(
+            (done, total)), log=self.log.append)
+        self.assertEqual(self.read(self.dest), DATA)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertEqual(self.server.requests, ['bytes=1000-'])
+        self.assertEqual(progress[-1], (len(DATA), len(DATA)))
+        self.assertGreater(progress[0][0], 1000)
+
+    def test_interrupted_download_resumes(self):
+        self.server.cut = 1
+        download.fetch(self.url, self.dest, SHA256, log=self.log.append, retries=1)
+        self.assertEqual(self.read(self.dest), DATA)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNone(self.server.requests[0])
+        self.assertEqual(self.server.requests[1], 'bytes={}-'.format(len(DATA) // 2))
+        self.assertIn('interrupted', self.log[0])
+
+    def test_wrong_checksum(self):
+        with self.assertRaisesRegexp(Exception, 'SHA-256'):
+            download.fetch(self.url, self.dest, '0' * 64, log=self.log.append)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_missing_file(self):
+        with self.assertRaisesRegexp(Exception, 'Cannot download'):
+            download.fetch(self.url.replace('backend', 'other'), self.dest, log=self.log.append)
+        self.assertEqual(len(self.server.requests), 1) # 404 isn't retried
+
+    def test_retrieve_records_checksum_in_cache(self):
+        with open(os.path.join(self.served, 'backend.zip.sha256'), 'wb') as f:
+            f.write('{}  backend.zip\n'.format(SHA256).encode('ascii'))
+        cache = os.path.join(self.folder, 'cache')
+        path = download.retrieve(self.url, cache, log=self.log.append)
+        self.assertEqual(self.read(path), DATA)
+        self.assertEqual(download.published_checksum(path), SHA256)
+        requests = len(self.server.requests)
+        # cached archive is used without downloading, cache serves as mirror folder
+        self.assertEqual(download.retrieve(self.url, cache, log=self.log.append), path)
+        self.assertEqual(len(self.server.requests), requests)
+        other = os.path.join(self.folder, 'other')
+        download.retrieve(self.url, other, mirror=cache, log=self.log.append)
+        self.assertEqual(len(self.server.requests), requests)
+        self.assertEqual(self.read(os.path.join(other, 'backend.zip')), DATA)
+
+
+class NoRangesTest(ServerTest):
+    """SimpleHTTPServer answers range requests with the whole file."""
+
+    handler = FolderHandler
+
+    def test_part_file_is_started_over(self):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(b'stale bytes')
+        download.fetch(self.url, self.dest, SHA256, log=self.log.append)
+        self.assertEqual(self.read(self.dest), DATA)
+        self.assertEqual(self.server.requests, ['bytes=11-'])
+
+
+if __name__ == '__main__':
+    unittest.main()
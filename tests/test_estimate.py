@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import estimate
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'plugin', 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_writers_of_other_processes_are_merged(self):
+        # History objects of their own stand for fork_job workers, only the lock file is shared
+        def record():
+            history = estimate.History(self.path)
+            for _ in range(10):
+                history.record('pdf2djvu', 10, 5.0, 1000, 500)
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(estimate.History(self.path).rates('pdf2djvu').samples, 40)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['history.json'])
+
+    def test_stale_lock_is_broken(self):
+        history = estimate.History(self.path)
+        history.record('pdf2djvu', 10, 5.0, 1000, 500)
+        with open(self.path + '.lock', 'wb') as f:
+            f.write(b'{"pid": 999999999}') # process which is gone
+        history.record('pdf2djvu', 10, 5.0, 1000, 500)
+        self.assertEqual(history.rates('pdf2djvu').samples, 2)
+        self.assertFalse(os.path.exists(self.path + '.lock'))
+
+    def test_prediction_from_history(self):
+        history = estimate.History(self.path)
+        guess = history.predict('pdf2djvu', 10, 10 ** 6, 'DCTDecode')
+        self.assertEqual((guess.output, guess.samples), (10 * estimate.PAGE_BYTES, 0))
+        for _ in range(estimate.MIN_SAMPLES):
+            history.record('pdf2djvu', 10, 5.0, 10 ** 6, 10 ** 5, 'DCTDecode')
+        prediction = history.predict('pdf2djvu', 20, 10 ** 6, 'DCTDecode')
+        self.assertEqual((prediction.output, prediction.samples), (2 * 10 ** 5, estimate.MIN_SAMPLES))
+        self.assertAlmostEqual(prediction.gain, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import inflight, processes
+
+KEY = inflight.inflight_key('library', 1, (100, 12345.0))
+
+class InFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.poll, inflight.POLL = inflight.POLL, 0.01
+
+    def tearDown(self):
+        inflight.POLL = self.poll
+        shutil.rmtree(self.folder)
+
+    def flight(self):
+        return inflight.InFlight(self.folder, KEY)
+
+    def waiter(self, abort=None):
+        """Thread acquiring the lock too, its result is appended to returned list."""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.flight().acquire(abort)))
+        thread.start()
+        return thread, results
+
+    def dead_pid(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        return exited.pid
+
+    def test_waiter_attaches_to_result(self):
+        owner = self.flight()
+        self.assertIsNone(owner.acquire())
+        thread, results = self.waiter()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive()) # waits while owner converts
+        owner.finish('/tmp/book.djvu')
+        thread.join(5)
+        self.assertEqual(results, [inflight.Attached('/tmp/book.djvu', os.getpid())])
+        self.assertFalse(os.path.exists(owner.lock))
+
+    def test_waiter_converts_after_failed_owner(self):
+        owner = self.flight()
+        owner.acquire()
+        thread, results = self.waiter()
+        owner.release()
+        thread.join(5)
+        self.assertEqual(results, [None])
+        self.assertTrue(os.path.exists(owner.lock))
+
+    def test_abort_stops_waiting(self):
+        self.flight().acquire()
+        abort = threading.Event()
+        abort.set()
+        thread, results = self.waiter(abort)
+        thread.join(5)
+        self.assertEqual(results, [inflight.Attached(None, os.getpid())])
+
+    def test_lock_of_dead_owner_is_taken_over_once(self):
+        lock = os.path.join(self.folder, KEY + '.lock')
+        with open(lock, 'wb') as f:
+            f.write(json.dumps({'pid' : self.dead_pid(), 'started' : 0}).encode('utf-8'))
+        abort = threading.Event()
+        waiters = [self.waiter(abort) for _ in range(4)]
+        for thread, _ in waiters:
+            thread.join(0.5)
+        owners = [results for _, results in waiters if results == [None]]
+        self.assertEqual(len(owners), 1)
+        # waiter which read the dead owner before the lock was taken over leaves it alone
+        self.assertFalse(processes.break_stale_lock(lock))
+        self.assertTrue(os.path.exists(lock))
+        with open(lock, 'rb') as f:
+            self.assertEqual(json.loads(f.read().decode('utf-8'))['pid'], os.getpid())
+        abort.set()
+        for thread, _ in waiters:
+            thread.join(5)
+        self.assertEqual([results[0].djvu for _, results in waiters if results != [None]],
+                         [None] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
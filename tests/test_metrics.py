@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import metrics
+
+def snapshot_of(*calls):
+    registry = metrics.Registry()
+    for method, args, labels in calls:
+        getattr(registry, method)(*args, **labels)
+    return registry.snapshot()
+
+def samples(text):
+    """Sample lines of Prometheus text by name with labels."""
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_every_metric_is_described(self):
+        text = metrics.render(metrics._empty())
+        for name, (kind, _) in metrics.DEFINITIONS.items():
+            self.assertIn('# TYPE {} {}\n'.format(name, kind), text)
+        # gauges are exposed even before anything happened
+        self.assertEqual(samples(text)['djvumaker_queue_depth'], 0)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_counters_gauges_and_labels(self):
+        snapshot = snapshot_of(('inc', ('djvumaker_conversions_total',), {'backend' : 'pdf2djvu'}),
+                               ('inc', ('djvumaker_conversions_total',), {'backend' : 'pdf2djvu'}),
+                               ('inc', ('djvumaker_failures_total',),
+                                {'backend' : 'djvudigital', 'reason' : 'say "no"'}),
+                               ('add', ('djvumaker_backend_processes', 3), {}),
+                               ('add', ('djvumaker_backend_processes', -1), {}))
+        values = samples(metrics.render(metrics._merge(metrics._empty(), snapshot)))
+        self.assertEqual(values['djvumaker_conversions_total{backend="pdf2djvu"}'], 2)
+        self.assertEqual(
+            values['djvumaker_failures_total{backend="djvudigital",reason="say \\"no\\""}'], 1)
+        self.assertEqual(values['djvumaker_backend_processes'], 2)
+
+    def test_histogram_buckets_are_cumulative(self):
+        snapshot = snapshot_of(('observe', ('djvumaker_conversion_seconds', 3), {}),
+                               ('observe', ('djvumaker_conversion_seconds', 100), {}),
+                               ('observe', ('djvumaker_conversion_seconds', 5000), {}))
+        values = samples(metrics.render(metrics._merge(metrics._empty(), snapshot)))
+        self.assertEqual(values['djvumaker_conversion_seconds_bucket{le="1"}'], 0)
+        self.assertEqual(values['djvumaker_conversion_seconds_bucket{le="5"}'], 1)
+        self.assertEqual(values['djvumaker_conversion_seconds_bucket{le="120"}'], 2)
+        self.assertEqual(values['djvumaker_conversion_seconds_bucket{le="3600"}'], 2)
+        self.assertEqual(values['djvumaker_conversion_seconds_bucket{le="+Inf"}'], 3)
+        self.assertEqual(values['djvumaker_conversion_seconds_sum'], 5103)
+        self.assertEqual(values['djvumaker_conversion_seconds_count'], 3)
+
+    def test_pages_per_second(self):
+        snapshot = snapshot_of(('inc', ('djvumaker_pages_converted_total', 120), {'backend' : 'a'}),
+                               ('inc', ('djvumaker_pages_converted_total', 60), {'backend' : 'b'}))
+        values = samples(metrics.render(metrics._merge(metrics._empty(), snapshot)))
+        self.assertEqual(values['djvumaker_pages_per_second'], 180 / metrics.RATE_WINDOW)
+
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, pid, snapshot):
+        with open(os.path.join(self.folder, 'process-{}-1.json'.format(pid)), 'wb') as f:
+            f.write(json.dumps(snapshot).encode('utf-8'))
+
+    def test_gauges_of_exited_processes_are_dropped(self):
+        exited = subprocess.Popen([sys.executable, '-c', '']) # pid of process which is gone
+        exited.wait()
+        calls = [('inc', ('djvumaker_conversions_total',), {}),
+                 ('add', ('djvumaker_backend_processes', 1), {})]
+        self.write(os.getpid(), snapshot_of(*calls))
+        self.write(exited.pid, snapshot_of(*calls))
+        values = samples(metrics.render(metrics.collect(self.folder)))
+        self.assertEqual(values['djvumaker_conversions_total'], 2)
+        self.assertEqual(values['djvumaker_backend_processes'], 1)
+        # snapshot of exited process is folded, its counters still count
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['process-{}-1.json'.format(os.getpid()), 'retired.json'])
+        values = samples(metrics.render(metrics.collect(self.folder)))
+        self.assertEqual(values['djvumaker_conversions_total'], 2)
+
+    def test_snapshot_folded_by_other_process_is_not_counted_again(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        self.write(exited.pid, snapshot_of(('inc', ('djvumaker_conversions_total',), {})))
+        path = os.path.join(self.folder, 'process-{}-1.json'.format(exited.pid))
+        # both processes read the snapshot before either of them took the lock
+        metrics._fold(self.folder, [path], 0)
+        metrics._fold(self.folder, [path], 0)
+        values = samples(metrics.render(metrics.collect(self.folder)))
+        self.assertEqual(values['djvumaker_conversions_total'], 1)
+        self.assertEqual(os.listdir(self.folder), ['retired.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
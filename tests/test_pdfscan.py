@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from tests import ROOT
+from calibre_plugins.djvumaker import pdfscan
+
+# 300 dpi letter page
+WIDTH, HEIGHT = 2550, 3300
+PAGE_CONTENT = b'q 612 0 0 792 0 0 cm /Im0 Do Q'
+
+def build_pdf(path, pages, extra=()):
+    """
+    Write PDF of `pages`, list of (content, image dict, image data) where image may be None,
+    `extra` objects are numbered after pages and referenced as `{N}` in image dicts.
+    """
+    objects = [None, None] # catalog, page tree
+    kids = []
+    extra_base = 3 + 3 * len(pages)
+    for content, image, data in pages:
+        page_num = len(objects) + 1
+        kids.append(page_num)
+        resources = b''
+        if image is not None:
+            resources = '/Resources << /XObject << /Im0 {} 0 R >> >>'.format(page_num + 2).encode()
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] {} /Contents {} 0 R >>'
+                       .format(resources.decode(), page_num + 1).encode())
+        objects.append(b'<< /Length ' + str(len(content)).encode() + b' >>\nstream\n' + content
+                       + b'\nendstream')
+        if image is not None:
+            image = image.format(*range(extra_base, extra_base + len(extra)))
+            objects.append(image.encode() + ' /Length {} >>\nstream\n'.format(len(data)).encode()
+                           + data + b'\nendstream')
+        else:
+            objects.append(b'null')
+    for obj in extra:
+        objects.append(obj)
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+        ' '.join('{} 0 R'.format(num) for num in kids), len(kids)).encode()
+    out, offsets = [b'%PDF-1.5\n'], []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(sum(len(part) for part in out))
+        out.append('{} 0 obj\n'.format(num).encode() + obj + b'\nendobj\n')
+    xref = sum(len(part) for part in out)
+    out.append('xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1).encode())
+    out.extend('{:010d} 00000 n \n'.format(offset).encode() for offset in offsets)
+    out.append('trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(
+        len(objects) + 1, xref).encode())
+    with open(path, 'wb') as f:
+        f.write(b''.join(out))
+
+def g4_image():
+    return ('<< /Type /XObject /Subtype /Image /Width {} /Height {} /BitsPerComponent 1'
+            ' /ColorSpace /DeviceGray /Filter /CCITTFaxDecode'
+            ' /DecodeParms << /K -1 /Columns {} /Rows {} >>'.format(WIDTH, HEIGHT, WIDTH, HEIGHT))
+
+def jbig2_image():
+    return ('<< /Type /XObject /Subtype /Image /Width {} /Height {} /BitsPerComponent 1'
+            ' /ColorSpace /DeviceGray /Filter /JBIG2Decode'
+            ' /DecodeParms << /JBIG2Globals {{0}} 0 R >>'.format(WIDTH, HEIGHT))
+
+def mask_image(width, height):
+    return ('<< /Type /XObject /Subtype /Image /Width {} /Height {} /ImageMask true'
+            ' /Filter /FlateDecode'.format(width, height))
+
+def globals_stream(data):
+    return b'<< /Length ' + str(len(data)).encode() + b' >>\nstream\n' + data + b'\nendstream'
+
+
+class ScanPagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'test.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_sparse_g4_page_is_not_blank(self):
+        # one line of text compresses to a few hundred bytes of G4 on a 8.4 Mpix page
+        build_pdf(self.path, [(PAGE_CONTENT, g4_image(), b'\x26\xa0' * 100)])
+        self.assertFalse(pdfscan.scan_pages(self.path)[0].blank)
+
+    def test_jbig2_page_with_globals_is_not_blank(self):
+        # symbols are in JBIG2Globals, the page stream only places them
+        build_pdf(self.path, [(PAGE_CONTENT, jbig2_image(), b'\x00\x01' * 20)],
+                  [globals_stream(b'\x00\x00\x00\x00\x00' * 400)])
+        self.assertFalse(pdfscan.scan_pages(self.path)[0].blank)
+
+    def test_jbig2_pages_with_different_globals_differ(self):
+        image = ('<< /Type /XObject /Subtype /Image /Width 8 /Height 8 /BitsPerComponent 1'
+                 ' /Filter /JBIG2Decode /DecodeParms << /JBIG2Globals {} 0 R >>')
+        build_pdf(self.path, [(PAGE_CONTENT, image.format('{0}'), b'same page stream'),
+                              (PAGE_CONTENT, image.format('{1}'), b'same page stream')],
+                  [globals_stream(b'symbols A'), globals_stream(b'symbols B')])
+        first, second = pdfscan.scan_pages(self.path)
+        self.assertNotEqual(first.key, second.key)
+
+    def test_empty_and_white_pages_are_blank(self):
+        white = zlib.compress(b'\xff' * 2 * 16)
+        build_pdf(self.path, [(b'', None, None), (b'q Q', None, None),
+                              (PAGE_CONTENT, mask_image(12, 16), white)])
+        self.assertEqual([page.blank for page in pdfscan.scan_pages(self.path)],
+                         [True, True, True])
+
+    def test_one_black_pixel_is_not_blank(self):
+        rows = [b'\xff\xf0'] * 16 # 12 pixels per row, padding bits are 0
+        rows[7] = b'\xff\x70'
+        build_pdf(self.path, [(PAGE_CONTENT, mask_image(12, 16), zlib.compress(b''.join(rows)))])
+        self.assertFalse(pdfscan.scan_pages(self.path)[0].blank)
+
+    def test_duplicate_pages_have_equal_keys(self):
+        data = b'\x26\xa0' * 100
+        build_pdf(self.path, [(PAGE_CONTENT, g4_image(), data), (PAGE_CONTENT, g4_image(), data),
+                              (b'BT /F1 12 Tf (x) Tj ET', None, None)])
+        keys = [page.key for page in pdfscan.scan_pages(self.path)]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        plan = pdfscan.plan_distinct_pages(self.path)
+        self.assertEqual(plan.encode_pages, [0, 2])
+        self.assertEqual(plan.duplicates, 1)
+
+
+class DocumentTest(unittest.TestCase):
+    """Repository's test.pdf."""
+
+    path = os.path.join(ROOT, 'test.pdf')
+
+    def test_pages(self):
+        with pdfscan.PDFDocument(self.path) as doc:
+            count = doc.page_count()
+            self.assertGreater(count, 0)
+            self.assertEqual(len(list(doc.pages())), count)
+        keys = pdfscan.scan_pages(self.path)
+        self.assertEqual(len(keys), count)
+        self.assertEqual(keys, pdfscan.scan_pages(self.path))
+
+    def test_profile(self):
+        profile = pdfscan.profile_document(self.path)
+        with pdfscan.PDFDocument(self.path) as doc:
+            self.assertEqual(profile.page_count, doc.page_count())
+        self.assertTrue(0 < profile.sampled <= pdfscan.RASTER_SAMPLES)
+        self.assertTrue(0.5 <= profile.confidence <= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import sys
+import unittest
+
+import tests # registers calibre_plugins.djvumaker
+from calibre_plugins.djvumaker import processes
+
+@unittest.skipUnless(hasattr(os, 'wait4'), 'CPU time of children is not known on Windows')
+class WaitCpuTest(unittest.TestCase):
+
+    def test_exit_status_and_cpu_time(self):
+        proc = processes.popen_group([sys.executable, '-c',
+                                      'import sys; sum(range(10 ** 6)); sys.exit(3)'])
+        self.assertGreater(processes.wait_cpu(proc), 0)
+        self.assertEqual((proc.returncode, proc.poll()), (3, 3))
+
+    def test_killed_process(self):
+        proc = processes.popen_group([sys.executable, '-c',
+                                      'import os, signal; os.kill(os.getpid(), signal.SIGTERM)'])
+        processes.wait_cpu(proc)
+        self.assertEqual(proc.returncode, -15)
+
+    def test_process_reaped_elsewhere(self):
+        proc = processes.popen_group([sys.executable, '-c', 'import sys; sys.exit(2)'])
+        proc.wait() # i.e. by abort watcher
+        self.assertIsNone(processes.wait_cpu(proc))
+        self.assertEqual(proc.returncode, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+tracing module for Calibre plugin djvumaker - opt-in timing of conversion phases
+
+Tracing is on when DJVUMAKER_TRACE environment variable holds a folder. Every process appends its
+finished spans as JSON lines to its own file in that folder, so fork_job workers, which inherit
+the variable, are traced too. `export` merges the files into Chrome trace JSON, which can be
+opened in chrome://tracing or https://ui.perfetto.dev. With DJVUMAKER_PROFILE=1, spans started
+with profile=True also dump cProfile statistics (only the outermost one per thread).
+
+References:
+(#NODOC)
+TRACE_ENV, PROFILE_ENV      -- environment variables turning tracing and profiling on
+enabled()                   -- whether tracing is on in this process
+enable(folder, profile)     -- turn tracing on for this process and its children
+disable()
+trace_env()                 -- environment variables for fork_job workers
+Span(name, profile=False, **args) -- timed span, context manager or .end()
+span                        -- alias of Span
+traced(name=None, profile=False) -- decorator tracing whole function
+export(folder, dest)        -- merge traces of all processes into Chrome trace JSON
+clear(folder)               -- remove recorded traces and profiles
+"""
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import cProfile
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import time
+from functools import wraps
+
+TRACE_ENV = 'DJVUMAKER_TRACE'
+PROFILE_ENV = 'DJVUMAKER_PROFILE'
+
+_lock = threading.Lock()
+_local = threading.local()
+_seen_threads = set()
+_process_named = []
+
+def enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+def enable(folder, profile=False):
+    """Turn tracing on, processes started from now on inherit it."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    os.environ[TRACE_ENV] = folder
+    if profile:
+        os.environ[PROFILE_ENV] = '1'
+    else:
+        os.environ.pop(PROFILE_ENV, None)
+
+def disable():
+    os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(PROFILE_ENV, None)
+
+def trace_env():
+    """Tracing variables to pass as `env` of fork_job, empty if tracing is off."""
+    return {key : os.environ[key] for key in (TRACE_ENV, PROFILE_ENV) if os.environ.get(key)}
+
+def _write(event):
+    folder = os.environ.get(TRACE_ENV)
+    if not folder:
+        return
+    pid, thread = os.getpid(), threading.current_thread()
+    events = []
+    with _lock:
+        if not _process_named:
+            _process_named.append(pid)
+            events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+                           'args' : {'name' : '{} ({})'.format(
+                               os.path.basename(sys.argv[0] if sys.argv else 'python'), pid)}})
+        if thread.ident not in _seen_threads:
+            _seen_threads.add(thread.ident)
+            events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : thread.ident,
+                           'args' : {'name' : thread.name}})
+        events.append(event)
+        try:
+            with open(os.path.join(folder, 'trace-{}.jsonl'.format(pid)), 'ab') as f:
+                for item in events:
+                    f.write(json.dumps(item).encode('utf-8') + b'\n')
+        except EnvironmentError:
+            pass # tracing must never break conversion
+
+class Span(object):
+    """
+    Timed phase, recorded as Chrome trace complete event when it ends. Does nothing when tracing
+    is off. Use as context manager, or call .end() for phases spanning several code blocks.
+    """
+
+    def __init__(self, name, profile=False, **args):
+        self.name = name
+        self.args = args
+        self.start = None
+        self.profiler = None
+        if not enabled():
+            return
+        if profile and os.environ.get(PROFILE_ENV) and not getattr(_local, 'profiling', False):
+            _local.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.time()
+
+    def end(self, **args):
+        if self.start is None:
+            return
+        duration = time.time() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            _local.profiling = False
+            try:
+                self.profiler.dump_stats(os.path.join(os.environ[TRACE_ENV], '{}-{}-{}.prof'.format(
+                    re.sub(r'\W+', '_', self.name), os.getpid(), int(self.start * 1000))))
+            except EnvironmentError:
+                pass
+        self.args.update(args)
+        _write({'name' : self.name, 'cat' : 'djvumaker', 'ph' : 'X', 'pid' : os.getpid(),
+                'tid' : threading.current_thread().ident, 'ts' : int(self.start * 1e6),
+                'dur' : int(duration * 1e6),
+                'args' : {key : '{}'.format(value) for key, value in self.args.items()}})
+        self.start = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.end(error='{}: {}'.format(exc_type.__name__, exc_value))
+        else:
+            self.end()
+        return False
+
+span = Span
+
+def traced(name=None, profile=False):
+    """Decorator recording every call of function as span."""
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            with Span(name or fun.__name__, profile=profile):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def export(folder, dest):
+    """Merge traces recorded in `folder` into Chrome trace JSON file `dest`, return event count."""
+    events = []
+    for path in sorted(glob.glob(os.path.join(folder, 'trace-*.jsonl'))):
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    pass # line cut by killed process
+    with open(dest, 'wb') as f:
+        f.write(json.dumps({'traceEvents' : events, 'displayTimeUnit' : 'ms'}).encode('utf-8'))
+    return sum(1 for event in events if event.get('ph') == 'X')
+
+def clear(folder):
+    for path in glob.glob(os.path.join(folder, 'trace-*.jsonl')) + \
+            glob.glob(os.path.join(folder, '*.prof')):
+        os.remove(path)
@@ -17,9 +17,11 @@ version_intlist_to_str(verintlist)
 version_from_output(output)
 check_version_executable(executable_path)
 create_backend_link(backend_name, version)
-install_pdf2djvu(PLUGINNAME, preferences, log=print)
+PDF2DJVU_FALLBACK_VERSION -- version downloaded when current one cannot be
+install_pdf2djvu(PLUGINNAME, preferences, log=print, sha256=None)
 get_url_basename(url)
-download_pdf2djvu(web_version, log)
+download_pdf2djvu(web_version, log, preferences=None, sha256=None) -- archive from cache, mirror or GitHub
+download_cache(plugin_name)
 unpack_zip_or_tar(PLUGINNAME, fpath, log)
 
 --- utility functions ---
@@ -27,18 +29,31 @@ EmptyClass()
 empty_function(*args, **kwargs)
 add_method_dec(method, method_name)
 discover_backend(backend_name, preferences, folder)
+page_ranges(pages)
+parse_page_ranges(text)
+format_duration(seconds)
+file_fingerprint(path)
+cpu_count()
+physical_memory()
+run_concurrently(jobs, workers, prints=print)
+temporary_path(suffix='') -- path of new empty temporary file, removed by its consumer
 """
 from __future__ import unicode_literals, division, absolute_import, print_function
 
 import argparse
 import os
-import urllib
 import urllib2
 import urlparse
 import subprocess
+import threading
+import traceback
 
 from calibre.constants import isosx, iswindows, islinux, isbsd
 from calibre.utils.config import config_dir
+from calibre.ptempfile import PersistentTemporaryFile
+from calibre_plugins.djvumaker.download import retrieve
+
+PDF2DJVU_FALLBACK_VERSION = '0.9.5'
 
 def create_cli_parser(self_DJVUmaker, PLUGINNAME, PLUGINVER_DOT, REGISTERED_BACKENDS_KEYS):
     """Creates CLI for plugin."""
@@ -61,6 +76,15 @@ def create_cli_parser(self_DJVUmaker, PLUGINNAME, PLUGINVER_DOT, REGISTERED_BACK
                                 help='installs or sets backend')
     parser_backend.add_argument('backend', choices=REGISTERED_BACKENDS_KEYS,
                                         help='choosed backend', nargs="?")
+    parser_backend.add_argument('--mirror', metavar='URL|FOLDER',
+                                help=('with install, download backend archives from this mirror'
+                                      " first (i.e. other machine's download cache), remembered,"
+                                      " `none` turns it off"))
+    parser_backend.add_argument('--cache', metavar='FOLDER',
+                                help=('with install, keep downloaded archives and their checksums'
+                                      ' in FOLDER, remembered, `none` restores default'))
+    parser_backend.add_argument('--sha256', metavar='HEX',
+                                help='with install, expected SHA-256 of downloaded archive')
 
     parser_convert = subparsers.add_parser('convert', help='Convert file to djvu')
     parser_convert.set_defaults(func=self_DJVUmaker.cli_convert)
@@ -75,6 +99,38 @@ def create_cli_parser(self_DJVUmaker, PLUGINNAME, PLUGINVER_DOT, REGISTERED_BACK
                                               " turn on postimport conversion first (`calibre-debug -r"
                                               " djvumaker -- postimport -y`)"),
                                 action="store_true")
+    group_convert.add_argument("--batch", metavar='SOURCE',
+                                help=("convert documents of folder tree SOURCE, listed in file SOURCE"
+                                      " (one path per line) or read from stdin (`-`) outside"
+                                      " calibre's library, without questions; JSON summary is the"
+                                      " last line of output"),
+                                action="store", type=str)
+    parser_convert.add_argument('-o', "--output", metavar='DIR',
+                                help=("with --batch, write DJVUs into DIR keeping layout of SOURCE"
+                                      " instead of next to source documents"),
+                                action="store", type=str)
+    parser_convert.add_argument("--refresh", help=("with -i or --all, re-encode only changed pages of"
+                                                   " replaced PDFs and splice them into existing DJVU"),
+                                action="store_true")
+    def pages_type(text):
+        try:
+            return parse_page_ranges(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError("expected 1-based page ranges like '1-20,35', got"
+                                             " '{}'".format(text))
+    parser_convert.add_argument("--pages", metavar='RANGES', type=pages_type,
+                                help=("with -p or -i, convert only these pages (i.e. 1-20) into a"
+                                      " preview DJVU and project time and size of whole book"))
+    parser_convert.add_argument("--jobs", metavar='N', type=int,
+                                help=("with --all or --batch, convert N books at once instead of adapting their"
+                                      " number to throughput and free memory"))
+    parser_convert.add_argument("--force", help=("with -i, --all or --batch, convert also scans predicted to"
+                                                 " shrink less than min_gain as DJVU"),
+                                action="store_true")
+    parser_convert.add_argument("--estimate", help=("with --all, only print projected CPU time, wall"
+                                                    " time and DJVU size of the run and its costliest"
+                                                    " books from past conversions"),
+                                action="store_true")
 
     parser_postimport = subparsers.add_parser('postimport', help='change postimport settings')
     parser_postimport.set_defaults(func=self_DJVUmaker.cli_set_postimport)
@@ -87,13 +143,92 @@ def create_cli_parser(self_DJVUmaker, PLUGINNAME, PLUGINVER_DOT, REGISTERED_BACK
                                 help="sets plugin to do not convert PDF files after import (default)",
                                 action="store_true")
 
+    parser_profile = subparsers.add_parser('profile', help=('change device profile, backends render'
+                                           ' pages at DPI fitting them to device screen'))
+    parser_profile.set_defaults(func=self_DJVUmaker.cli_set_profile)
+    parser_profile.add_argument('profile', nargs='?',
+                                help=("device profile name, custom resolution as WIDTHxHEIGHT"
+                                      " or `none` to render at backend's default DPI"))
+    parser_profile.add_argument('-l', '--list', help='list known device profiles',
+                                action='store_true')
+
+    parser_worker = subparsers.add_parser('worker', help=('run worker node converting books sent by'
+                                          ' other calibre installations in local network'))
+    parser_worker.set_defaults(func=self_DJVUmaker.cli_worker)
+    parser_worker.add_argument('--host', default='127.0.0.1',
+                               help=('address to listen on, 127.0.0.1 by default; other addresses'
+                                     " (`''` for all interfaces) require --token"))
+    parser_worker.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser_worker.add_argument('--capacity', type=int,
+                               help=('number of books or page shards converted at once, by default'
+                                     " from backend's declared threads and memory"))
+    parser_worker.add_argument('--token', help=('shared secret required from coordinators, sent'
+                                                ' unencrypted like the documents'))
+
+    parser_nodes = subparsers.add_parser('nodes', help=('change worker nodes which convert books'
+                                         ' of this library, lists them without arguments'))
+    parser_nodes.set_defaults(func=self_DJVUmaker.cli_nodes)
+    parser_nodes.add_argument('--add', metavar='HOST:PORT[/CAPACITY]', help='add worker node')
+    parser_nodes.add_argument('--remove', metavar='HOST:PORT[/CAPACITY]',
+                              help='remove worker node')
+    parser_nodes.add_argument('--loopback', type=int, metavar='N',
+                              help='run N local worker nodes, for testing (0 turns them off)')
+    parser_nodes.add_argument('--loopback-capacity', type=int, metavar='N',
+                              help='capacity of every local worker node')
+    parser_nodes.add_argument('--shard-pages', type=int, metavar='N',
+                              help='minimal number of pages sent to one node')
+    parser_nodes.add_argument('--retries', type=int, metavar='N',
+                              help='how many times jobs of lost nodes are retried')
+    parser_nodes.add_argument('--token', help='shared secret of worker nodes')
+
+    parser_index = subparsers.add_parser('index', help=('profile library books (pages, image encodings,'
+                                         ' DPI, scan verdict) into sidecar index'))
+    parser_index.set_defaults(func=self_DJVUmaker.cli_index)
+    parser_index.add_argument('--rebuild', action='store_true', help='profile all books again')
+    parser_index.add_argument('--show', metavar='ID', type=int, help='print recorded profile of book')
+    parser_index.add_argument('--tag', metavar='TAG', help='add TAG to books indexed as scans')
+    parser_index.add_argument('--background', choices=['on', 'off'],
+                              help='turn background indexing in GUI on or off (off by default)')
+    parser_index.add_argument('--auto-tag', metavar='TAG',
+                              help="tag new scans found by background indexer, '' turns it off")
+
+    parser_trace = subparsers.add_parser('trace', help=('record timing of conversion phases, shows'
+                                         ' tracing state without arguments'))
+    parser_trace.set_defaults(func=self_DJVUmaker.cli_trace)
+    group_trace = parser_trace.add_mutually_exclusive_group(required=False)
+    group_trace.add_argument('--on', help='turn tracing on', action='store_true')
+    group_trace.add_argument('--off', help='turn tracing off', action='store_true')
+    parser_trace.add_argument('--profile', action='store_true',
+                              help='with --on, dump cProfile statistics of Python phases')
+    parser_trace.add_argument('--export', metavar='FILE',
+                              help='write recorded spans as Chrome trace JSON')
+    parser_trace.add_argument('--clear', action='store_true',
+                              help='remove recorded spans and profiles')
+
+    parser_metrics = subparsers.add_parser('metrics', help=('publish live metrics of conversions for'
+                                                            ' Prometheus, shows state without'
+                                                            ' arguments'))
+    parser_metrics.set_defaults(func=self_DJVUmaker.cli_metrics)
+    group_metrics = parser_metrics.add_mutually_exclusive_group(required=False)
+    group_metrics.add_argument('--on', help='turn metrics on', action='store_true')
+    group_metrics.add_argument('--off', help='turn metrics off', action='store_true')
+    parser_metrics.add_argument('--port', type=int, metavar='PORT',
+                                help='serve metrics on http://127.0.0.1:PORT/metrics, 0 turns it off')
+    parser_metrics.add_argument('--textfile', metavar='FILE',
+                                help=('write metrics to FILE (i.e. in node_exporter textfile'
+                                      ' collector folder), empty string restores default'))
+    parser_metrics.add_argument('--show', action='store_true',
+                                help='print current metrics of all processes')
+
     parser_install_deps = subparsers.add_parser('install_deps',
         help='(depreciated) alias for `{}backend install djvudigital`'.format(parser.prog))
     parser_install_deps.set_defaults(func=self_DJVUmaker.cli_backend, command='install',
                                      backend='djvudigital')
     parser_convert_all  = subparsers.add_parser('convert_all',
         help='(depreciated) alias for `{}convert --all`'.format(parser.prog))
-    parser_convert_all.set_defaults(func=self_DJVUmaker.cli_convert, all=True)
+    parser_convert_all.set_defaults(func=self_DJVUmaker.cli_convert, all=True, path=None, id=None,
+                                    refresh=False, pages=None, jobs=None,
+                                    estimate=False, force=False, batch=None, output=None)
     return parser
 
 
@@ -182,7 +317,7 @@ def create_backend_link(backend_name, version):
 # class Installer_pdf2djvu(Installer):
 #     pass
 
-def install_pdf2djvu(PLUGINNAME, preferences, log=print):
+def install_pdf2djvu(PLUGINNAME, preferences, log=print, sha256=None):
     #NODOC
     backend_path, saved_version, installed_version, path_version = discover_backend('pdf2djvu',
         preferences, plugin_dir(PLUGINNAME))
@@ -210,8 +345,16 @@ def install_pdf2djvu(PLUGINNAME, preferences, log=print):
     log("Checking pdf2djvu's author page for current relase...")
     github_latest_url = r'https://github.com/jwilk/pdf2djvu/releases/latest'
     # DEBUG UNCOMMENT
-    github_page = urllib2.urlopen(github_latest_url)
-    web_version = get_url_basename(github_page.geturl())
+    try:
+        github_page = urllib2.urlopen(github_latest_url, timeout=30)
+        web_version = get_url_basename(github_page.geturl())
+    except (urllib2.URLError, IOError) as err:
+        if not preferences['download']['mirror']:
+            raise
+        # machines of local network may have no access to GitHub, only to the mirror
+        log("Cannot reach pdf2djvu's author page ({}), using version {} from mirror.".format(
+            err, PDF2DJVU_FALLBACK_VERSION))
+        web_version = PDF2DJVU_FALLBACK_VERSION
 
     # DEBUG COMMENT
     # web_version = '0.9.5'
@@ -227,7 +370,7 @@ def install_pdf2djvu(PLUGINNAME, preferences, log=print):
 
     def download_and_unpack():
         try:
-            fpath = download_pdf2djvu(web_version, log)
+            fpath = download_pdf2djvu(web_version, log, preferences, sha256)
         except:
             msg = ('Error occured during downloading new relase, you can try manually download current'
                    ' relase from {} and extract it inside calibre{sep}plugins{sep}djvumaker'
@@ -276,7 +419,7 @@ def get_url_basename(url):
     #NODOC
     return os.path.basename(urlparse.urlsplit(url).path)
 
-def download_pdf2djvu(web_version, log):
+def download_pdf2djvu(web_version, log, preferences=None, sha256=None):
     #NODOC
     def gen_zip_url(code):
         #NODOC
@@ -285,53 +428,37 @@ def download_pdf2djvu(web_version, log):
         #NODOC
         return r'https://github.com/jwilk/pdf2djvu/releases/download/{}/pdf2djvu-{}.tar.xz'.format(code, code)
 
-    # TODO: what with fallback!?! new argument
     # TODO: cross import
     PLUGINNAME = 'djvumaker'
-    fallback_version = '0.9.5'
-    if iswindows:
-        fallback_arch_url = gen_zip_url(fallback_version)
-        arch_url = gen_zip_url(web_version)
-    else:
-        fallback_arch_url = gen_tar_url(fallback_version)
-        arch_url = gen_tar_url(web_version)
-
-    def download_progress_bar(i, chunk, full):
-        """'args: a count of blocks transferred so far,
-        a block size in bytes, and the total size of the file"""
-        printProgressBar(i*chunk, full, prefix = '\tProgress:', suffix = 'Complete',
-                         length=50, prints=print)
-
-    def check_msg(fpath, msg):
-        return (
-                'Content-Length' in msg and int(msg['Content-Length']) > 0
-            and 'Content-Type' in msg and msg['Content-Type'].split('/')[0] == 'application'
-            and 'Content-Disposition' in msg
-            and msg['Content-Disposition'].split(';')[0] == 'attachment'
-            and msg['Content-Disposition'].split(';')[1].strip() == 'filename={}'.format(
-                os.path.basename(fpath))
-                )
+    fallback_version = PDF2DJVU_FALLBACK_VERSION
+    gen_url = gen_zip_url if iswindows else gen_tar_url
+    settings = preferences['download'] if preferences is not None else {}
+    mirror = settings.get('mirror')
+    cache = settings.get('cache') or download_cache(PLUGINNAME)
+
+    def download_progress_bar(done, total):
+        if total:
+            printProgressBar(done, total, prefix = '\tProgress:', suffix = 'Complete',
+                             length=50, prints=print)
 
     log('Downloading current version of pdf2djvu...')
-    if not os.path.isdir(plugin_dir(PLUGINNAME)):
-        os.mkdir(plugin_dir(PLUGINNAME))
-    fpath, msg = urllib.urlretrieve(arch_url, os.path.join(plugin_dir(PLUGINNAME), get_url_basename(arch_url)),
-                                    download_progress_bar)
-    # print() # should progess bar function handle this TODO:
-    if not check_msg(fpath, msg):
-        log('Cannot download current version {} from GitHub.'.format(web_version))
-        if web_version != fallback_version:
-            log('Trying download version {}...'.format(fallback_version), download_progress_bar)
-            fpath, msg_fallback = urllib.urlretrieve(fallback_arch_url, os.path.join(plugin_dir(PLUGINNAME),
-                                                     get_url_basename(fallback_arch_url)),
-                                                     download_progress_bar)
-            # print() # should progess bar function handle this TODO:
-            if not check_msg(fpath, msg_fallback):
-                raise Exception('Cannot download pdf2djvu.')
-    else:
-        log('Dowloaded {} file'.format(os.path.abspath(fpath)))
+    try:
+        fpath = retrieve(gen_url(web_version), cache, mirror, sha256, download_progress_bar, log)
+    except Exception:
+        log('Cannot download current version {}.'.format(web_version))
+        if web_version == fallback_version:
+            raise
+        log('Trying download version {}...'.format(fallback_version))
+        # a checksum given for current version cannot match the fallback archive
+        fpath = retrieve(gen_url(fallback_version), cache, mirror, None, download_progress_bar,
+                         log)
+    log('Dowloaded {} file'.format(os.path.abspath(fpath)))
     return fpath
 
+def download_cache(plugin_name):
+    """Default folder keeping downloaded backend archives and their checksums."""
+    return os.path.join(plugin_dir(plugin_name), 'downloads')
+
 def unpack_zip_or_tar(PLUGINNAME, fpath, log):
     #NODOC
     # DEBUG COMMENT
@@ -340,7 +467,7 @@ def unpack_zip_or_tar(PLUGINNAME, fpath, log):
     if iswindows:
         from zipfile import ZipFile
         with ZipFile(fpath, 'r') as myzip:
-            myzip.extractall(os.path.dirname(fpath))
+            myzip.extractall(plugin_dir(PLUGINNAME))
     else:
         raise NotImplementedError('Python 2.7 Standard Library cannot unpack tar.xz archives, do this manually or through shell.')
         # it may not not work for macOS:
@@ -348,9 +475,7 @@ def unpack_zip_or_tar(PLUGINNAME, fpath, log):
         # TODO: you have to make it still..., with sth like:
         # subprocess.call(['make'])
         # doesn't work for linux or mac then
-    log('Extracted downloaded archive')
-    os.remove(fpath)
-    log('Removed downloaded archive')
+    log('Extracted downloaded archive, it is kept in {}'.format(os.path.dirname(fpath)))
 
 # Print iterations progress
 def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '=',
@@ -399,5 +524,87 @@ def add_method_dec(obj, name):
         return fun
     return inner
 
+def page_ranges(pages):
+    """Conversion from 0-based page indexes [0, 1, 2, 5] to 1-based page ranges '1-3,6'."""
+    ranges = []
+    for page in sorted(set(pages)):
+        if ranges and ranges[-1][1] == page:
+            ranges[-1][1] = page + 1
+        else:
+            ranges.append([page + 1, page + 1])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last)
+                    for first, last in ranges)
+
+def parse_page_ranges(text):
+    """Conversion from 1-based page ranges '1-3,6' to sorted 0-based page indexes [0, 1, 2, 5]."""
+    pages = set()
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first:
+            raise ValueError('invalid page range: {}'.format(part.strip()))
+        pages.update(range(first - 1, last))
+    return sorted(pages)
+
+def format_duration(seconds):
+    """Human readable duration: '12.3 s', '4 min 05 s', '2 h 07 min'."""
+    if seconds < 60:
+        return '{:.1f} s'.format(seconds)
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes < 60:
+        return '{} min {:02d} s'.format(minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return '{} h {:02d} min'.format(hours, minutes)
+
+def file_fingerprint(path):
+    """Cheap identity of file content: [size, mtime], changes whenever the file is replaced."""
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def cpu_count():
+    """Number of CPU cores, 1 if it cannot be determined."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def physical_memory():
+    """Physical memory in MB, None if it cannot be determined."""
+    try:
+        return os.sysconf(str('SC_PHYS_PAGES')) * os.sysconf(str('SC_PAGE_SIZE')) // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None # Windows
+
+def run_concurrently(jobs, workers, prints=print):
+    """Run callables `jobs` in `workers` threads. Exceptions of jobs are printed, not raised."""
+    pending = list(reversed(jobs))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                job = pending.pop()
+            try:
+                job()
+            except Exception:
+                prints(traceback.format_exc())
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(jobs))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def temporary_path(suffix=''):
+    """
+    Path of new empty file in calibre's temporary folder, closed, for tools which write it
+    by name. The file is not removed automatically: whoever consumes it deletes it (calibre
+    clears its temporary folder on exit).
+    """
+    reserved = PersistentTemporaryFile(suffix)
+    reserved.close()
+    return reserved.name
+
 def plugin_dir(plugin_name):
     return os.path.join(config_dir, 'plugins', plugin_name)